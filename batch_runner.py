@@ -0,0 +1,271 @@
+"""
+Headless runs of the reserving pipeline (load -> configure -> triangles ->
+link ratios -> LDF) for nightly and quarter-end batches:
+
+    python batch_runner.py batch.json
+
+The config file lists the extracts to run and one or more named
+configurations whose keys mirror the Step 2 questions of the app:
+
+    {
+        "files": ["extracts/2024Q4.xlsx"],
+        "output": "batch_output",
+        "workers": 8,
+        "averages": ["simple", "volume", "regression"],
+        "mack": true,
+        "configurations": {
+            "gross": {"q0": "*", "q2": "Gross", "q10": "Paid + Incurred", "q11": "Quarterly"},
+            "net_ri": {"q0": ["Motor", "Property"], "q2": "Gross + Net", "q11": "Yearly"}
+        }
+    }
+
+q0 may be one segment, a list of segments, "*" for every segment in the
+file, or "All segments" for one stacked run. Missing answers take the
+wizard's defaults. Every (file, configuration, segment) job runs in its own
+worker process and writes its triangles as CSV under
+output/<file>/<configuration>/<segment>/<dataset>/, and the chain ladder
+reserves of all its datasets (with Mack standard errors when "mack" is
+set) next to them as reserves.csv and reserves_by_origin.csv.
+"""
+import argparse
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ingest import load_path, write_store, has_store, list_segments, read_segment, apply_filters
+from preprocess import ALL_SEGMENTS, compile_plan, apply_plan
+from triangles import (GRAINS, PAID, INCURRED, fingerprint, build_catalog, segment_labels, segment_frame, triangle_view,
+                       fused_view, fused_link_ratio_view, fused_ldf_view, ldf_grid_view, reserve_view)
+
+
+# Answers used when a configuration leaves a question out: the first
+# option of each Step 2 question
+DEFAULT_ANSWERS = {
+    "q0": "*",
+    "batch_index": "",
+    "q1": "Accident",
+    "q2": "Gross + RI",
+    "q3": "No",
+    "ss_choice3": "Gross and SS separately",
+    "q4": "No",
+    "threshold": 0,
+    "ss_choice4": "Cap Claims",
+    "q5": "Yes",
+    "ss_choice5": "Calculate IBNR separately",
+    "q6": "Exposures",
+    "q7": "No",
+    "ss_choice7": "Separate",
+    "q8": "Yes",
+    "q9": "Yes",
+    "q10": "Paid only",
+    "q11": "Yearly",
+}
+
+AVERAGES = ["simple", "volume", "regression"]
+
+
+def _safe_name(value):
+    # Segment and dataset labels become folder names
+    return re.sub(r"[^\w.-]+", "_", str(value)).strip("_") or "_"
+
+
+def load_config(path):
+    """
+    Read a batch config file and fill in defaults.
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    if not config.get("files"):
+        raise ValueError("Batch config lists no files")
+    if not config.get("configurations"):
+        raise ValueError("Batch config has no configurations")
+
+    config.setdefault("output", "batch_output")
+    config.setdefault("workers", None)
+    config.setdefault("averages", AVERAGES)
+    config.setdefault("mack", False)
+    config["configurations"] = {
+        name: {**DEFAULT_ANSWERS, **answers} for name, answers in config["configurations"].items()
+    }
+    return config
+
+
+def plan_jobs(config):
+    """
+    Expand a config into one job per (file, configuration, segment).
+
+    Each file is loaded once here so that its ingest cache and partitioned
+    store exist before the workers start; workers then only read their
+    own segment from the store.
+    """
+    jobs = []
+    for path in config["files"]:
+        df_paid, df_OS, key = load_path(path)
+        write_store(key, df_paid, df_OS)
+        if has_store(key):
+            available = list_segments(key)
+        else:
+            available = df_paid["Line of Business"].dropna().unique().tolist()
+
+        for name, answers in config["configurations"].items():
+            q0 = answers["q0"]
+            if q0 == "*":
+                segments = available
+            elif isinstance(q0, list):
+                segments = q0
+            else:
+                segments = [q0]
+
+            for segment in segments:
+                jobs.append({
+                    "path": path,
+                    "key": key,
+                    "configuration": name,
+                    "answers": {**answers, "q0": segment},
+                    "averages": config["averages"],
+                    "mack": config["mack"],
+                    "output": os.path.join(config["output"], _safe_name(os.path.splitext(os.path.basename(path))[0]),
+                                           _safe_name(name), _safe_name(segment)),
+                })
+    return jobs
+
+
+def _segment_rows(job, sheet):
+    # Same sources as segment_rows in the app: the store when there is one,
+    # the cached sheet otherwise
+    segment = job["answers"]["q0"]
+    if segment != ALL_SEGMENTS and has_store(job["key"]):
+        return read_segment(job["key"], sheet, segment)
+
+    df_paid, df_OS, _ = load_path(job["path"])
+    df = df_paid if sheet == "Paid" else df_OS
+    if segment == ALL_SEGMENTS:
+        return df
+    return apply_filters(df, [("Line of Business", "==", segment)])
+
+
+def _write(frame, folder, name):
+    frame.to_csv(os.path.join(folder, name + ".csv"))
+
+
+def run_job(job):
+    """
+    Run the whole pipeline for one job and write every triangle the app
+    would show in Steps 3-5, and its Step 6 reserves. Returns the number of
+    files written.
+    """
+    answers = job["answers"]
+    plan = compile_plan(answers)
+    config_key = fingerprint(job["key"], plan)
+    prepared = apply_plan(plan, _segment_rows(job, "Paid"), "Paid")
+    prepared_OS = apply_plan(plan, _segment_rows(job, "OS"), "OS")
+
+    grain = GRAINS.get(answers["q11"], "OMDM")
+    with_incurred = answers["q10"] == "Paid + Incurred"
+    cache = {}
+    written = 0
+
+    # A stacked run is written out one segment per folder, like
+    # separate runs would have been
+    if prepared["index"] is None:
+        targets = {None: job["output"]}
+    else:
+        segments = prepared["frame"][prepared["index"]].dropna().unique().tolist()
+        targets = {segment: os.path.join(job["output"], _safe_name(segment)) for segment in segments}
+
+    catalog = build_catalog(config_key, prepared, prepared_OS)
+    for entry in catalog.values():
+        incremental = fused_view(cache, entry, grain)
+        cumulative = fused_view(cache, entry, grain, cumulative=True)
+        link_ratios = fused_link_ratio_view(cache, entry, grain)
+        ldfs = {average: fused_ldf_view(cache, entry, grain, average) for average in job["averages"]}
+        grid = ldf_grid_view(cache, entry, grain)
+
+        views = {
+            "paid_incremental": triangle_view(cache, entry["paid"], grain),
+            "paid_cumulative": cumulative[PAID],
+            "paid_link_ratios": link_ratios[PAID],
+        }
+        for average, ldf in ldfs.items():
+            views[f"paid_ldf_{average}"] = ldf[PAID]
+
+        if with_incurred and entry["os"] is not None:
+            views["os_incremental"] = triangle_view(cache, entry["os"], grain)
+            views["incurred_incremental"] = incremental[INCURRED]
+            views["incurred_cumulative"] = cumulative[INCURRED]
+            views["incurred_link_ratios"] = link_ratios[INCURRED]
+            for average, ldf in ldfs.items():
+                views[f"incurred_ldf_{average}"] = ldf[INCURRED]
+
+        # A dataset stacked by segment only holds the segments it has rows for
+        present = segment_labels(cumulative)
+        for segment, root in targets.items():
+            if segment is not None and segment not in present:
+                continue
+            folder = os.path.join(root, _safe_name(entry["label"]))
+            os.makedirs(folder, exist_ok=True)
+            for view_name, tri in views.items():
+                _write(segment_frame(tri, segment), folder, view_name)
+                written += 1
+            # Every averaging method and window, one row each
+            _write(grid.xs(segment if segment is not None else grid.index[0][0], level=0), folder, "ldf_grid")
+            written += 1
+
+    # Every dataset and segment in one fit
+    if catalog:
+        reserves = reserve_view(cache, catalog, grain, job["mack"])
+        present = reserves[0].index.get_level_values(0).unique().tolist()
+        for segment, root in targets.items():
+            if segment is not None and segment not in present:
+                continue
+            os.makedirs(root, exist_ok=True)
+            for name, frame in zip(("reserves", "reserves_by_origin"), reserves):
+                if not with_incurred:
+                    frame = frame[frame.index.get_level_values("Column") == PAID]
+                _write(frame.xs(segment if segment is not None else frame.index[0][0], level=0), root, name)
+                written += 1
+
+    return written
+
+
+def run_batch(config, workers=None):
+    """
+    Run every job of a config over a process pool. Returns a list of
+    (job, files written or the exception raised).
+    """
+    jobs = plan_jobs(config)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers or config["workers"]) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results.append((job, future.result()))
+            except Exception as e:
+                # One bad segment should not lose the rest of the batch
+                results.append((job, e))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the reserving pipeline headless over a batch config.")
+    parser.add_argument("config", help="JSON batch config (see batch_runner.py)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: config, then CPU count)")
+    args = parser.parse_args(argv)
+
+    results = run_batch(load_config(args.config), args.workers)
+
+    failed = 0
+    for job, result in sorted(results, key=lambda r: r[0]["output"]):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"FAILED {job['output']}: {result}")
+        else:
+            print(f"ok     {job['output']} ({result} files)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
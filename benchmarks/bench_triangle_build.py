@@ -0,0 +1,77 @@
+"""
+Triangle build: chainladder grouping the raw rows (the original
+`cl.Triangle(data=filtered_df, ...)` path) against triangles.build_triangle,
+which bins the rows into cells with np.bincount first.
+
+    python benchmarks/bench_triangle_build.py --rows 1000000 --segments 10
+
+Both triangles are checked to agree to the cent before timings are shown.
+"""
+import argparse
+import os
+import sys
+import time
+
+import chainladder as cl
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_claims import generate  # noqa: E402
+from triangles import ORIGIN_COLUMN, build_triangle, dense  # noqa: E402
+
+DEVELOPMENT = "Payment Date"
+AMOUNT = "Gross Claim Amount Paid as at"
+SEGMENT = "Line of Business"
+
+
+def synthetic_rows(rows, segments, years, seed=0):
+    # The Paid sheet of a synthetic extract over the last `years` years
+    start = f"{2025 - years + 1}-01-01"
+    df_paid, _ = generate(rows, segments, start=start, end="2025-12-31", os_rows=0, seed=seed)
+    return df_paid[[SEGMENT, ORIGIN_COLUMN, DEVELOPMENT, AMOUNT]].astype({SEGMENT: "category"})
+
+
+def timed(label, build, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = build()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<28}{best:>10.3f} s")
+    return result, best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark triangle construction from claim rows.")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--segments", type=int, default=5)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    data = synthetic_rows(args.rows, args.segments, args.years)
+    index = SEGMENT if args.segments > 1 else None
+    print(f"{args.rows:,} rows, {args.segments} segment(s), {args.years} years")
+
+    raw = data.assign(**{SEGMENT: data[SEGMENT].astype("object")})
+    kwargs = {"index": [SEGMENT]} if index else {}
+    reference, before = timed(
+        "cl.Triangle on rows",
+        lambda: cl.Triangle(data=raw, origin=ORIGIN_COLUMN, development=DEVELOPMENT, columns=AMOUNT, **kwargs),
+        args.repeat,
+    )
+    binned, after = timed("build_triangle (bincount)", lambda: build_triangle(data, DEVELOPMENT, AMOUNT, index), args.repeat)
+
+    expected = np.nan_to_num(dense(reference).values)
+    actual = np.nan_to_num(dense(binned).values)
+    if expected.shape != actual.shape:
+        raise SystemExit(f"Shape mismatch: {expected.shape} vs {actual.shape}")
+    diff = np.abs(expected - actual).max()
+    if diff >= 0.005:
+        raise SystemExit(f"Triangles differ by up to {diff:.4f}")
+    print(f"max difference {diff:.2e}, speed-up x{before / after:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Synthetic claims extracts with the exact Paid/OS layout of the production
+extracts (the 29 columns of Test_file.xlsx, in the same order), at any
+size:
+
+    python benchmarks/generate_claims.py extract.xlsx --rows 500000 --segments 8
+    python benchmarks/generate_claims.py extract_dir --rows 5000000 --format parquet
+
+Excel caps a sheet at 1,048,576 rows, so larger extracts are written as
+Paid.parquet / OS.parquet instead.
+"""
+import argparse
+import os
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+# Column order of both sheets; only the amount column differs
+_COLUMNS = [
+    "Serial Number", "Accident/Treatment Date", "Serial Number.1", "Data Source Qtr", "Line of Business",
+    "Product", "Coverage", "Reserving Segment", "IFRS17 GOC", "Unique Claim ID", "Unique Policy ID",
+    "Unique Event ID", "Open/Closed/Reopen", None, "RI Proportional", "RI Non Proportional", "Recoveries",
+    "Subrogation (Individual)", "Subrogation (Company)", "Coinsurance Amount", "Excess/Deductible",
+    "Claim/LAE", "Reporting Date", "Payment Date", "Risk Start Date", "Risk End Date", "Large Claims",
+    "Earned Premiums", "Expsosures",
+]
+PAID_SCHEMA = [c or "Gross Claim Amount Paid as at" for c in _COLUMNS]
+OS_SCHEMA = [c or "Gross Claim Amount OS as at" for c in _COLUMNS]
+
+XLSX_MAX_ROWS = 1_048_575
+
+LINES_OF_BUSINESS = ["Auto", "Property", "Liability", "Marine", "Health", "Engineering", "Aviation", "Energy"]
+PRODUCTS = ["Premium", "Standard", "Basic"]
+COVERAGES = ["Liability", "Own Damage", "Bodily Injury", "Fire", "Theft"]
+
+
+def _segment_names(segments):
+    names = LINES_OF_BUSINESS[:segments]
+    return names + [f"Line {i}" for i in range(len(names) + 1, segments + 1)]
+
+
+def _quarter_labels(dates):
+    return (dates.dt.year.astype(str) + "Q" + dates.dt.quarter.astype(str)).to_numpy()
+
+
+def _sheet(rng, rows, segments, start, end, large_threshold, large_share, large_alpha, sheet):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    span = (end - start).days
+    days = lambda values: pd.Series(pd.to_timedelta(values.astype(int), unit="D"))
+
+    accident = start + days(rng.integers(0, span, rows))
+    reporting = (accident + days(rng.exponential(45, rows))).clip(upper=end)
+    payment = (reporting + days(rng.exponential(240, rows))).clip(upper=end)
+
+    # Lognormal attritional claims plus a Pareto tail above the threshold
+    large = rng.random(rows) < large_share
+    amount = rng.lognormal(7.5, 1.2, rows)
+    amount[large] = large_threshold * (1 + rng.pareto(large_alpha, large.sum()))
+    amount = np.round(amount, 2)
+
+    n_claims = max(rows // 3, 1)
+    claim = rng.integers(0, n_claims, rows)
+    risk_start = accident - days(rng.integers(0, 365, rows))
+    development = payment if sheet == "Paid" else reporting
+
+    return pd.DataFrame({
+        "Serial Number": np.arange(1, rows + 1),
+        "Accident/Treatment Date": accident,
+        "Serial Number.1": rng.integers(1, 100, rows),
+        "Data Source Qtr": _quarter_labels(development),
+        "Line of Business": np.asarray(_segment_names(segments))[rng.integers(0, segments, rows)],
+        "Product": np.asarray(PRODUCTS)[rng.integers(0, len(PRODUCTS), rows)],
+        "Coverage": np.asarray(COVERAGES)[rng.integers(0, len(COVERAGES), rows)],
+        "Reserving Segment": np.char.add("Segment ", np.asarray(list("ABCD"))[rng.integers(0, 4, rows)]),
+        "IFRS17 GOC": np.char.add("GOC", rng.integers(1, 6, rows).astype(str)),
+        "Unique Claim ID": np.char.add("CLM", (100000 + claim).astype(str)),
+        "Unique Policy ID": np.char.add("POL", (500000 + claim // 2).astype(str)),
+        "Unique Event ID": np.char.add("EVT", (900000 + claim // 5).astype(str)),
+        "Open/Closed/Reopen": rng.choice(["Open", "Closed", "Reopen"], rows, p=[0.3, 0.6, 0.1]),
+        ("Gross Claim Amount Paid as at" if sheet == "Paid" else "Gross Claim Amount OS as at"): amount,
+        "RI Proportional": np.round(amount * rng.uniform(0, 0.3, rows), 2),
+        "RI Non Proportional": np.round(np.where(large, amount - large_threshold, 0) * 0.8, 2),
+        "Recoveries": np.round(amount * rng.uniform(0, 0.05, rows), 2),
+        "Subrogation (Individual)": np.round(amount * rng.uniform(0, 0.02, rows), 2),
+        "Subrogation (Company)": np.round(amount * rng.uniform(0, 0.03, rows), 2),
+        "Coinsurance Amount": np.round(amount * rng.uniform(0, 0.1, rows), 2),
+        "Excess/Deductible": np.round(rng.uniform(0, 2000, rows), 2),
+        "Claim/LAE": rng.choice(["Claim", "LAE"], rows, p=[0.9, 0.1]),
+        "Reporting Date": reporting,
+        "Payment Date": payment,
+        "Risk Start Date": risk_start,
+        "Risk End Date": risk_start + pd.Timedelta(days=365),
+        "Large Claims": large.astype(int),
+        "Earned Premiums": rng.integers(10_000, 100_000, rows),
+        "Expsosures": rng.integers(1_000, 20_000, rows),
+    })[PAID_SCHEMA if sheet == "Paid" else OS_SCHEMA]
+
+
+def generate(rows, segments=4, start="2015-01-01", end="2025-12-31", large_threshold=250_000.0,
+             large_share=0.005, large_alpha=1.5, os_rows=None, seed=0):
+    """
+    Generate a synthetic extract. Returns (df_paid, df_OS) with the columns
+    of PAID_SCHEMA and OS_SCHEMA.
+
+    rows / os_rows      rows of the Paid / OS sheets (OS defaults to rows // 2)
+    segments            distinct Lines of Business
+    start, end          accident date span; development dates never pass `end`
+    large_threshold     claims in the tail are Pareto(large_alpha) above it
+    large_share         fraction of rows in the tail
+    """
+    rng = np.random.default_rng(seed)
+    args = (segments, start, end, large_threshold, large_share, large_alpha)
+    df_paid = _sheet(rng, rows, *args, sheet="Paid")
+    df_OS = _sheet(rng, os_rows if os_rows is not None else max(rows // 2, 1), *args, sheet="OS")
+    return df_paid, df_OS
+
+
+def write_extract(path, df_paid, df_OS, fmt="xlsx"):
+    """
+    Write an extract as a two-sheet workbook (Paid first, then OS), or as
+    Paid.parquet and OS.parquet in the folder `path`.
+    """
+    if fmt == "parquet":
+        os.makedirs(path, exist_ok=True)
+        df_paid.to_parquet(os.path.join(path, "Paid.parquet"), index=False)
+        df_OS.to_parquet(os.path.join(path, "OS.parquet"), index=False)
+        return
+
+    if max(len(df_paid), len(df_OS)) > XLSX_MAX_ROWS:
+        raise ValueError(f"More than {XLSX_MAX_ROWS:,} rows do not fit in an Excel sheet; use --format parquet")
+    # Rows are streamed through a write-only workbook, which holds no cells
+    # in memory (pandas' ExcelWriter cannot use that mode)
+    wb = openpyxl.Workbook(write_only=True)
+    for title, df in (("Paid", df_paid), ("OS", df_OS)):
+        ws = wb.create_sheet(title)
+        ws.append(list(df.columns))
+        for row in df.itertuples(index=False, name=None):
+            ws.append(row)
+    wb.save(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic claims extract.")
+    parser.add_argument("path", help="output .xlsx file, or folder with --format parquet")
+    parser.add_argument("--rows", type=int, default=100_000, help="Paid rows")
+    parser.add_argument("--os-rows", type=int, default=None, help="OS rows (default: rows // 2)")
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--start", default="2015-01-01", help="first accident date")
+    parser.add_argument("--end", default="2025-12-31", help="last accident/development date")
+    parser.add_argument("--large-threshold", type=float, default=250_000.0)
+    parser.add_argument("--large-share", type=float, default=0.005)
+    parser.add_argument("--large-alpha", type=float, default=1.5, help="Pareto tail index")
+    parser.add_argument("--format", choices=["xlsx", "parquet"], default="xlsx")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    df_paid, df_OS = generate(args.rows, args.segments, args.start, args.end, args.large_threshold,
+                              args.large_share, args.large_alpha, args.os_rows, args.seed)
+    write_extract(args.path, df_paid, df_OS, args.format)
+    print(f"Wrote {len(df_paid):,} Paid and {len(df_OS):,} OS rows to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Stage-by-stage benchmark of the triangle pipeline on a synthetic extract
+(see generate_claims.py) or on a real one:
+
+    python benchmarks/suite.py --rows 1000000 --segments 8
+    python benchmarks/suite.py --extract Test_file.xlsx
+
+Every stage is timed (best of --repeat runs) and then run once more under
+tracemalloc for its peak allocation. Results are written to
+benchmarks/results/<time>-<git revision>.json and compared with the latest
+earlier result for the same parameters, so slowdowns between versions
+show up as regressions.
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import chainladder as cl
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_claims import XLSX_MAX_ROWS, generate, write_extract  # noqa: E402
+from ingest import apply_filters, read_workbook  # noqa: E402
+from preprocess import DEVELOPMENT_COLUMNS, apply_plan, compile_plan, materialize  # noqa: E402
+from triangles import GRAINS, build_triangle, segment_frame  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Step 2 answers that switch on every q2-q7 branch of the preprocessing
+ANSWERS = {
+    "q2": "Gross + Net",
+    "q3": "Yes", "ss_choice3": "Net of SS",
+    "q4": "Yes", "threshold": 250_000, "ss_choice4": "Cap Claims",
+    "q5": "Yes", "ss_choice5": "Calculate IBNR separately",
+    "q7": "Yes", "ss_choice7": "Separate",
+    "q11": "Quarterly",
+}
+
+REGRESSION = 1.2   # flag stages at least 20% slower than the previous result
+
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def measure(fn, repeat):
+    """
+    Best wall time of `repeat` calls of fn, then one more call under
+    tracemalloc for the peak allocation. Returns (result, seconds, peak MB).
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, best, peak / (1 << 20)
+
+
+def run_stages(raw, segment, grain, repeat):
+    """
+    Run the pipeline stage by stage on the Paid sheet of a workbook, each
+    stage taking the previous one's output. Returns [(stage, s, MB)].
+    """
+    rows = []
+
+    def stage(name, fn):
+        result, seconds, peak = measure(fn, repeat)
+        rows.append((name, seconds, peak))
+        print(f"{name:<22}{seconds:>10.3f} s{peak:>10.1f} MB", flush=True)
+        return result
+
+    df_paid, _ = stage("load", lambda: read_workbook(raw))
+    df = stage("segment filter", lambda: apply_filters(df_paid, [("Line of Business", "==", segment)]))
+    plan = compile_plan(dict(ANSWERS, q0=segment))
+    prepared = stage("preprocess (q2-q7)", lambda: apply_plan(plan, df, "Paid"))
+    data = materialize(prepared, "filtered_df")
+    measure_column = prepared["datasets"]["filtered_df"]["measure"]
+    tri = stage("cl.Triangle build", lambda: build_triangle(data, DEVELOPMENT_COLUMNS["Paid"], measure_column))
+    tri = stage("grain", lambda: tri.grain(GRAINS[grain]))
+    cum = stage("incr_to_cum", lambda: tri.incr_to_cum())
+    stage("link_ratio", lambda: cum.link_ratio)
+    stage("cl.Development", lambda: cl.Development(average="volume").fit(cum).ldf_)
+    stage("formatting", lambda: segment_frame(cum))
+    return rows
+
+
+def previous_result(params):
+    for path in sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")), reverse=True):
+        with open(path) as f:
+            result = json.load(f)
+        if result["params"] == params:
+            return path, result
+    return None, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the triangle pipeline.")
+    parser.add_argument("--extract", help="benchmark this workbook instead of a synthetic one")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--start", default="2015-01-01")
+    parser.add_argument("--end", default="2025-12-31")
+    parser.add_argument("--large-share", type=float, default=0.005)
+    parser.add_argument("--segment", help="segment to filter on (default: the first)")
+    parser.add_argument("--grain", choices=list(GRAINS), default="Quarterly")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-save", action="store_true", help="do not store the result")
+    args = parser.parse_args(argv)
+
+    if args.extract:
+        with open(args.extract, "rb") as f:
+            raw = f.read()
+        params = {"extract": os.path.basename(args.extract), "size": len(raw)}
+    else:
+        if args.rows > XLSX_MAX_ROWS:
+            raise SystemExit(f"The load stage reads an .xlsx, which holds at most {XLSX_MAX_ROWS:,} rows")
+        params = {"rows": args.rows, "segments": args.segments, "start": args.start, "end": args.end,
+                  "large_share": args.large_share}
+        df_paid, df_OS = generate(args.rows, args.segments, args.start, args.end, large_share=args.large_share)
+        args.segment = args.segment or str(df_paid["Line of Business"].iloc[0])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "extract.xlsx")
+            write_extract(path, df_paid, df_OS)
+            with open(path, "rb") as f:
+                raw = f.read()
+        del df_paid, df_OS
+
+    segment = args.segment
+    if segment is None:
+        segment = str(read_workbook(raw)[0]["Line of Business"].dropna().iloc[0])
+    params.update(segment=segment, grain=args.grain)
+
+    print(f"{params}\n")
+    rows = run_stages(raw, segment, args.grain, args.repeat)
+    stages = {name: {"seconds": seconds, "peak_mb": peak} for name, seconds, peak in rows}
+
+    previous_path, previous = previous_result(params)
+    if previous:
+        print(f"\nAgainst {os.path.basename(previous_path)}:")
+        for name, now in stages.items():
+            before = previous["stages"].get(name)
+            if not before:
+                continue
+            ratio = now["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+            flag = "  REGRESSION" if ratio >= REGRESSION else ""
+            print(f"{name:<22}{before['seconds']:>10.3f} -> {now['seconds']:.3f} s  x{ratio:.2f}{flag}")
+
+    if not args.no_save:
+        revision = git_revision()
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{stamp}-{revision}.json")
+        result = {
+            "revision": revision,
+            "time": stamp,
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "chainladder": cl.__version__,
+            "params": params,
+            "stages": stages,
+        }
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nSaved {os.path.relpath(path, ROOT)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import queue
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# Review comments shared by every session on the server. SQLite in WAL
+# mode lets readers and one writer work at the same time, so posting a
+# comment never blocks reviewers reading (or the app computing).
+DB_PATH = ".cache/comments.sqlite3"
+POOL_SIZE = 4
+PAGE_SIZE = 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS comments (
+    id      INTEGER PRIMARY KEY,
+    project TEXT    NOT NULL,
+    segment TEXT    NOT NULL,
+    step    INTEGER NOT NULL,
+    dataset TEXT    NOT NULL,
+    user    TEXT    NOT NULL,
+    text    TEXT    NOT NULL,
+    time    TEXT    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comments_thread ON comments (project, segment, step, dataset, id);
+"""
+
+_pool = None
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=5.0, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _get_pool():
+    # Created on first use; Streamlit sessions are threads of one process,
+    # so they all share this pool
+    global _pool
+    if _pool is None:
+        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+        pool = queue.Queue()
+        for i in range(POOL_SIZE):
+            conn = _connect()
+            if i == 0:
+                conn.executescript(_SCHEMA)
+            pool.put(conn)
+        _pool = pool
+    return _pool
+
+
+@contextmanager
+def connection():
+    """
+    Borrow a pooled connection; waits if every connection is in use.
+    """
+    pool = _get_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+
+def add_comment(project, segment, step, dataset, user, text):
+    """
+    Post a comment to the (project, segment, step, dataset) thread.
+    Returns its id.
+    """
+    with connection() as conn:
+        cursor = conn.execute(
+            "INSERT INTO comments (project, segment, step, dataset, user, text, time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (project, segment, step, dataset, user, text, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        )
+        return cursor.lastrowid
+
+
+def list_comments(project, segment, step, dataset, before_id=None, limit=PAGE_SIZE):
+    """
+    One page of a thread, newest first. Pass the smallest id of a page as
+    `before_id` to get the next (older) page; the index keeps each page
+    query as cheap as the first.
+    """
+    query = "SELECT id, user, text, time FROM comments WHERE project = ? AND segment = ? AND step = ? AND dataset = ?"
+    params = [project, segment, step, dataset]
+    if before_id is not None:
+        query += " AND id < ?"
+        params.append(before_id)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+
+    with connection() as conn:
+        return [dict(row) for row in conn.execute(query, params)]
+
+
+def count_comments(project, segment, step, dataset):
+    with connection() as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM comments WHERE project = ? AND segment = ? AND step = ? AND dataset = ?",
+            (project, segment, step, dataset),
+        ).fetchone()[0]
@@ -0,0 +1,255 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from ingest import CACHE_VERSION
+from preprocess import AMOUNT_COLUMNS, DEVELOPMENT_COLUMNS, SS_COLUMNS, RI_COLUMNS
+from triangles import ORIGIN_COLUMN, PREMIUM, dataset_spec, fingerprint, month_codes
+
+
+# Materialized monthly cube of an extract, built once per upload:
+#   segment x row class x measure x origin month x development lag (months)
+# Row classes are Claim/LAE (Claim, LAE, other) x Reopened (no, yes) and
+# measures are the gross amount, SS, RI and Earned Premiums, so the
+# datasets of any plan without large claims or yearly ALAE dates are sums
+# of cube slices. The cube is stored as .npy files and memory-mapped, so
+# switching segment or development period only reads the cells involved,
+# never the rows.
+CUBE_DIR = os.path.join(".cache", "cube")
+SEGMENT_COLUMN = "Line of Business"
+
+CUBE_VERSION = 2   # bump whenever the cube layout changes
+
+CLAIM_LAE = ["Claim", "LAE", None]      # None: anything else
+N_CLASSES = len(CLAIM_LAE) * 2
+MEASURES = ["amount", "SS", "RI", "EP"]
+
+
+def _folder(key):
+    return os.path.join(CUBE_DIR, f"{key}-v{CACHE_VERSION}.{CUBE_VERSION}")
+
+
+def has_cube(key):
+    return key is not None and os.path.exists(os.path.join(_folder(key), "meta.json"))
+
+
+def _row_classes(df):
+    claim_lae = df["Claim/LAE"]
+    lae_code = np.where(claim_lae == "Claim", 0, np.where(claim_lae == "LAE", 1, 2))
+    reopen = (df["Open/Closed/Reopen"] == "Reopen").to_numpy()
+    return lae_code * 2 + reopen
+
+
+def build_cube(key, df_paid, df_OS):
+    """
+    Build and persist the cube of an extract unless it already exists.
+
+    Rows without dates or segment cannot be placed in the cube; extracts
+    with such rows get no cube and keep using the row-based path.
+    """
+    if has_cube(key):
+        return True
+
+    sheets = {"Paid": df_paid, "OS": df_OS}
+    codes = {}
+    for sheet, df in sheets.items():
+        if len(df) == 0:
+            return False
+        origin, origin_nat = month_codes(df[ORIGIN_COLUMN])
+        dev, dev_nat = month_codes(df[DEVELOPMENT_COLUMNS[sheet]])
+        if origin_nat.any() or dev_nat.any() or df[SEGMENT_COLUMN].isna().any():
+            return False
+        codes[sheet] = (origin, dev - origin)
+
+    # One set of axes for both sheets, so Paid and OS cells line up
+    segments = sorted(set(df_paid[SEGMENT_COLUMN].unique()) | set(df_OS[SEGMENT_COLUMN].unique()), key=str)
+    origin0 = min(origin.min() for origin, _ in codes.values() if len(origin))
+    lag0 = min(lag.min() for _, lag in codes.values() if len(lag))
+    n_origin = max(origin.max() for origin, _ in codes.values() if len(origin)) - origin0 + 1
+    n_lag = max(lag.max() for _, lag in codes.values() if len(lag)) - lag0 + 1
+    # Plain ints: numpy scalars in the shape would end up in the .npy header
+    shape = (len(segments), N_CLASSES, int(n_origin), int(n_lag))
+
+    folder = _folder(key)
+    tmp_folder = folder + ".tmp"
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    for sheet, df in sheets.items():
+        origin, lag = codes[sheet]
+        segment = pd.Categorical(df[SEGMENT_COLUMN], categories=segments).codes.astype(np.int64)
+        flat = ((segment * N_CLASSES + _row_classes(df)) * n_origin + (origin - origin0)) * n_lag + (lag - lag0)
+        size = int(np.prod(shape))
+
+        counts = np.lib.format.open_memmap(os.path.join(tmp_folder, f"{sheet}-counts.npy"), mode="w+",
+                                           dtype=np.int32, shape=shape)
+        counts.reshape(-1)[:] = np.bincount(flat, minlength=size)
+        counts.flush()
+
+        values = np.lib.format.open_memmap(os.path.join(tmp_folder, f"{sheet}-values.npy"), mode="w+",
+                                           dtype=np.float64, shape=(len(MEASURES),) + shape)
+        measure_columns = {"amount": [AMOUNT_COLUMNS[sheet]], "SS": SS_COLUMNS, "RI": RI_COLUMNS, "EP": [PREMIUM]}
+        for m, measure in enumerate(MEASURES):
+            columns = [c for c in measure_columns[measure] if c in df.columns]
+            weights = sum((np.nan_to_num(df[c].to_numpy(dtype="float64")) for c in columns), np.zeros(len(df)))
+            values[m].reshape(-1)[:] = np.bincount(flat, weights=weights, minlength=size)
+        values.flush()
+        del counts, values
+
+    with open(os.path.join(tmp_folder, "meta.json"), "w") as f:
+        json.dump({"segments": [str(s) for s in segments], "origin0": int(origin0), "lag0": int(lag0)}, f)
+    os.replace(tmp_folder, folder)
+    return True
+
+
+def _open(key, sheet):
+    folder = _folder(key)
+    with open(os.path.join(folder, "meta.json")) as f:
+        meta = json.load(f)
+    counts = np.load(os.path.join(folder, f"{sheet}-counts.npy"), mmap_mode="r")
+    values = np.load(os.path.join(folder, f"{sheet}-values.npy"), mmap_mode="r")
+    return meta, counts, values
+
+
+def cube_covers(key, plan):
+    """
+    True when every dataset of `plan` can be summed from the cube: no
+    large-claim threshold (applied per row), no yearly ALAE dates (moved
+    per row) and, for stacked runs, stacking by Line of Business.
+    """
+    return (
+        has_cube(key)
+        and plan["large_claims"] is None
+        and not plan["alae_yearly_dates"]
+        and plan["index"] in (None, SEGMENT_COLUMN)
+    )
+
+
+def _classes(lae=None, reopen=None):
+    # Boolean mask over the row classes: Claim/LAE codes in `lae` (all when
+    # None) and reopened or not (both when None)
+    mask = np.zeros(N_CLASSES, dtype=bool)
+    for code in range(len(CLAIM_LAE)):
+        for flag in (0, 1):
+            if (lae is None or code in lae) and (reopen is None or flag == reopen):
+                mask[code * 2 + flag] = True
+    return mask
+
+
+def plan_terms(plan, sheet):
+    """
+    The datasets apply_plan would produce for `plan`, as cube terms:
+    {name: {"label", "measure", "sources", "classes", "weights"}} where the
+    dataset's measure is sum(weights[m] * measure m) over its row classes.
+    """
+    amount = AMOUNT_COLUMNS[sheet]
+    lae = [0] if plan["alae_separate"] else None
+    reopen = 0 if plan["reopen_separate"] else None
+    main = _classes(lae, reopen)
+
+    adjusted = {"amount": 1.0}
+    main_sources = [amount]
+    if plan["ss"] == "net":
+        adjusted = {"amount": 1.0, "SS": -1.0}
+        main_sources = main_sources + SS_COLUMNS
+
+    def term(label, classes, measure, sources, weights):
+        return {"label": label, "measure": measure, "sources": sources, "classes": classes, "weights": weights}
+
+    terms = {"filtered_df": term("Net of SS" if plan["ss"] == "net" else "Gross", main, amount, main_sources, adjusted)}
+    if plan["alae_separate"]:
+        terms["alae_df"] = term("ALAE", _classes([1]), amount, [amount], {"amount": 1.0})
+    if plan["reopen_separate"]:
+        terms["reopen_df"] = term("Reopened Claims", _classes(lae, 1), amount, [amount], {"amount": 1.0})
+    if plan["ss"] == "separate":
+        terms["ss_triangle"] = term("SS", main, "SS", SS_COLUMNS, {"SS": 1.0})
+    if plan["ri"] == "separate":
+        terms["ri_triangle"] = term("RI", main, "RI", RI_COLUMNS, {"RI": 1.0})
+    elif plan["ri"] == "net":
+        terms["net_ri_df"] = term("Net of RI", main, amount, main_sources + RI_COLUMNS, dict(adjusted, RI=-1.0))
+    return terms
+
+
+def _picked(segments, segment):
+    # Positions of one segment (none when the cube lacks it), or of all
+    if segment is not None:
+        return [segments.index(str(segment))] if str(segment) in segments else []
+    return list(range(len(segments)))
+
+
+def cube_cells(key, sheet, term, segment=None, index=None):
+    """
+    Triangle cells (as triangles.bin_rows returns them) of one dataset term
+    for one segment, or for every segment stacked under `index`.
+    """
+    meta, counts, values = _open(key, sheet)
+    segments = meta["segments"]
+    picked = _picked(segments, segment)
+
+    classes = np.flatnonzero(term["classes"])
+    counts = counts[picked][:, classes].sum(axis=1)
+    total = np.zeros(counts.shape)
+    for measure, weight in term["weights"].items():
+        total += weight * values[MEASURES.index(measure)][picked][:, classes].sum(axis=1)
+
+    seg, origin, lag = np.nonzero(counts)
+    origin = origin + meta["origin0"]
+    development = DEVELOPMENT_COLUMNS[sheet]
+    cells = {}
+    if index is not None:
+        cells[index] = np.asarray([segments[picked[s]] for s in seg], dtype=object)
+    cells[ORIGIN_COLUMN] = origin.astype("datetime64[M]").astype("datetime64[ns]")
+    cells[development] = (origin + lag + meta["lag0"]).astype("datetime64[M]").astype("datetime64[ns]")
+    cells[term["measure"]] = total[seg, origin - meta["origin0"], lag]
+    return pd.DataFrame(cells)
+
+
+def cube_rows(key, sheet, term, segment=None):
+    """
+    Number of rows of one dataset term, for one segment or for all.
+    """
+    meta, counts, _ = _open(key, sheet)
+    picked = _picked(meta["segments"], segment)
+    return int(counts[picked][:, np.flatnonzero(term["classes"])].sum())
+
+
+def cube_catalog(config_key, key, plan):
+    """
+    Dataset catalog (see triangles.build_catalog) whose triangles are read
+    from the cube instead of the rows. Same keys as the row-based catalog,
+    and likewise without the datasets that have no Paid rows.
+    """
+    catalog = {}
+    os_terms = plan_terms(plan, "OS")
+    cells = lambda sheet, term: cube_cells(key, sheet, term, plan["segment"], plan["index"])
+    for name, term in plan_terms(plan, "Paid").items():
+        if not cube_rows(key, "Paid", term, plan["segment"]):
+            continue
+        spec_key = fingerprint(config_key, name)
+        entry = {
+            "name": name,
+            "label": term["label"],
+            "measure": term["measure"],
+            "sources": term["sources"],
+            "development": {"Paid": DEVELOPMENT_COLUMNS["Paid"], "OS": DEVELOPMENT_COLUMNS["OS"]},
+        }
+        # Earned Premiums of the dataset's Paid rows
+        premium = dict(term, measure=PREMIUM, weights={"EP": 1.0})
+        for side, sheet, sheet_term, suffix in (("paid", "Paid", term, "Paid"), ("os", "OS", os_terms[name], "OS"),
+                                                ("premium", "Paid", premium, "EP")):
+            if side == "os" and not cube_rows(key, "OS", sheet_term, plan["segment"]):
+                entry[side] = None
+                continue
+            entry[side] = dataset_spec(
+                spec_key + "-" + suffix,
+                lambda sheet=sheet, sheet_term=sheet_term: cells(sheet, sheet_term),
+                DEVELOPMENT_COLUMNS[sheet], sheet_term["measure"], plan["index"],
+            )
+        catalog[name] = entry
+    return catalog
+
+
+def cube_segments(key):
+    with open(os.path.join(_folder(key), "meta.json")) as f:
+        return json.load(f)["segments"]
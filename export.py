@@ -0,0 +1,196 @@
+import os
+import re
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+from triangles import PAID, OS, INCURRED, PREMIUM, fused_view, fused_link_ratio_view, ldf_grid_view, segment_frame
+
+
+# Exports are written to disk as they are built, one (segment, column)
+# slice at a time: the xlsx through openpyxl's write-only (row-streaming)
+# workbook, the Parquet file through a ParquetWriter in row groups. Only
+# one dataset's views are held at a time, in a cache of their own, so an
+# export neither grows nor shares the session's triangle cache.
+EXPORT_DIR = os.path.join(".cache", "exports")
+ROW_GROUP_ROWS = 65_536
+
+# Excel number formats matching the app's display (AMOUNT_FORMAT, 4 decimals)
+AMOUNT_NUMBER_FORMAT = "#,##0_);(#,##0)"
+RATIO_NUMBER_FORMAT = "0.0000_);(0.0000)"
+
+# Long format: one row per non-empty cell. Triangles fill Origin, LDF
+# tables Method and Periods; Development is the development period or link
+PARQUET_SCHEMA = pa.schema([
+    ("Dataset", pa.string()),
+    ("Table", pa.string()),
+    ("Column", pa.string()),
+    ("Segment", pa.string()),
+    ("Origin", pa.string()),
+    ("Method", pa.string()),
+    ("Periods", pa.string()),
+    ("Development", pa.string()),
+    ("Value", pa.float64()),
+])
+
+
+def export_bytes(write, tables, suffix):
+    """
+    Contents of an export written by `write` (write_workbook or
+    write_parquet) to a temporary file under EXPORT_DIR, which is removed
+    again: the tables are streamed to disk, only the finished file is read.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=EXPORT_DIR)
+    os.close(fd)
+    try:
+        write(path, tables)
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+def export_tables(catalog, grain, with_incurred=True, with_premiums=False):
+    """
+    Every table Steps 3-5 show for a catalog, one dataset after the other:
+    yields (dataset label, table, column, segment, frame), the frame being
+    one segment's origin x development triangle or its LDFs by method and
+    periods. OS and Incurred come with with_incurred (and an OS side),
+    Earned Premiums with with_premiums (and premiums).
+    """
+    for entry in catalog.values():
+        cache = {}
+        incremental = fused_view(cache, entry, grain)
+        cumulative = fused_view(cache, entry, grain, cumulative=True)
+        link_ratios = fused_link_ratio_view(cache, entry, grain)
+        grid = ldf_grid_view(cache, entry, grain)
+
+        columns = [PAID]
+        if with_incurred and OS in incremental.columns:
+            columns += [OS, INCURRED]
+        development = [column for column in columns if column != OS]
+        premiums = [PREMIUM] if with_premiums and PREMIUM in cumulative.columns else []
+
+        tables = [
+            ("Incremental", incremental, columns),
+            ("Cumulative", cumulative, columns + premiums),
+            ("Link ratios", link_ratios, development),
+        ]
+        segments = incremental.index.iloc[:, 0].tolist()
+        for table, tri, names in tables:
+            for column in names:
+                for segment in segments:
+                    frame = segment_frame(tri[column], segment if len(segments) > 1 else None)
+                    frame.index.name = "Origin"
+                    yield entry["label"], table, column, segment, frame
+
+        for column in development:
+            rows = grid.xs(column, level="Column")
+            for segment in segments:
+                yield entry["label"], "LDFs", column, segment, rows.xs(segment, level=0)
+
+
+def _sheet_title(label, table, used):
+    # Excel sheet names: at most 31 characters, none of []:*?/\ , unique
+    title = re.sub(r"[\[\]:*?/\\]", "_", f"{label} {table}")[:31]
+    base, n = title, 1
+    while title.lower() in used:
+        n += 1
+        title = f"{base[:31 - len(str(n)) - 1]}~{n}"
+    used.add(title.lower())
+    return title
+
+
+def _xlsx_rows(sheet, column, segment, frame, number_format):
+    bold = Font(bold=True)
+
+    def cell(value, font=None, fmt=None):
+        c = WriteOnlyCell(sheet, value=value)
+        if font is not None:
+            c.font = font
+        if fmt is not None:
+            c.number_format = fmt
+        return c
+
+    yield [cell(f"{column} - {segment}", bold)]
+    yield [cell(name, bold) for name in frame.index.names] + [cell(str(d), bold) for d in frame.columns]
+    values = frame.to_numpy(dtype="float64")
+    for labels, row in zip(frame.index, values):
+        labels = labels if isinstance(labels, tuple) else (labels,)
+        # Empty cells stay empty rather than NaN
+        yield [str(label) for label in labels] + [
+            None if np.isnan(v) else cell(float(v), fmt=number_format) for v in row
+        ]
+    yield []
+
+
+def _parquet_table(label, table, column, segment, frame):
+    values = frame.to_numpy(dtype="float64")
+    present = ~np.isnan(values)
+    rows, cols = np.nonzero(present)
+    n = rows.size
+
+    def repeat(value):
+        return pa.array([value] * n, pa.string()) if value is not None else pa.nulls(n, pa.string())
+
+    labels = frame.index.to_frame(index=False).astype(str).to_numpy()
+    if table == "LDFs":
+        origin, method, periods = None, labels[rows, 0], labels[rows, 1]
+    else:
+        origin, method, periods = labels[rows, 0], None, None
+    development = np.asarray([str(d) for d in frame.columns], dtype=object)[cols]
+    return pa.table([
+        repeat(label), repeat(table), repeat(column), repeat(str(segment)),
+        pa.array(origin, pa.string()) if origin is not None else repeat(None),
+        pa.array(method, pa.string()) if method is not None else repeat(None),
+        pa.array(periods, pa.string()) if periods is not None else repeat(None),
+        pa.array(development, pa.string()),
+        pa.array(values[present], pa.float64()),
+    ], schema=PARQUET_SCHEMA)
+
+
+def write_workbook(path, tables):
+    """
+    Stream export_tables into an xlsx workbook: one sheet per dataset and
+    table, one block per column and segment (title, header, rows), cells
+    numeric with amount or ratio number formats. Returns the path.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    wb = Workbook(write_only=True)
+    sheets, used = {}, set()
+    for label, table, column, segment, frame in tables:
+        if (label, table) not in sheets:
+            sheets[(label, table)] = wb.create_sheet(_sheet_title(label, table, used))
+        sheet = sheets[(label, table)]
+        number_format = AMOUNT_NUMBER_FORMAT if table in ("Incremental", "Cumulative") else RATIO_NUMBER_FORMAT
+        for row in _xlsx_rows(sheet, column, segment, frame, number_format):
+            sheet.append(row)
+    if not sheets:
+        wb.create_sheet("Empty")
+    wb.save(path)
+    return path
+
+
+def write_parquet(path, tables):
+    """
+    Stream export_tables into a long-format Parquet file (PARQUET_SCHEMA),
+    buffering about ROW_GROUP_ROWS rows per row group. Returns the path.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    pending, rows = [], 0
+    with pq.ParquetWriter(path, PARQUET_SCHEMA) as writer:
+        for args in tables:
+            pending.append(_parquet_table(*args))
+            rows += pending[-1].num_rows
+            if rows >= ROW_GROUP_ROWS:
+                writer.write_table(pa.concat_tables(pending), row_group_size=ROW_GROUP_ROWS)
+                pending, rows = [], 0
+        if pending:
+            writer.write_table(pa.concat_tables(pending), row_group_size=ROW_GROUP_ROWS)
+    return path
@@ -0,0 +1,449 @@
+import hashlib
+import io
+import os
+import posixpath
+import shutil
+import zipfile
+from urllib.parse import unquote
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from profiling import cache_event, stage
+
+
+# Parsed extracts are kept on local disk, one folder per distinct file content
+CACHE_DIR = os.path.join(".cache", "ingest")
+CACHE_VERSION = 4   # bump whenever the cached column layout changes
+
+PAID_SHEET = 0      # the Paid data is always the first sheet
+OS_SHEET = "OS"
+
+# Only these columns of the ~29 in a claims extract are used by the app
+COMMON_COLUMNS = [
+    "Data Source Qtr",
+    "Line of Business",
+    "Reserving Segment",
+    "IFRS17 GOC",
+    "Accident/Treatment Date",
+    "Open/Closed/Reopen",
+    "RI Proportional",
+    "RI Non Proportional",
+    "Recoveries",
+    "Subrogation (Individual)",
+    "Subrogation (Company)",
+    "Claim/LAE",
+    "Earned Premiums",
+]
+PAID_COLUMNS = COMMON_COLUMNS + ["Gross Claim Amount Paid as at", "Payment Date"]
+OS_COLUMNS = COMMON_COLUMNS + ["Gross Claim Amount OS as at", "Reporting Date"]
+
+# Loading schema. Dates become datetime64 once, here, so the date helpers
+# never re-parse them. Text fields become categoricals: a few distinct
+# values held once, with integer codes per row, so segment and Claim/LAE
+# filters compare codes. IDs (not projected by the app, but typed the same
+# way if they are) are integer-coded likewise.
+DATE_COLUMNS = {"Accident/Treatment Date", "Payment Date", "Reporting Date"}
+TEXT_COLUMNS = {"Data Source Qtr", "Line of Business", "Reserving Segment", "IFRS17 GOC",
+                "Product", "Coverage", "Open/Closed/Reopen", "Claim/LAE"}
+ID_COLUMNS = {"Unique Claim ID", "Unique Policy ID", "Unique Event ID"}
+
+# Amounts are float64 unless TRIANGLES_AMOUNT_DTYPE=float32, which halves
+# them at the cost of ~7 significant digits per row
+AMOUNT_DTYPE = os.environ.get("TRIANGLES_AMOUNT_DTYPE", "float64")
+
+# Loaded data is also kept as a dataset partitioned by these columns, so a
+# segment can be read without touching the rest of the book
+STORE_DIR = os.path.join(".cache", "store")
+PARTITION_COLUMNS = ["Line of Business", "Data Source Qtr"]
+
+CHUNK_ROWS = 50_000     # rows per typed chunk while streaming a sheet
+
+_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_DOC_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+
+def content_key(raw: bytes) -> str:
+    """
+    Return a short hex digest identifying the contents of an uploaded file.
+    Two uploads of the same extract always get the same key.
+    """
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+
+# ---- STREAMING XLSX READER ----
+
+def _column_index(ref):
+    """
+    Zero-based column number of a cell reference, e.g. "A7" -> 0, "AB12" -> 27.
+    """
+    n = 0
+    for ch in ref:
+        if ch.isdigit():
+            break
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+
+def _sheet_paths(zf):
+    """
+    Map every sheet name, in workbook order, to its XML part in the archive.
+    """
+    workbook = ET.fromstring(zf.read("xl/workbook.xml"))
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    targets = {r.get("Id"): r.get("Target") for r in rels.iter(f"{{{_PKG_REL_NS}}}Relationship")}
+
+    paths = {}
+    for sheet in workbook.iter(f"{{{_MAIN_NS}}}sheet"):
+        target = targets[sheet.get(f"{{{_DOC_REL_NS}}}id")]
+        # Targets are either absolute ("/xl/worksheets/sheet1.xml") or relative to xl/
+        if target.startswith("/"):
+            paths[sheet.get("name")] = target.lstrip("/")
+        else:
+            paths[sheet.get("name")] = posixpath.normpath(posixpath.join("xl", target))
+    return paths
+
+
+def _shared_strings(zf):
+    """
+    Read the shared string table (empty for workbooks using inline strings).
+    """
+    if "xl/sharedStrings.xml" not in zf.namelist():
+        return []
+
+    strings = []
+    si_tag, t_tag, rph_tag = f"{{{_MAIN_NS}}}si", f"{{{_MAIN_NS}}}t", f"{{{_MAIN_NS}}}rPh"
+    with zf.open("xl/sharedStrings.xml") as stream:
+        for _, elem in ET.iterparse(stream):
+            if elem.tag == si_tag:
+                # Text of the string and its runs; phonetic hints are not part of it
+                strings.append("".join(t.text or "" for child in elem if child.tag != rph_tag
+                                       for t in child.iter(t_tag)))
+                elem.clear()
+    return strings
+
+
+def _decode_cell(cell_type, text, shared_strings):
+    if text == "":
+        return None
+    if cell_type in ("inlineStr", "str"):
+        return text
+    if cell_type == "s":
+        return shared_strings[int(text)]
+    if cell_type == "b":
+        return text == "1"
+    if cell_type == "e":
+        return None
+    return float(text)
+
+
+def iter_sheet_rows(zf, path, shared_strings, wanted=None, block_size=1 << 20):
+    """
+    Stream a worksheet row by row with an expat (SAX) parser.
+
+    Yields one dict per row mapping zero-based column number -> value. Only
+    columns in `wanted` (a set of column numbers) are decoded; text of every
+    other cell is ignored as it streams past. None decodes every column.
+    No element tree is built, so memory does not grow with the sheet.
+    """
+    rows = []
+    state = {"row": None, "col": -1, "type": None, "keep": False, "collect": False, "in_rph": False, "text": []}
+
+    def start(name, attrs):
+        tag = name.rpartition("|")[2]
+        if tag == "c":
+            ref = attrs.get("r")
+            state["col"] = _column_index(ref) if ref else state["col"] + 1
+            state["keep"] = wanted is None or state["col"] in wanted
+            state["type"] = attrs.get("t", "n")
+            state["text"] = []
+        elif tag in ("v", "t"):
+            state["collect"] = state["keep"] and not state["in_rph"]
+        elif tag == "row":
+            state["row"] = {}
+            state["col"] = -1
+        elif tag == "rPh":
+            # phonetic hints inside inline strings are not part of the value
+            state["in_rph"] = True
+
+    def end(name):
+        tag = name.rpartition("|")[2]
+        if tag in ("v", "t"):
+            state["collect"] = False
+        elif tag == "rPh":
+            state["in_rph"] = False
+        elif tag == "c":
+            if state["keep"]:
+                state["row"][state["col"]] = _decode_cell(state["type"], "".join(state["text"]), shared_strings)
+            state["keep"] = False
+        elif tag == "row":
+            rows.append(state["row"])
+
+    def chars(data):
+        if state["collect"]:
+            state["text"].append(data)
+
+    parser = expat.ParserCreate(namespace_separator="|")
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = chars
+
+    with zf.open(path) as stream:
+        while True:
+            block = stream.read(block_size)
+            parser.Parse(block, not block)
+            yield from rows
+            rows.clear()
+            if not block:
+                break
+
+
+def _typed_column(name, values):
+    """
+    Convert the raw values streamed for one column into a typed Series.
+    Dates arrive as Excel serial numbers and are converted in one go.
+    """
+    raw = pd.Series(values, dtype="object")
+    if name in TEXT_COLUMNS or name in ID_COLUMNS:
+        return raw.astype("category")
+
+    numbers = pd.to_numeric(raw, errors="coerce")
+    if name in DATE_COLUMNS:
+        if numbers.isna().sum() > raw.isna().sum():
+            # Dates stored as text rather than serial numbers
+            return pd.to_datetime(raw)
+        return pd.to_datetime(numbers, unit="D", origin="1899-12-30")
+    return numbers.astype(AMOUNT_DTYPE)
+
+
+def apply_schema(df):
+    """
+    Type the known columns of a DataFrame read by other means (legacy
+    .xls through pandas) the same way as the streaming reader.
+    """
+    for name in df.columns:
+        if name in TEXT_COLUMNS or name in ID_COLUMNS:
+            df[name] = df[name].astype("category")
+        elif name in DATE_COLUMNS:
+            df[name] = pd.to_datetime(df[name])
+        else:
+            df[name] = pd.to_numeric(df[name], errors="coerce").astype(AMOUNT_DTYPE)
+    return df
+
+
+def _concat_chunks(chunks):
+    # Chunks see different category sets; union them so columns stay
+    # categorical instead of falling back to object
+    columns = {}
+    for name in chunks[0].columns:
+        parts = [chunk[name] for chunk in chunks]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            columns[name] = pd.Series(union_categoricals(parts, ignore_order=True))
+        else:
+            columns[name] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+def read_sheet(zf, path, shared_strings, columns, chunk_rows=CHUNK_ROWS):
+    """
+    Read the projected `columns` of one worksheet into a DataFrame.
+
+    The first row is the header. Rows are streamed and collected into typed
+    chunks of `chunk_rows` rows, which are concatenated at the end, so peak
+    memory follows the projected columns rather than the full sheet.
+    """
+    header_row = next(iter_sheet_rows(zf, path, shared_strings), {})
+    header = {value: col for col, value in header_row.items() if value is not None}
+    projected = [(name, header[name]) for name in columns if name in header]
+    wanted = {col for _, col in projected}
+
+    chunks = []
+    buffers = {name: [] for name, _ in projected}
+
+    def flush():
+        if buffers and len(next(iter(buffers.values()))):
+            chunks.append(pd.DataFrame({name: _typed_column(name, values) for name, values in buffers.items()}))
+            for values in buffers.values():
+                values.clear()
+
+    rows = iter_sheet_rows(zf, path, shared_strings, wanted)
+    next(rows, None)  # header
+    n = 0
+    for row in rows:
+        for name, col in projected:
+            buffers[name].append(row.get(col))
+        n += 1
+        if n % chunk_rows == 0:
+            flush()
+    flush()
+
+    if not chunks:
+        return pd.DataFrame({name: pd.Series(dtype="object") for name, _ in projected})
+    return _concat_chunks(chunks)
+
+
+def read_workbook(raw: bytes):
+    """
+    Parse the projected columns of the Paid (first) and OS sheets.
+
+    .xlsx/.xlsm files go through the streaming reader above; legacy .xls
+    files fall back to pandas, opened once for both sheets.
+
+    Returns (df_paid, df_OS).
+    """
+    if not zipfile.is_zipfile(io.BytesIO(raw)):
+        wanted = set(PAID_COLUMNS) | set(OS_COLUMNS)
+        sheets = pd.read_excel(io.BytesIO(raw), sheet_name=[PAID_SHEET, OS_SHEET], usecols=lambda c: c in wanted)
+        return apply_schema(sheets[PAID_SHEET]), apply_schema(sheets[OS_SHEET])
+
+    with zipfile.ZipFile(io.BytesIO(raw)) as zf:
+        paths = _sheet_paths(zf)
+        if OS_SHEET not in paths:
+            raise ValueError(f"Workbook has no '{OS_SHEET}' sheet")
+        shared_strings = _shared_strings(zf)
+        df_paid = read_sheet(zf, list(paths.values())[PAID_SHEET], shared_strings, PAID_COLUMNS)
+        df_OS = read_sheet(zf, paths[OS_SHEET], shared_strings, OS_COLUMNS)
+    return df_paid, df_OS
+
+
+def _cache_paths(key):
+    folder = os.path.join(CACHE_DIR, f"{key}-v{CACHE_VERSION}-{AMOUNT_DTYPE}")
+    return folder, os.path.join(folder, "Paid.parquet"), os.path.join(folder, "OS.parquet")
+
+
+def _write_parquet(df, path):
+    # Write to a temporary name first so a half-written file is never picked up
+    tmp_path = path + ".tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def load_workbook(raw: bytes):
+    """
+    Load the Paid and OS sheets of a workbook, using the on-disk Parquet
+    cache when this exact file has been loaded before.
+
+    Returns (df_paid, df_OS, key) where key identifies the file contents.
+    """
+    key = content_key(raw)
+    folder, paid_path, os_path = _cache_paths(key)
+
+    if os.path.exists(paid_path) and os.path.exists(os_path):
+        cache_event("ingest", hit=True)
+        return pd.read_parquet(paid_path), pd.read_parquet(os_path), key
+
+    cache_event("ingest", hit=False)
+    with stage("parse workbook"):
+        df_paid, df_OS = read_workbook(raw)
+
+    try:
+        os.makedirs(folder, exist_ok=True)
+        _write_parquet(df_paid, paid_path)
+        _write_parquet(df_OS, os_path)
+    except (OSError, ValueError, TypeError, NotImplementedError):
+        # Caching is best effort: columns Arrow cannot store (e.g. mixed
+        # types) just mean this extract is parsed again next time
+        pass
+
+    return df_paid, df_OS, key
+
+
+def load_path(path):
+    """
+    Load a workbook from a path on disk through the same cache.
+
+    Returns (df_paid, df_OS, key).
+    """
+    with open(path, "rb") as f:
+        return load_workbook(f.read())
+
+
+# ---- PARTITIONED STORE ----
+
+def _store_path(key, sheet):
+    return os.path.join(STORE_DIR, f"{key}-v{CACHE_VERSION}-{AMOUNT_DTYPE}", sheet)
+
+
+def has_store(key):
+    """
+    True if both sheets of the extract identified by `key` are in the store.
+    """
+    return key is not None and all(os.path.isdir(_store_path(key, sheet)) for sheet in ("Paid", "OS"))
+
+
+def write_store(key, df_paid, df_OS):
+    """
+    Persist both sheets as Parquet datasets partitioned by Line of Business
+    and Data Source Qtr. Sheets already in the store are left untouched.
+    """
+    for sheet, df in (("Paid", df_paid), ("OS", df_OS)):
+        path = _store_path(key, sheet)
+        if os.path.isdir(path):
+            continue
+
+        partition_cols = [c for c in PARTITION_COLUMNS if c in df.columns]
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            df.to_parquet(tmp_path, partition_cols=partition_cols, index=False)
+            os.replace(tmp_path, path)
+        except (OSError, ValueError, TypeError, NotImplementedError):
+            # Best effort, like the ingest cache: without a store the app
+            # falls back to filtering the DataFrames in memory
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def list_segments(key):
+    """
+    Line of Business values in the store, read from the partition folder
+    names rather than from the data.
+    """
+    prefix = PARTITION_COLUMNS[0] + "="
+    names = sorted(os.listdir(_store_path(key, "Paid")))
+    return [unquote(name[len(prefix):]) for name in names if name.startswith(prefix)]
+
+
+def apply_filters(df, filters):
+    """
+    Apply pyarrow-style filters, e.g. [("Claim/LAE", "==", "LAE")], to a
+    DataFrame in memory. Supports "==", "!=", "in" and "not in".
+    """
+    if not filters:
+        return df
+
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters or []:
+        if op == "==":
+            mask &= df[column] == value
+        elif op == "!=":
+            mask &= df[column] != value
+        elif op == "in":
+            mask &= df[column].isin(value)
+        elif op == "not in":
+            mask &= ~df[column].isin(value)
+        else:
+            raise ValueError(f"Unsupported filter operator: {op}")
+    return df[mask]
+
+
+def read_segment(key, sheet, segment, filters=None):
+    """
+    Read the rows of one Line of Business from the store.
+
+    Only the files of that segment's partitions are opened, and `filters`
+    (pyarrow-style, see apply_filters) are pushed down into the scan so
+    rows that fail them are never materialised.
+    """
+    pushed = [(PARTITION_COLUMNS[0], "==", segment)] + list(filters or [])
+    df = pd.read_parquet(_store_path(key, sheet), filters=pushed)
+
+    # Partition columns come back as categoricals over every partition
+    # value; keep only the categories present, like the loaded columns
+    for column in PARTITION_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category").cat.remove_unused_categories()
+    return df
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+
+# Averaging methods as chainladder's Development fits them: a regression
+# through the origin with weights x^-k, so that each LDF is
+#   sum(x^(1-k) * y) / sum(x^(2-k))
+# over the link ratios y/x of a development column (x, y both non-zero).
+METHODS = {"simple": 2, "volume": 1, "regression": 0}
+
+ALL_PERIODS = "All"
+
+
+def _dense_values(tri):
+    values = tri.values
+    if not isinstance(values, np.ndarray):
+        values = values.todense()   # sparse backend
+    return np.asarray(values, dtype="float64")
+
+
+def ldf_sums(values):
+    """
+    Numerators and denominators of every method's LDF for every averaging
+    window, from one pass over the link ratios of a cumulative
+    (index, column, origin, development) array.
+
+    Each link ratio is binned by how many diagonals before the latest one
+    its y lies on, so the sums over the latest n diagonals, for every n,
+    are one cumulative sum along that axis. Returns (num, den) of shape
+    (method, index, column, development - 1, windows); window w covers
+    the latest w + 1 diagonals and the last one covers them all.
+    """
+    n_index, n_columns, n_origin, n_dev = values.shape
+    x, y = values[..., :-1], values[..., 1:]
+    valid = np.isfinite(x) & np.isfinite(y) & (x != 0) & (y != 0)
+
+    # Diagonal of each y, counted back from the latest observed diagonal
+    observed = (np.isfinite(values) & (values != 0)).any(axis=(0, 1))
+    diagonal = np.arange(n_origin)[:, None] + np.arange(n_dev)[None, :]
+    latest = diagonal[observed].max() if observed.any() else 0
+    age = np.broadcast_to(latest - diagonal[:, 1:], valid.shape)
+
+    n_windows = int(age[valid].max()) + 1 if valid.any() else 1
+    cell = np.broadcast_to(np.arange(n_index * n_columns).reshape(n_index, n_columns, 1, 1), valid.shape)
+    column = np.broadcast_to(np.arange(n_dev - 1), valid.shape)
+    flat = ((cell[valid] * (n_dev - 1)) + column[valid]) * n_windows + age[valid]
+    size = n_index * n_columns * (n_dev - 1) * n_windows
+    x, y = x[valid], y[valid]
+
+    shape = (n_index, n_columns, n_dev - 1, n_windows)
+    num = np.empty((len(METHODS),) + shape)
+    den = np.empty((len(METHODS),) + shape)
+    for m, k in enumerate(METHODS.values()):
+        num[m] = np.bincount(flat, weights=x ** (1 - k) * y, minlength=size).reshape(shape)
+        den[m] = np.bincount(flat, weights=x ** (2 - k), minlength=size).reshape(shape)
+    return np.cumsum(num, axis=-1), np.cumsum(den, axis=-1)
+
+
+def ldf_grid(tri):
+    """
+    LDFs of a cumulative triangle for every averaging method and every
+    window of the latest 1..N diagonals (N being "All"), in one table:
+    rows (index, column, method, periods), one column per development
+    link ("1-2", "2-3", ...).
+
+    With all periods the LDFs equal cl.Development(average=...).ldf_;
+    a window of n periods matches its n_periods=n. Windows count
+    diagonals of the triangle itself, so they match only when origin and
+    development share a grain (OYDY, OQDQ, OMDM, as the app builds them).
+    """
+    num, den = ldf_sums(_dense_values(tri))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ldf = np.where(den != 0, num / den, np.nan)
+
+    n_windows = ldf.shape[-1]
+    # Labels are strings throughout ("1", "2", ..., "All") so the level has one type
+    periods = [str(n) for n in range(1, n_windows)] + [ALL_PERIODS]
+    development = [str(d) for d in tri.development]
+    links = [f"{a}-{b}" for a, b in zip(development[:-1], development[1:])]
+    index_labels = tri.index.iloc[:, 0].tolist()
+
+    rows = pd.MultiIndex.from_product(
+        [index_labels, list(tri.columns), list(METHODS), periods],
+        names=[tri.key_labels[0], "Column", "Method", "Periods"],
+    )
+    # (method, index, column, link, window) -> rows (index, column, method, window) x link
+    table = ldf.transpose(1, 2, 0, 4, 3).reshape(len(rows), len(links))
+    return pd.DataFrame(table, index=rows, columns=links)
@@ -0,0 +1,77 @@
+import os
+import weakref
+
+import numpy as np
+import pandas as pd
+
+
+# Default per-session budget for loaded data plus derived objects, in MB.
+# Set TRIANGLES_MEMORY_BUDGET_MB to change it for the whole server.
+MEMORY_BUDGET_MB = int(os.environ.get("TRIANGLES_MEMORY_BUDGET_MB", 1024))
+
+MB = 1 << 20
+
+# Deep DataFrame sizes scan every string, so they are remembered per frame
+# (frames are never modified in place once loaded or prepared)
+_frame_sizes = {}
+
+
+def nbytes(obj):
+    """
+    Approximate memory held by an object: DataFrames (including string
+    contents), arrays, triangles (dense or sparse values) and dicts/lists
+    of them. Anything else counts as 0.
+    """
+    if obj is None:
+        return 0
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return _frame_nbytes(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, "values") and hasattr(obj, "to_frame") and hasattr(obj, "development"):
+        # chainladder Triangle; sparse.COO values report nbytes too
+        return int(getattr(obj.values, "nbytes", 0))
+    if isinstance(obj, dict):
+        return sum(nbytes(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(value) for value in obj)
+    return 0
+
+
+def _frame_nbytes(df):
+    known = _frame_sizes.get(id(df))
+    if known is not None and known[0]() is df:
+        return known[1]
+
+    usage = df.memory_usage(deep=True)
+    size = int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+    key = id(df)
+    _frame_sizes[key] = (weakref.ref(df, lambda _: _frame_sizes.pop(key, None)), size)
+    return size
+
+
+def evict_lru(cache, max_bytes):
+    """
+    Drop least recently used entries of an OrderedDict cache (see
+    triangles.cached) until it holds at most `max_bytes`. Evicted entries
+    are rebuilt on their next use. Returns the number evicted.
+    """
+    sizes = {key: nbytes(value) for key, value in cache.items()}
+    total = sum(sizes.values())
+    evicted = 0
+    while cache and total > max_bytes:
+        key, _ = cache.popitem(last=False)
+        total -= sizes[key]
+        evicted += 1
+    return evicted
+
+
+def usage_table(items):
+    """
+    Memory accounting view: {name: object} -> DataFrame of MB per item,
+    largest first, with a total row.
+    """
+    rows = [(name, nbytes(obj) / MB) for name, obj in items.items()]
+    table = pd.DataFrame(rows, columns=["Object", "MB"]).sort_values("MB", ascending=False)
+    total = pd.DataFrame([("Total", table["MB"].sum())], columns=["Object", "MB"])
+    return pd.concat([table, total], ignore_index=True).set_index("Object")
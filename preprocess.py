@@ -0,0 +1,241 @@
+import numpy as np
+import pandas as pd
+
+
+AMOUNT_COLUMNS = {"Paid": "Gross Claim Amount Paid as at", "OS": "Gross Claim Amount OS as at"}
+DEVELOPMENT_COLUMNS = {"Paid": "Payment Date", "OS": "Reporting Date"}
+SS_COLUMNS = ["Recoveries", "Subrogation (Individual)", "Subrogation (Company)"]
+RI_COLUMNS = ["RI Proportional", "RI Non Proportional"]
+
+# Step 2 answers the preprocessing depends on
+PLAN_ANSWERS = ["q0", "batch_index", "q2", "q3", "ss_choice3", "q4", "threshold", "ss_choice4",
+                "q5", "ss_choice5", "q7", "ss_choice7", "q11"]
+
+# q0 choice that analyses every segment at once, stacked along the triangle
+# index by one of SEGMENT_COLUMNS
+ALL_SEGMENTS = "All segments"
+SEGMENT_COLUMNS = ["Line of Business", "Reserving Segment", "IFRS17 GOC"]
+
+
+# ---- DATE HELPERS ----
+
+def _as_datetime(x):
+    # Loaded date columns are already datetime64 (see ingest.py); only
+    # anything else gets parsed
+    if isinstance(x, pd.Series) and pd.api.types.is_datetime64_any_dtype(x):
+        return x
+    return pd.to_datetime(x)
+
+
+def to_month_start(x):
+    """
+    Convert a date or collection of dates to the first day of the month.
+    Works on scalars, lists, Series, and DataFrame columns.
+    """
+    return _as_datetime(x).dt.to_period("M").dt.to_timestamp()
+
+
+def map_year_min_to_jan1(date_series: pd.Series) -> pd.Series:
+    """
+    For each year in the datetime series:
+      - Find the minimum date
+      - Replace it with January 1st of that year
+    """
+    # Ensure datetime
+    ds = _as_datetime(date_series)
+
+    # Find min date per year
+    min_dates = ds.groupby(ds.dt.year).transform('max')
+
+    # Construct January 1st for each year
+    jan1 = pd.to_datetime(ds.dt.year.astype(str) + "-12-31")
+
+    # Replace only the min date in each year
+    return ds.where(ds != min_dates, jan1)
+
+
+def adjust_year_max_to_dec15(date_series: pd.Series) -> pd.Series:
+    """
+    For each year in the datetime series:
+      - Find the maximum date for that year
+      - Replace it with Dec 15 of that same year
+    Returns a new Series with adjusted dates.
+    """
+    # Ensure datetime
+    ds = _as_datetime(date_series)
+
+    # Get max date per year
+    max_dates = ds.groupby(ds.dt.year).transform('max')
+
+    # Compute the replacement Dec 15 date for each entry
+    dec15 = pd.to_datetime(ds.dt.year.astype(str) + "-12-15")
+
+    # Replace only where date == max date in the year
+    return ds.where(ds != max_dates, dec15)
+
+
+def adjust_quarter_max_to_15th(date_series: pd.Series) -> pd.Series:
+    ds = _as_datetime(date_series)
+    quarters = ds.dt.to_period('Q')
+    max_dates = ds.groupby(quarters).transform('max')
+    quarter_start = quarters.dt.end_time
+    quarter_15th = quarter_start
+    return ds.where(ds != max_dates, quarter_15th)
+
+
+# ---- PREPROCESSING PLAN ----
+
+def compile_plan(answers):
+    """
+    Compile the Step 2 answers (anything with .get, e.g. st.session_state)
+    into a plan: a flat dict of the switches apply_plan needs.
+    """
+    q = {name: answers.get(name) for name in PLAN_ANSWERS}
+    alae_separate = q["q7"] == "Yes" and q["ss_choice7"] == "Separate"
+
+    large_claims = None
+    if q["q4"] == "Yes":
+        large_claims = {"Cap Claims": "cap", "Exclude Claims": "exclude"}.get(q["ss_choice4"])
+
+    ss = None
+    if q["q3"] == "Yes":
+        ss = {"Gross and SS separately": "separate", "Net of SS": "net"}.get(q["ss_choice3"])
+
+    all_segments = q["q0"] == ALL_SEGMENTS
+
+    return {
+        "segment": None if all_segments else q["q0"],
+        "index": (q["batch_index"] or SEGMENT_COLUMNS[0]) if all_segments else None,
+        "alae_separate": alae_separate,
+        "alae_yearly_dates": alae_separate and q["q11"] == "Yearly",
+        "reopen_separate": q["q5"] == "Yes" and q["ss_choice5"] == "Calculate IBNR separately",
+        "large_claims": large_claims,
+        "threshold": float(q["threshold"] or 0),
+        "ss": ss,
+        "ri": {"Gross + RI": "separate", "Gross + Net": "net"}.get(q["q2"]),
+    }
+
+
+def _dataset(label, rows, measure, sources, overlay=None):
+    # `sources` are the input columns the dataset's measure is computed from
+    return {"label": label, "rows": np.flatnonzero(rows), "measure": measure, "sources": sources,
+            "overlay": overlay or {}}
+
+
+def apply_plan(plan, df, sheet):
+    """
+    Evaluate a plan over one sheet ('Paid' or 'OS') of a segment's rows
+    (or of the whole sheet when the plan stacks all segments).
+
+    All masks and derived columns are computed in a single vectorized pass.
+    `df` itself is never copied or modified: each dataset (Gross / Net of
+    SS, ALAE, Reopened Claims, Large Claims, SS, RI, Net of RI) is returned
+    as an array of row positions into `df` plus an overlay naming the
+    derived columns that replace or add to the original ones. Use
+    materialize() to turn one of them into a DataFrame.
+    """
+    amount = AMOUNT_COLUMNS[sheet]
+    development = DEVELOPMENT_COLUMNS[sheet]
+    n = len(df)
+
+    raw = df[amount].to_numpy(dtype="float64")
+    main = np.ones(n, dtype=bool)
+    columns = {}
+    datasets = {}
+    main_overlay = {}
+    main_sources = [amount]
+
+    # 7 (ALAE)
+    alae = None
+    if plan["alae_separate"]:
+        claim_lae = df["Claim/LAE"]
+        alae = (claim_lae == "LAE").to_numpy()
+        main &= (claim_lae == "Claim").to_numpy()
+
+    # 5 (Reopened)
+    reopen = None
+    if plan["reopen_separate"]:
+        is_reopen = (df["Open/Closed/Reopen"] == "Reopen").to_numpy()
+        reopen = main & is_reopen
+        main &= ~is_reopen
+
+    # 4 (Large Claims)
+    adjusted = raw
+    large = None
+    if plan["large_claims"] == "cap":
+        adjusted = np.minimum(raw, plan["threshold"])
+    elif plan["large_claims"] == "exclude":
+        large = main & (raw > plan["threshold"])
+        main &= raw <= plan["threshold"]
+
+    # 3 (Salvage and Subrogation)
+    if plan["ss"] is not None:
+        ss = sum(df[c].to_numpy(dtype="float64") for c in SS_COLUMNS)
+        if plan["ss"] == "separate":
+            columns["SS"] = ss
+            main_overlay["SS"] = "SS"
+        else:
+            adjusted = adjusted - ss
+            main_sources = main_sources + SS_COLUMNS
+
+    if adjusted is not raw:
+        columns["adjusted"] = adjusted
+        main_overlay[amount] = "adjusted"
+
+    # 2 (Reinsurance)
+    if plan["ri"] is not None:
+        ri = sum(df[c].to_numpy(dtype="float64") for c in RI_COLUMNS)
+        if plan["ri"] == "separate":
+            columns["RI"] = ri
+            main_overlay["RI"] = "RI"
+        else:
+            columns["net_ri"] = adjusted - ri
+
+    datasets["filtered_df"] = _dataset("Net of SS" if plan["ss"] == "net" else "Gross", main, amount, main_sources, main_overlay)
+
+    if alae is not None:
+        alae_overlay = {}
+        if plan["alae_yearly_dates"]:
+            # Dec 15 adjustment uses the ALAE rows' own dates only, per segment
+            # when all segments are stacked
+            dates = df[development].to_numpy().copy()
+            alae_dates = df[development][alae]
+            if plan["index"] is not None:
+                alae_dates = alae_dates.groupby(df[plan["index"]][alae], observed=True, dropna=False).transform(adjust_year_max_to_dec15)
+            else:
+                alae_dates = adjust_year_max_to_dec15(alae_dates)
+            dates[alae] = alae_dates.to_numpy()
+            columns["alae_dates"] = dates
+            alae_overlay[development] = "alae_dates"
+        datasets["alae_df"] = _dataset("ALAE", alae, amount, [amount], alae_overlay)
+
+    if reopen is not None:
+        datasets["reopen_df"] = _dataset("Reopened Claims", reopen, amount, [amount])
+
+    if large is not None:
+        datasets["large_claims_df"] = _dataset("Large Claims", large, amount, [amount])
+
+    if plan["ss"] == "separate":
+        datasets["ss_triangle"] = _dataset("SS", main, "SS", SS_COLUMNS, main_overlay)
+
+    if plan["ri"] == "separate":
+        datasets["ri_triangle"] = _dataset("RI", main, "RI", RI_COLUMNS, main_overlay)
+    elif plan["ri"] == "net":
+        datasets["net_ri_df"] = _dataset("Net of RI", main, amount, main_sources + RI_COLUMNS,
+                                       dict(main_overlay, **{amount: "net_ri"}))
+
+    return {"sheet": sheet, "frame": df, "index": plan["index"], "columns": columns, "datasets": datasets}
+
+
+def materialize(prepared, name):
+    """
+    Build one dataset of an apply_plan result as a DataFrame: its rows of
+    the base frame, with its overlay columns applied. Only this dataset's
+    rows are copied.
+    """
+    dataset = prepared["datasets"][name]
+    rows = dataset["rows"]
+    out = prepared["frame"].take(rows)
+    for column, source in dataset["overlay"].items():
+        out[column] = prepared["columns"][source][rows]
+    return out
@@ -0,0 +1,231 @@
+import contextvars
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+# Opt-in instrumentation of the pipeline. A session's profile is a plain
+# dict (see new_profile) made current for one script run by begin_run;
+# stage() and cache_event() record into it and do nothing at all when no
+# profile is current, so batch runs and unprofiled sessions pay nothing.
+MAX_EVENTS = 20_000     # trace events kept per profile, oldest dropped first
+
+_current = contextvars.ContextVar("profile", default=None)
+# tracemalloc traces the whole process, which every session shares: it
+# runs while any session asks for it and is stopped once none does (and
+# only if this module started it). A closed browser tab never says so, so
+# a session that has not run for MEMORY_IDLE_S no longer counts.
+#
+# Its peak is process-wide too: each stage resets it, so a stage during
+# which another session reset it reports no peak rather than a wrong one.
+# Allocations of other sessions' concurrent runs are counted regardless.
+MEMORY_IDLE_S = 600
+
+_tracing_sessions = {}      # session -> time of its last run
+_tracing_lock = threading.Lock()
+_tracing_timer = None
+_started_tracemalloc = False
+_peak_resets = 0            # reset_peak() calls by every session
+
+
+def new_profile():
+    return {
+        "origin": time.perf_counter(),
+        "runs": 0,
+        "reruns": {},       # step -> script runs
+        "stages": {},       # stage -> {"calls", "total_s", "max_s", "peak_mb"}
+        "cache": {},        # cache -> [hits, misses]
+        "events": [],       # Chrome trace events
+        "stack": [],
+        "peak_resets": 0,   # reset_peak() calls by this profile
+    }
+
+
+def begin_run(profile, step, memory=False, session=None):
+    """
+    Make `profile` current for this script run (None switches profiling
+    off) and count the run against `step`. With memory=True stages also
+    record their peak allocation via tracemalloc, which traces the whole
+    process and slows it down noticeably. `session` tells apart callers
+    sharing the process, so one turning memory tracking off leaves it on
+    for the others; one idle for MEMORY_IDLE_S is taken to be gone.
+    """
+    _track_memory(session, memory)
+
+    _current.set(profile)
+    if profile is not None:
+        profile["runs"] += 1
+        profile["reruns"][step] = profile["reruns"].get(step, 0) + 1
+        profile["step"] = step
+        # The whole run is the outermost stage
+        profile["stack"] = [_open_frame(profile)]
+
+
+def _track_memory(session, memory):
+    with _tracing_lock:
+        if memory:
+            _tracing_sessions[session] = time.monotonic()
+        else:
+            _tracing_sessions.pop(session, None)
+        _update_tracing()
+
+
+def _update_tracing():
+    # Called holding _tracing_lock
+    global _started_tracemalloc, _tracing_timer
+    now = time.monotonic()
+    for session, seen in list(_tracing_sessions.items()):
+        if now - seen > MEMORY_IDLE_S:
+            del _tracing_sessions[session]
+
+    if _tracing_sessions and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    elif not _tracing_sessions and _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+    # Expire idle sessions even when no session runs again
+    if _tracing_sessions and _tracing_timer is None:
+        _tracing_timer = threading.Timer(MEMORY_IDLE_S, _rearm)
+        _tracing_timer.daemon = True
+        _tracing_timer.start()
+
+
+def _rearm():
+    global _tracing_timer
+    with _tracing_lock:
+        _tracing_timer = None
+        _update_tracing()
+
+
+def end_run():
+    """
+    Record the script run as a whole ("step N") and stop profiling it.
+    Runs cut short by st.rerun or st.stop simply go unrecorded.
+    """
+    profile = _current.get()
+    _current.set(None)
+    if profile is not None and profile["stack"]:
+        frame = profile["stack"][0]
+        profile["stack"] = []
+        _close_frame(profile, f"step {profile['step']}", frame)
+
+
+def _open_frame(profile):
+    global _peak_resets
+    tracing = tracemalloc.is_tracing()
+    frame = {"start_mem": tracemalloc.get_traced_memory()[0] if tracing else 0, "child_peak": 0,
+             "tracing": tracing, "start": time.perf_counter()}
+    if tracing:
+        with _tracing_lock:
+            tracemalloc.reset_peak()
+            _peak_resets += 1
+            profile["peak_resets"] = profile.get("peak_resets", 0) + 1
+            frame["resets"] = (_peak_resets, profile["peak_resets"])
+    return frame
+
+
+def _close_frame(profile, name, frame):
+    seconds = time.perf_counter() - frame["start"]
+    peak_mb = None
+    if frame["tracing"] and tracemalloc.is_tracing():
+        with _tracing_lock:
+            peak = max(tracemalloc.get_traced_memory()[1], frame["child_peak"])
+            # Resets since this stage's own, less those of its child stages
+            foreign = (_peak_resets - frame["resets"][0]) - (profile["peak_resets"] - frame["resets"][1])
+        if not foreign:
+            peak_mb = max(peak - frame["start_mem"], 0) / (1 << 20)
+            if profile["stack"]:
+                # reset_peak() in this stage hid the allocations from the parent
+                parent = profile["stack"][-1]
+                parent["child_peak"] = max(parent["child_peak"], peak)
+    _record(profile, name, frame["start"], seconds, peak_mb)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the enclosed block as one stage of the current profile. Stages
+    nest; a stage's peak memory includes its children's.
+    """
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+
+    frame = _open_frame(profile)
+    profile["stack"].append(frame)
+    try:
+        yield
+    finally:
+        if profile["stack"] and profile["stack"][-1] is frame:
+            profile["stack"].pop()
+        _close_frame(profile, name, frame)
+
+
+def _record(profile, name, start, seconds, peak_mb):
+    totals = profile["stages"].setdefault(name, {"calls": 0, "total_s": 0.0, "max_s": 0.0, "peak_mb": None})
+    totals["calls"] += 1
+    totals["total_s"] += seconds
+    totals["max_s"] = max(totals["max_s"], seconds)
+    if peak_mb is not None:
+        totals["peak_mb"] = max(totals["peak_mb"] or 0.0, peak_mb)
+
+    args = {"step": profile.get("step"), "run": profile["runs"]}
+    if peak_mb is not None:
+        args["peak_mb"] = round(peak_mb, 3)
+    events = profile["events"]
+    events.append({
+        "name": name, "ph": "X", "pid": 1, "tid": 1,
+        "ts": (start - profile["origin"]) * 1e6, "dur": seconds * 1e6, "args": args,
+    })
+    if len(events) > MAX_EVENTS:
+        del events[: len(events) - MAX_EVENTS]
+
+
+def cache_event(cache, hit):
+    """
+    Count a hit or miss of the named cache in the current profile.
+    """
+    profile = _current.get()
+    if profile is None:
+        return
+    counts = profile["cache"].setdefault(cache, [0, 0])
+    counts[0 if hit else 1] += 1
+
+
+def stage_table(profile):
+    """
+    Stage totals, slowest first: calls, total / mean / max seconds and
+    peak MB (empty unless memory was tracked).
+    """
+    rows = [
+        (name, s["calls"], s["total_s"], s["total_s"] / s["calls"], s["max_s"], s["peak_mb"])
+        for name, s in profile["stages"].items()
+    ]
+    table = pd.DataFrame(rows, columns=["Stage", "Calls", "Total (s)", "Mean (s)", "Max (s)", "Peak MB"])
+    return table.sort_values("Total (s)", ascending=False).set_index("Stage")
+
+
+def cache_table(profile):
+    rows = [(name, hits, misses, 100 * hits / (hits + misses)) for name, (hits, misses) in profile["cache"].items()]
+    return pd.DataFrame(rows, columns=["Cache", "Hits", "Misses", "Hit rate (%)"]).set_index("Cache")
+
+
+def trace_json(profile):
+    """
+    The recorded stages in Chrome trace event format, for chrome://tracing
+    or Perfetto. Step numbers and rerun counts go in the metadata.
+    """
+    trace = {
+        "traceEvents": profile["events"],
+        "displayTimeUnit": "ms",
+        "otherData": {"runs": profile["runs"], "reruns": {str(k): v for k, v in profile["reruns"].items()},
+                      "cache": profile["cache"]},
+    }
+    return json.dumps(trace).encode()
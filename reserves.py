@@ -0,0 +1,109 @@
+import chainladder as cl
+import numpy as np
+import pandas as pd
+
+from profiling import stage
+from stochastic import observed_cells
+
+
+# Months per development period of the app's (same-grain) triangles
+MONTHS = {"OYDY": 12, "OQDQ": 3, "OMDM": 1}
+
+
+def lagged(tri, grain):
+    """
+    Copy of a triangle whose development was renumbered 1..n (see
+    triangles.renumbered) with development ages in months again and the
+    valuation date at its latest diagonal holding data, so chainladder's
+    methods see a proper triangle.
+    """
+    tri = tri.copy()
+    tri.development = pd.Index([MONTHS[grain] * (i + 1) for i in range(tri.development.size)])
+    values = tri.values
+    if not isinstance(values, np.ndarray):
+        values = values.todense()   # sparse backend
+    mask = observed_cells(np.asarray(values, dtype="float64"))
+    valuation = np.asarray(tri.valuation).reshape(mask.shape)
+    tri.valuation_date = pd.Timestamp(valuation[mask].max())
+    return tri
+
+
+def _mack(model, n_dev):
+    """
+    Mack (1993) standard errors of a fitted cl.Chainladder, for every
+    index and column at once: per origin and in total, each as
+    sqrt(process^2 + parameter^2). This is the recursion of
+    cl.MackChainladder, which in chainladder 0.9.1 only runs on
+    single-index, single-column triangles.
+    """
+    X = model.X_
+    full = np.nan_to_num(np.asarray(model.full_triangle_.values, dtype="float64")[..., :n_dev])
+    observed = np.isfinite(X.nan_triangle)
+    # No tail: a last factor of 1 without uncertainty
+    pad = lambda a, value: np.concatenate([a[..., :n_dev - 1], np.full(a.shape[:-1] + (1,), value)], axis=-1)
+    ldf = pad(np.asarray(X.ldf_.values), 1.0)
+    sigma = pad(np.asarray(X.sigma_.values), 0.0)
+    std_err = pad(np.asarray(X.std_err_.values), 0.0)
+    weights = np.concatenate([np.asarray(X.w_), np.ones(X.w_.shape[:3] + (1,))], axis=-1)
+    weights[np.isnan(weights)] = 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        process_std_err = np.nan_to_num(sigma / np.sqrt(np.where(full != 0, full, np.nan))) * weights
+
+    future = ~np.concatenate([observed, np.zeros((observed.shape[0], 1), bool)], axis=1)
+
+    def recursion(t1, mask=None):
+        risk = np.zeros(t1.shape[:-1])
+        for d in range(n_dev):
+            risk = np.sqrt(t1[..., d] ** 2 + (ldf[..., d] * risk) ** 2)
+            if mask is not None:
+                risk = np.nan_to_num(risk * mask[:, d + 1])
+        return risk
+
+    process = recursion(full * process_std_err, future)
+    parameter = recursion(full * np.nan_to_num(std_err), future)
+
+    # Parameter risk of the total: the latest diagonal onwards, summed over origins
+    latest = observed.sum(axis=1) - 1
+    ahead = np.arange(n_dev)[None, :] >= latest[:, None]
+    total_parameter = recursion((np.where(ahead, full, 0) * np.nan_to_num(std_err)).sum(axis=-2, keepdims=True))
+    total = np.sqrt((process ** 2).sum(axis=-1) + total_parameter[..., 0] ** 2)
+    return np.sqrt(process ** 2 + parameter ** 2), total
+
+
+def reserve_summary(tri, mack=False):
+    """
+    Chain ladder (volume-weighted, all periods) reserves of every index and
+    column of a cumulative triangle, fitted in one pass. Returns (totals,
+    origins): Latest, Ultimate and IBNR per (index, column), and per
+    (index, column, origin); with mack=True also the Mack standard error
+    of the IBNR and its CV.
+    """
+    tri = tri.set_backend("numpy") if tri.array_backend != "numpy" else tri
+    with stage("cl.Chainladder"):
+        model = cl.Chainladder().fit(cl.Development().fit_transform(tri))
+    latest = np.nan_to_num(np.asarray(model.X_.latest_diagonal.values)[..., 0])
+    ultimate = np.nan_to_num(np.asarray(model.ultimate_.values)[..., 0])
+    columns = {"Latest": latest, "Ultimate": ultimate, "IBNR": ultimate - latest}
+
+    totals = {name: values.sum(axis=-1) for name, values in columns.items()}
+    if mack:
+        with stage("Mack"):
+            columns["Mack Std Err"], totals["Mack Std Err"] = _mack(model, tri.shape[3])
+        for table in (columns, totals):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                table["CV"] = np.where(table["IBNR"] != 0, table["Mack Std Err"] / table["IBNR"], np.nan)
+
+    # A segment a column has no cells in (a dataset can miss segments) stays
+    # empty rather than showing zero reserves
+    empty = ~np.isfinite(np.asarray(tri.values, dtype="float64")).any(axis=(2, 3))
+    for name in columns:
+        columns[name] = np.where(empty[..., None], np.nan, columns[name])
+        totals[name] = np.where(empty, np.nan, totals[name])
+
+    labels = [tri.index.iloc[:, 0].tolist(), list(tri.columns)]
+    names = [tri.key_labels[0], "Column"]
+    index = pd.MultiIndex.from_product(labels, names=names)
+    totals = pd.DataFrame({name: values.reshape(-1) for name, values in totals.items()}, index=index)
+    index = pd.MultiIndex.from_product(labels + [[str(o) for o in tri.origin]], names=names + ["Origin"])
+    origins = pd.DataFrame({name: values.reshape(-1) for name, values in columns.items()}, index=index)
+    return totals, origins
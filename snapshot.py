@@ -0,0 +1,212 @@
+import copy
+import io
+import json
+import mmap
+import os
+import pickle
+import re
+import struct
+import zipfile
+
+import numpy as np
+import pyarrow as pa
+import sparse
+
+
+# A project snapshot is one uncompressed zip file holding
+#   snapshot.json        answers, step and other session fields, plus an
+#                        index of the triangles below
+#   data/<name>.arrow    column-projected input sheets as Arrow IPC files
+#   triangles/<i>.pkl    a triangle with its values removed (axes, grain...)
+#   triangles/<i>-*.npy  its values: the dense tensor, or the coordinates
+#                        and data of a sparse one
+# Members are stored, not deflated, and aligned to 64 bytes, so on opening
+# the file is memory-mapped and the triangle arrays and the numeric and
+# date columns of the sheets are read in place instead of being parsed.
+# Text (categorical) columns are still decoded into pandas.
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DIR = ".cache/snapshots"
+SNAPSHOT_SUFFIX = ".snapshot"
+
+ALIGNMENT = 64
+_PADDING_HEADER_ID = 0xD935     # extra-field id used by zipalign for padding
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+def snapshot_name(name):
+    """
+    A user-typed snapshot name reduced to a safe file name (as batch runs
+    name their folders), so it cannot reach outside SNAPSHOT_DIR.
+    """
+    return re.sub(r"[^\w.-]+", "_", str(name)).strip("._") or "_"
+
+
+def snapshot_path(name):
+    """
+    Path of the snapshot `name` under SNAPSHOT_DIR. Raises ValueError for
+    a name that would resolve anywhere else.
+    """
+    path = os.path.join(SNAPSHOT_DIR, snapshot_name(name) + SNAPSHOT_SUFFIX)
+    root = os.path.realpath(SNAPSHOT_DIR)
+    if os.path.dirname(os.path.realpath(path)) != root:
+        raise ValueError(f"Invalid snapshot name: {name!r}")
+    return path
+
+
+def list_snapshots():
+    """
+    Names of the snapshots saved on this server, newest first.
+    """
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    paths = [os.path.join(SNAPSHOT_DIR, f) for f in os.listdir(SNAPSHOT_DIR) if f.endswith(SNAPSHOT_SUFFIX)]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    return [os.path.basename(p)[:-len(SNAPSHOT_SUFFIX)] for p in paths]
+
+
+def _write_aligned(zf, name, payload):
+    # Pad the local header's extra field so the member's data starts on an
+    # ALIGNMENT boundary (zipfile adds a 20 byte zip64 field for big members)
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_STORED
+    zip64 = len(payload) * 1.05 > zipfile.ZIP64_LIMIT
+    start = zf.start_dir + _LOCAL_HEADER.size + len(name.encode()) + 4 + (20 if zip64 else 0)
+    pad = -start % ALIGNMENT
+    info.extra = struct.pack("<HH", _PADDING_HEADER_ID, pad) + b"\0" * pad
+    zf.writestr(info, payload)
+
+
+def _npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _arrow_bytes(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def _is_triangle(obj):
+    # chainladder Triangle, told apart the way memory.nbytes does
+    return hasattr(obj, "values") and hasattr(obj, "to_frame") and hasattr(obj, "development")
+
+
+def _key(value):
+    # Cache keys nest tuples, which JSON turns into lists
+    return tuple(_key(v) for v in value) if isinstance(value, list) else value
+
+
+def save_snapshot(path, state, frames, triangles):
+    """
+    Write a snapshot.
+
+    state      JSON-serialisable dict of session fields (answers, step...)
+    frames     {name: DataFrame} of input data
+    triangles  {cache key tuple: chainladder Triangle}, e.g. the app's
+               triangle cache; entries that are not triangles (LDF
+               tables, reserves derived from them) are left out and
+               rebuilt on their next use
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    index = []
+
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name, df in frames.items():
+            if df is not None:
+                _write_aligned(zf, f"data/{name}.arrow", _arrow_bytes(df))
+
+        triangles = {key: tri for key, tri in triangles.items() if _is_triangle(tri)}
+        for i, (key, tri) in enumerate(triangles.items()):
+            values = tri.values
+            shell = copy.copy(tri)
+            shell.values = None
+            entry = {"key": list(key), "shell": f"triangles/{i}.pkl"}
+            _write_aligned(zf, entry["shell"], pickle.dumps(shell, protocol=pickle.HIGHEST_PROTOCOL))
+
+            if hasattr(values, "coords"):
+                # sparse.COO
+                entry["sparse"] = {"shape": list(values.shape), "fill_value": float(values.fill_value)}
+                entry["coords"], entry["data"] = f"triangles/{i}-coords.npy", f"triangles/{i}-data.npy"
+                _write_aligned(zf, entry["coords"], _npy_bytes(values.coords))
+                _write_aligned(zf, entry["data"], _npy_bytes(values.data))
+            else:
+                entry["values"] = f"triangles/{i}-values.npy"
+                _write_aligned(zf, entry["values"], _npy_bytes(np.asarray(values)))
+            index.append(entry)
+
+        manifest = {"version": SNAPSHOT_VERSION, "state": state, "frames": list(frames), "triangles": index}
+        zf.writestr("snapshot.json", json.dumps(manifest, default=str))
+
+    os.replace(tmp_path, path)
+
+
+def _member_view(zf, view, name):
+    # Memory view of a stored member's bytes, located through its local header
+    info = zf.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f"Snapshot member {name} is compressed")
+    header = _LOCAL_HEADER.unpack_from(view, info.header_offset)
+    start = info.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1]
+    return view[start:start + info.file_size]
+
+
+def _npy_array(member):
+    reader = io.BytesIO(member[:4096])
+    version = np.lib.format.read_magic(reader)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(reader)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(reader)
+    offset = reader.tell()
+    count = int(np.prod(shape)) if shape else 1
+    return np.frombuffer(member, dtype=dtype, count=count, offset=offset).reshape(shape, order="F" if fortran_order else "C")
+
+
+def load_snapshot(path):
+    """
+    Open a snapshot. Returns (state, frames, triangles) as given to
+    save_snapshot.
+
+    The file is mapped copy-on-write: arrays are views on the mapping that
+    the OS pages in on first touch, and writes to them stay private to
+    this process.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mapped)
+
+    with zipfile.ZipFile(path) as zf:
+        manifest = json.loads(zf.read("snapshot.json"))
+        if manifest.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {manifest.get('version')}")
+
+        frames = {}
+        for name in manifest["frames"]:
+            member = f"data/{name}.arrow"
+            if member in zf.namelist():
+                # Unconsolidated, so columns without nulls stay views on the mapping
+                table = pa.ipc.open_file(pa.py_buffer(_member_view(zf, view, member))).read_all()
+                frames[name] = table.to_pandas(split_blocks=True)
+            else:
+                frames[name] = None
+
+        triangles = {}
+        for entry in manifest["triangles"]:
+            tri = pickle.loads(_member_view(zf, view, entry["shell"]))
+            if "sparse" in entry:
+                tri.values = sparse.COO(
+                    _npy_array(_member_view(zf, view, entry["coords"])),
+                    _npy_array(_member_view(zf, view, entry["data"])),
+                    shape=tuple(entry["sparse"]["shape"]),
+                    fill_value=entry["sparse"]["fill_value"],
+                )
+            else:
+                tri.values = _npy_array(_member_view(zf, view, entry["values"]))
+            triangles[_key(entry["key"])] = tri
+
+    return manifest["state"], frames, triangles
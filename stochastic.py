@@ -0,0 +1,346 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from profiling import stage
+
+
+# Over-dispersed Poisson (ODP) bootstrap of chain ladder reserves, as
+# cl.BootstrapODPSample followed by cl.Chainladder, but without building a
+# chainladder Triangle per simulation: the model (expected incrementals,
+# hat-adjusted residual pool, scale) is fitted once per series, and the
+# simulations run in numpy, chunk by chunk, in worker processes. Only each
+# simulation's reserve comes back; percentiles are estimated on the fly.
+PERCENTILES = [50, 75, 90, 95, 99, 99.5]
+
+# Memory a worker may use for one chunk of simulated triangles, in MB.
+# Set TRIANGLES_BOOTSTRAP_CHUNK_MB to change it.
+CHUNK_MB = int(os.environ.get("TRIANGLES_BOOTSTRAP_CHUNK_MB", 256))
+_ARRAYS_PER_SIM = 12    # simulation-sized arrays alive at once in simulate_chunk
+
+
+# ---- STREAMING PERCENTILES ----
+
+def p2_start(p):
+    """
+    P-square estimator of the p-th percentile (Jain & Chlamtac, 1985): five
+    markers updated per observation, so a percentile of any number of
+    simulations is tracked in constant memory.
+    """
+    q = p / 100
+    return {"p": p, "heights": [], "positions": [1, 2, 3, 4, 5],
+            "desired": [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5], "increments": [0, q / 2, q, (1 + q) / 2, 1]}
+
+
+def p2_add(estimator, x):
+    heights, positions, desired = estimator["heights"], estimator["positions"], estimator["desired"]
+    if len(heights) < 5:
+        heights.append(x)
+        heights.sort()
+        return
+
+    if x < heights[0]:
+        heights[0] = x
+        k = 0
+    elif x >= heights[4]:
+        heights[4] = x
+        k = 3
+    else:
+        k = 0
+        while x >= heights[k + 1]:
+            k += 1
+    for i in range(k + 1, 5):
+        positions[i] += 1
+    for i in range(5):
+        desired[i] += estimator["increments"][i]
+
+    # Move the middle markers towards their desired positions
+    for i in (1, 2, 3):
+        d = desired[i] - positions[i]
+        if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+            d = 1 if d > 0 else -1
+            n0, n1, n2 = positions[i - 1], positions[i], positions[i + 1]
+            q0, q1, q2 = heights[i - 1], heights[i], heights[i + 1]
+            parabolic = q1 + d / (n2 - n0) * ((n1 - n0 + d) * (q2 - q1) / (n2 - n1) + (n2 - n1 - d) * (q1 - q0) / (n1 - n0))
+            if q0 < parabolic < q2:
+                heights[i] = parabolic
+            else:
+                heights[i] = q1 + d * (heights[i + d] - q1) / (positions[i + d] - n1)
+            positions[i] += d
+
+
+def p2_value(estimator):
+    heights = estimator["heights"]
+    if len(heights) < 5:
+        # Still exact: the observations themselves
+        return float(np.percentile(heights, estimator["p"])) if heights else np.nan
+    return heights[2]
+
+
+def summary_start(percentiles=PERCENTILES):
+    """
+    Running count, mean, variance (Welford), range and percentiles of a
+    stream of reserves.
+    """
+    return {"count": 0, "mean": 0.0, "m2": 0.0, "min": np.inf, "max": -np.inf,
+            "percentiles": [p2_start(p) for p in percentiles]}
+
+
+def summary_add(summary, values):
+    values = np.asarray(values, dtype="float64")
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return
+    # Chan et al.'s merge of a chunk's mean and variance into the totals
+    n, mean, m2 = values.size, values.mean(), ((values - values.mean()) ** 2).sum()
+    total = summary["count"] + n
+    delta = mean - summary["mean"]
+    summary["mean"] += delta * n / total
+    summary["m2"] += m2 + delta ** 2 * summary["count"] * n / total
+    summary["count"] = total
+    summary["min"] = min(summary["min"], values.min())
+    summary["max"] = max(summary["max"], values.max())
+    for x in values.tolist():
+        for estimator in summary["percentiles"]:
+            p2_add(estimator, x)
+
+
+def summary_row(summary):
+    count = summary["count"]
+    std = np.sqrt(summary["m2"] / (count - 1)) if count > 1 else np.nan
+    row = {"Simulations": count, "Mean": summary["mean"] if count else np.nan, "Std": std,
+           "CV": std / summary["mean"] if count and summary["mean"] else np.nan,
+           "Min": summary["min"] if count else np.nan}
+    for estimator in summary["percentiles"]:
+        row[f"P{estimator['p']:g}"] = p2_value(estimator)
+    row["Max"] = summary["max"] if count else np.nan
+    return row
+
+
+# ---- ODP BOOTSTRAP ----
+
+def observed_cells(values):
+    """
+    Cells up to the latest diagonal that holds data, for an (..., origin,
+    development) array: the triangle's own valuation, by position.
+    """
+    n_origin, n_dev = values.shape[-2:]
+    diagonal = np.arange(n_origin)[:, None] + np.arange(n_dev)[None, :]
+    data = (np.isfinite(values) & (values != 0)).reshape(-1, n_origin, n_dev).any(axis=0)
+    latest = diagonal[data].max() if data.any() else n_origin - 1
+    return diagonal <= latest
+
+
+def _valid_links(cum, mask):
+    # Link ratios the volume LDFs are taken over: both ends observed and non-zero
+    x, y = cum[..., :-1], cum[..., 1:]
+    return mask[:, 1:] & np.isfinite(x) & np.isfinite(y) & (x != 0) & (y != 0)
+
+
+def _volume_ldfs(cum, mask):
+    valid = _valid_links(cum, mask)
+    num = np.where(valid, cum[..., 1:], 0).sum(axis=-2)
+    den = np.where(valid, cum[..., :-1], 0).sum(axis=-2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(den != 0, num / den, 1.0)
+
+
+def _latest(cum, mask):
+    # Each origin's latest observed cumulative and its development position
+    position = mask.sum(axis=1) - 1
+    latest = np.take_along_axis(cum, np.broadcast_to(position[:, None], cum.shape[:-1] + (1,)), axis=-1)[..., 0]
+    return np.nan_to_num(latest), position
+
+
+def _projected(cum, mask, ldfs):
+    # Cumulative triangles completed with the chain ladder LDFs
+    full = np.where(mask, np.nan_to_num(cum), 0.0)
+    for d in range(1, mask.shape[1]):
+        future = ~mask[:, d]
+        if future.any():
+            full[..., future, d] = full[..., future, d - 1] * ldfs[..., d - 1, None]
+    return full
+
+
+def chainladder_ibnr(cum, mask):
+    """
+    Chain ladder (volume-weighted, all periods) IBNR of each origin for an
+    (..., origin, development) array of cumulative triangles.
+    """
+    ldfs = _volume_ldfs(cum, mask)
+    full = _projected(cum, mask, ldfs)
+    latest, _ = _latest(cum, mask)
+    return full[..., -1] - latest
+
+
+def _hat_factors(expected, mask):
+    """
+    Hat matrix adjustment sqrt(1 / (1 - h)) of each observed cell (Shapland
+    eq. 3.23), for the ODP GLM with one parameter per origin and per
+    development step. The diagonal is taken as w * rowsum((X A^-1) * X), so
+    the n_obs x n_obs hat matrix is never formed.
+    """
+    n_origin, n_dev = mask.shape
+    dev, origin = np.nonzero(mask.T)                # column-major, as the GLM's observations
+    design = np.zeros((origin.size, n_origin + n_dev - 1))
+    design[np.arange(origin.size), origin] = 1.0
+    design[:, n_origin:] = np.arange(n_dev - 1)[None, :] < dev[:, None]
+    weight = expected[origin, dev]
+
+    information = (design * weight[:, None]).T @ design
+    h = weight * ((design @ np.linalg.inv(information)) * design).sum(axis=1)
+    # Cells the model fits exactly (h = 1, e.g. the corners) have no residual
+    factors = np.full(mask.shape, np.nan)
+    exact = np.isclose(h, 1, rtol=0, atol=1e-9)
+    factors[origin[~exact], dev[~exact]] = np.sqrt(1 / np.abs(1 - h[~exact]))
+    return factors
+
+
+def fit_odp(cum, hat_adj=True):
+    """
+    Fit the ODP bootstrap model of one cumulative (origin, development)
+    triangle: expected incrementals, the pool of centred, hat-adjusted
+    Pearson residuals and the scale parameter phi. Returns None when the
+    triangle has too few observations for the model.
+    """
+    mask = observed_cells(cum)
+    ldfs = _volume_ldfs(cum, mask)
+    latest, position = _latest(cum, mask)
+
+    # Expected cumulatives back from each origin's latest value
+    cdf = np.append(np.cumprod(ldfs[::-1])[::-1], 1.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = latest[:, None] * (cdf[position][:, None] / cdf[None, :])
+        expected = np.nan_to_num(np.diff(expected, axis=1, prepend=0.0)) * mask
+        # Empty cells and zero increments have no residual (chainladder's cum_to_incr)
+        incremental = np.diff(np.nan_to_num(cum), axis=1, prepend=0.0)
+        incremental[incremental == 0] = np.nan
+        residuals = (incremental - expected) / np.sqrt(np.abs(expected))
+
+    # Residuals of links dropped from the LDFs are left out, as chainladder does
+    valid = _valid_links(cum, mask)
+    weights = mask[:, :-1] & (valid | ~mask[:, 1:])
+    residuals = np.where(mask & np.concatenate([weights[:, :1], weights], axis=1), residuals, np.nan)
+
+    n_params = mask.shape[0] + mask.shape[1] - 1
+    degrees_of_freedom = mask.sum() - n_params
+    if degrees_of_freedom <= 0:
+        return None
+    scale = np.nansum(np.where(np.isfinite(residuals), residuals, 0) ** 2) / degrees_of_freedom
+
+    if hat_adj:
+        try:
+            residuals = residuals * _hat_factors(expected, mask)
+        except np.linalg.LinAlgError:
+            pass    # singular design: no adjustment, like chainladder
+    pool = residuals[np.isfinite(residuals) & (residuals != 0)]
+    if not pool.size:
+        return None
+    return {"expected": expected, "mask": mask, "residuals": pool - pool.mean(), "scale": scale}
+
+
+def chunk_size(shape):
+    """
+    Simulations of a triangle of `shape` (origin, development) per chunk
+    that fit in CHUNK_MB.
+    """
+    per_sim = int(np.prod(shape)) * 8 * _ARRAYS_PER_SIM
+    return max(1, CHUNK_MB * (1 << 20) // per_sim)
+
+
+def simulate_chunk(model, n_sims, seed, process=True):
+    """
+    Total reserves of `n_sims` bootstrap replicates. Residuals are drawn
+    as cl.BootstrapODPSample(random_state=seed) draws them; with
+    process=True each future incremental is then drawn from a gamma
+    distribution with the projected mean and variance phi * mean.
+    """
+    rng = np.random.RandomState(seed)
+    expected, mask = model["expected"], model["mask"]
+    resampled = rng.choice(model["residuals"], size=(n_sims,) + expected.shape)
+    incremental = np.where(mask, resampled * np.sqrt(np.abs(expected)) + expected, np.nan)
+    del resampled
+    cum = np.cumsum(incremental, axis=-1)
+    del incremental
+
+    full = _projected(cum, mask, _volume_ldfs(cum, mask))
+    if not process:
+        latest, _ = _latest(cum, mask)
+        return (full[..., -1] - latest).sum(axis=-1)
+
+    future = np.diff(full, axis=-1)[..., ~mask[:, 1:]]
+    scale = model["scale"]
+    if scale > 0:
+        future = np.sign(future) * rng.gamma(np.abs(future) / scale, scale)
+    return future.sum(axis=-1)
+
+
+def _simulate_task(task):
+    return simulate_chunk(*task)
+
+
+def _series(tri):
+    # (label, column, cumulative values) of each segment and column
+    values = tri.values
+    if not isinstance(values, np.ndarray):
+        values = values.todense()   # sparse backend
+    values = np.asarray(values, dtype="float64")
+    labels = tri.index.iloc[:, 0].tolist()
+    for i, label in enumerate(labels):
+        for c, column in enumerate(tri.columns):
+            yield label, column, values[i, c]
+
+
+def simulate_reserves(tri, n_sims=1000, process=True, hat_adj=True, seed=0, workers=None,
+                      percentiles=PERCENTILES, progress=None):
+    """
+    Bootstrap reserve distribution of every segment and column of a
+    cumulative triangle (the Step 5 cumulative triangles): one row per
+    (segment, column) with the deterministic chain ladder IBNR and the
+    mean, standard deviation, range and percentiles of the simulated
+    reserves.
+
+    Simulations are sharded over `workers` processes (default: CPU count;
+    1 runs in process) in chunks of chunk_size() triangles, seeded from
+    `seed` per chunk so results do not depend on the number of workers.
+    `progress(done, total)` is called after each chunk.
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks, summaries, rows = [], [], []
+    seeds = np.random.SeedSequence(seed)
+    with stage("bootstrap fit"):
+        for label, column, cum in _series(tri):
+            summary = summary_start(percentiles)
+            mask = observed_cells(cum)
+            rows.append({tri.key_labels[0]: label, "Column": column,
+                         "Chain ladder IBNR": chainladder_ibnr(cum, mask).sum()})
+            summaries.append(summary)
+            model = fit_odp(cum, hat_adj)
+            if model is None:
+                continue
+            size = chunk_size(cum.shape)
+            for start in range(0, n_sims, size):
+                child = seeds.spawn(1)[0]
+                tasks.append((summary, (model, min(size, n_sims - start), int(child.generate_state(1)[0]), process)))
+
+    with stage("bootstrap simulate"):
+        if workers == 1:
+            results = (_simulate_task(args) for _, args in tasks)
+            _collect(tasks, results, progress)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                _collect(tasks, pool.map(_simulate_task, [args for _, args in tasks]), progress)
+
+    for row, summary in zip(rows, summaries):
+        row.update(summary_row(summary))
+    return pd.DataFrame(rows).set_index([tri.key_labels[0], "Column"])
+
+
+def _collect(tasks, results, progress):
+    # Results come back in task order, so the estimates are reproducible
+    for done, ((summary, _), reserves) in enumerate(zip(tasks, results), start=1):
+        summary_add(summary, reserves)
+        if progress is not None:
+            progress(done, len(tasks))
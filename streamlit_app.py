@@ -1,11 +1,22 @@
 import streamlit as st
 import pandas as pd
 import chainladder as cl
-from datetime import datetime
-import pickle
-import json
 import os
 import io
+import uuid
+from collections import OrderedDict
+
+from ingest import load_workbook, load_path, write_store, has_store, list_segments, read_segment, apply_filters
+from preprocess import ALL_SEGMENTS, SEGMENT_COLUMNS, compile_plan, apply_plan
+from memory import MB, MEMORY_BUDGET_MB, nbytes, evict_lru, usage_table
+from profiling import new_profile, begin_run, end_run, stage, cache_event, stage_table, cache_table, trace_json
+from comments import PAGE_SIZE, add_comment, list_comments, count_comments
+from cube import build_cube, cube_covers, cube_catalog, cube_segments
+from snapshot import snapshot_name, snapshot_path, list_snapshots, save_snapshot, load_snapshot
+from triangle_store import store_key, read_manifest, append_extract, stored_specs
+from export import export_tables, export_bytes, write_workbook, write_parquet
+from triangles import (GRAINS, PAID, OS, INCURRED, PREMIUM, fingerprint, build_catalog, segment_labels, segment_frame, triangle_view,
+                       fused_view, fused_link_ratio_view, ldf_grid_view, reserve_view, bootstrap_view)
 
 st.set_page_config(layout="wide")
 pd.set_option('display.max_columns', None)
@@ -20,6 +31,17 @@ if "step" not in st.session_state:
 if "df" not in st.session_state:
     st.session_state.df = None
 
+if "data_key" not in st.session_state:
+    st.session_state.data_key = None
+
+# Triangles built so far, keyed by configuration fingerprint (see triangles.py),
+# in least- to most-recently used order
+if "triangle_cache" not in st.session_state:
+    st.session_state.triangle_cache = OrderedDict()
+
+if "memory_budget_mb" not in st.session_state:
+    st.session_state.memory_budget_mb = MEMORY_BUDGET_MB
+
 # ---- FUNCTIONS TO CHANGE STEPS ----
 def next_step():
     if st.session_state.df is not None:
@@ -34,113 +56,391 @@ segments = []
 
 # ---- HELPER FUNCTIONS ----
 
-def format_numeric(df):
+# Triangles are passed to st.dataframe as numbers and formatted by the
+# browser, instead of being turned into frames of strings cell by cell
+AMOUNT_FORMAT = "accounting"    # thousands separators, negatives in brackets
+
+
+def number_column(decimals=0, **kwargs):
+    """
+    Number column in AMOUNT_FORMAT with a fixed number of decimals: 1,234
+    and (1,234) for amounts, 1.2345 and (1.2345) for ratios, as the old
+    format_numeric_nans / format_four_decimals strings showed them. The
+    browser takes the decimals from `step`; without it accounting shows 2.
     """
-    Format all numeric columns in a dataframe with comma separators
-    and no decimal places (e.g., 1,234,567).
+    return st.column_config.NumberColumn(format=AMOUNT_FORMAT, step=10 ** -decimals if decimals else 1, **kwargs)
+
 
-    Returns a copy of the formatted dataframe.
+def triangle_column_config(df, decimals=0):
     """
-    df_formatted = df.copy()
+    Column config showing every column of a triangle frame as a narrow
+    number column: amounts, or ratios with fixed decimals.
+    """
+    return {col: number_column(decimals, width="small") for col in df.columns}
+
 
-    for col in df_formatted.select_dtypes(include=['number']).columns:
-        df_formatted[col] = df_formatted[col].apply(lambda x: f"{x:,.0f}")
+# Largest window of a triangle sent to the browser at once; bigger
+# (monthly) triangles are paged through on the server
+PAGE_ORIGINS = 36
+PAGE_DEVELOPMENTS = 36
 
-    return df_formatted
+# Where Steps 3-5 take their triangles from (see triangle_store.py)
+TRIANGLE_SOURCES = ["Loaded extract", "Quarterly store"]
+STORE_SOURCE = TRIANGLE_SOURCES[1]
 
 
-def format_numeric_nans(df):
+def missing_segment(labels, segment):
+    """
+    Whether a dataset stacked by segment has no rows for the chosen segment
+    (its `labels` don't include it), saying so on the page when it hasn't.
     """
-    Format all numeric columns in a dataframe with comma separators
-    and no decimal places (e.g., 1,234,567). Negative values are shown
-    in brackets (e.g., -2 -> (2)). Replace NaNs with empty strings.
+    if segment is None or segment in list(labels):
+        return False
+    st.info(f"No {segment} rows in this dataset.")
+    return True
 
-    Returns a copy of the formatted dataframe.
+
+def show_triangle(title, tri, segment=None, decimals=0):
     """
-    df_formatted = df.copy()
+    Render a triangle under a title. The values stay numeric; NaNs show as
+    empty cells.
 
-    for col in df_formatted.select_dtypes(include=['number']).columns:
-        df_formatted[col] = df_formatted[col].apply(
-            lambda x: "" if pd.isna(x)
-            else (f"({abs(x):,.0f})" if x < 0 else f"{x:,.0f}")
+    Triangles larger than PAGE_ORIGINS x PAGE_DEVELOPMENTS get origin and
+    development pickers, and only the visible window is sliced, made
+    dense and sent to the browser.
+    """
+    st.title(title)
+    if missing_segment(segment_labels(tri), segment):
+        return
+    n_origins, n_developments = tri.shape[2], tri.shape[3]
+    origins = developments = None
+
+    if n_origins > PAGE_ORIGINS or n_developments > PAGE_DEVELOPMENTS:
+        col1, col2 = st.columns(2)
+        first_origin = col1.number_input(
+            f"First origin (of {n_origins})", min_value=1, max_value=n_origins,
+            value=1, step=PAGE_ORIGINS, key=f"{title}-origin"
+        )
+        first_development = col2.number_input(
+            f"First development period (of {n_developments})", min_value=1, max_value=n_developments,
+            value=1, step=PAGE_DEVELOPMENTS, key=f"{title}-development"
         )
+        origins = slice(first_origin - 1, first_origin - 1 + PAGE_ORIGINS)
+        developments = slice(first_development - 1, first_development - 1 + PAGE_DEVELOPMENTS)
 
-    return df_formatted
+    df = segment_frame(tri, segment, origins, developments)
+    with stage("render"):
+        st.dataframe(df, column_config=triangle_column_config(df, decimals))
 
 
-def format_four_decimals(df):
+def segment_rows(sheet, filters=None):
     """
-    Format all numeric columns in a dataframe with 4 decimal places.
-    Negative values are shown in brackets (e.g., -2 -> (2.0000)).
-    Replace NaNs with empty strings.
+    Rows of the selected segment (q0) for the 'Paid' or 'OS' sheet.
 
-    Returns a copy of the formatted dataframe.
+    Read from the partitioned store when the file has one, so only that
+    segment is scanned and `filters` are pushed down into the scan;
+    otherwise the loaded DataFrame is filtered in memory. With
+    "All segments" the whole sheet is used.
     """
-    df_formatted = df.copy()
+    with stage("segment filter"):
+        if st.session_state.q0 == ALL_SEGMENTS:
+            df = st.session_state.df if sheet == "Paid" else st.session_state.df_OS
+            return apply_filters(df, filters)
 
-    for col in df_formatted.select_dtypes(include=['number']).columns:
-        df_formatted[col] = df_formatted[col].apply(
-            lambda x: "" if pd.isna(x)
-            else (f"({abs(x):.4f})" if x < 0 else f"{x:.4f}")
-        )
+        if has_store(st.session_state.data_key):
+            return read_segment(st.session_state.data_key, sheet, st.session_state.q0, filters)
+
+        df = st.session_state.df if sheet == "Paid" else st.session_state.df_OS
+        return apply_filters(df, [("Line of Business", "==", st.session_state.q0)] + list(filters or []))
+
+
+def ensure_prepared():
+    """
+    Compile the Step 2 answers into a plan and, when the plan or the data
+    changed, prepare both sheets and rebuild the dataset catalog. Reruns
+    with the same answers (typing a comment, switching the sidebar
+    dataset...) reuse what is there.
+
+    Plans the monthly cube covers (see cube.py) read no rows at all: their
+    catalog sums cube slices, and there are no prepared sheets.
+    """
+    st.session_state.grain = GRAINS.get(st.session_state.q11, 'OMDM')
+
+    plan = compile_plan(st.session_state)
+    st.session_state.config_key = fingerprint(st.session_state.data_key, plan)
+
+    prepared = st.session_state.get("prepared_key") == st.session_state.config_key
+    cache_event("prepared datasets", hit=prepared)
+    if not prepared:
+        index = plan["index"]
+        if cube_covers(st.session_state.data_key, plan):
+            st.session_state.prepared = st.session_state.prepared_OS = None
+            st.session_state.catalog = cube_catalog(st.session_state.config_key, st.session_state.data_key, plan)
+            st.session_state.view_segments = cube_segments(st.session_state.data_key) if index else None
+        else:
+            # One scan of the segment per sheet; every dataset is a row selection of it
+            df_paid, df_OS = segment_rows("Paid"), segment_rows("OS")
+            with stage("preprocess"):
+                st.session_state.prepared = apply_plan(plan, df_paid, "Paid")
+                st.session_state.prepared_OS = apply_plan(plan, df_OS, "OS")
+            st.session_state.catalog = build_catalog(
+                st.session_state.config_key, st.session_state.prepared, st.session_state.prepared_OS
+            )
+            if index:
+                st.session_state.view_segments = sorted(st.session_state.prepared["frame"][index].dropna().unique().tolist())
+            else:
+                st.session_state.view_segments = None
+        st.session_state.view_index = index
+        st.session_state.prepared_key = st.session_state.config_key
+
+
+def current_catalog():
+    """
+    The catalog of the current configuration as every step shows it: with
+    the quarterly store selected in Step 2.5, datasets it holds are built
+    from the stored cells instead of the loaded extract.
+    """
+    catalog = st.session_state.catalog
+    if not catalog or st.session_state.get("triangle_source") != STORE_SOURCE:
+        return catalog
+
+    key = store_key(compile_plan(st.session_state))
+    stored = read_manifest(key)["datasets"]
+    resolved = {}
+    for name, entry in catalog.items():
+        if name in stored:
+            paid_spec, os_spec = stored_specs(key, name)
+            # Stored cells carry no premiums
+            entry = dict(entry, paid=paid_spec, os=os_spec, premium=None)
+        resolved[name] = entry
+    return resolved
+
+
+def choose_dataset():
+    """
+    Sidebar choice of the dataset to view (see current_catalog). Returns
+    its catalog entry, or None when the configuration produced no datasets.
+    """
+    catalog = current_catalog()
+    if not catalog:
+        st.sidebar.info("No dataframes or triangles available to display.")
+        return None
 
-    return df_formatted
+    name = st.sidebar.selectbox("Choose dataset to view", list(catalog), format_func=lambda n: catalog[n]["label"])
+    return catalog[name]
 
 
-def to_month_start(x):
+def choose_segment():
     """
-    Convert a date or collection of dates to the first day of the month.
-    Works on scalars, lists, Series, and DataFrame columns.
+    With "All segments", let the user pick which segment of the stacked
+    triangles to look at. Returns None when a single segment was analysed.
     """
-    return pd.to_datetime(x).dt.to_period("M").dt.to_timestamp()
+    index = st.session_state.view_index
+    if index is None:
+        return None
+    return st.sidebar.selectbox(f"{index} to view", st.session_state.view_segments)
 
 
-def map_year_min_to_jan1(date_series: pd.Series) -> pd.Series:
+def ldf_selection(grid, column, segment=None, key=""):
     """
-    For each year in the datetime series:
-      - Find the minimum date
-      - Replace it with January 1st of that year
+    Averaging method and number of periods pickers for one column of an
+    LDF grid, showing the chosen LDFs and, on request, every combination.
     """
-    # Ensure datetime
-    ds = pd.to_datetime(date_series)
+    rows = grid.xs(column, level="Column")
+    if missing_segment(rows.index.get_level_values(0).unique(), segment):
+        return
+    rows = rows.xs(segment if segment is not None else rows.index[0][0], level=0)
+    periods = list(rows.index.get_level_values("Periods").unique())
 
-    # Find min date per year
-    min_dates = ds.groupby(ds.dt.year).transform('max')
+    col1, col2 = st.columns(2)
+    method = col1.selectbox("Select averaging method:", options=["simple", "regression", "volume"],
+                            index=0, key=f"{key}-method")
+    n_periods = col2.selectbox("Select number of periods:", options=periods,
+                               index=len(periods) - 1, key=f"{key}-periods")
 
-    # Construct January 1st for each year
-    jan1 = pd.to_datetime(ds.dt.year.astype(str) + "-12-31")
+    st.subheader("Calculated LDF:")
+    st.dataframe(rows.loc[[(method, n_periods)]])
+    if st.checkbox("Show all methods and periods", key=f"{key}-grid"):
+        st.dataframe(rows)
 
-    # Replace only the min date in each year
-    return ds.where(ds != min_dates, jan1)
 
-def adjust_year_max_to_dec15(date_series: pd.Series) -> pd.Series:
+def export_buttons():
     """
-    For each year in the datetime series:
-      - Find the maximum date for that year
-      - Replace it with Dec 15 of that same year
-    Returns a new Series with adjusted dates.
+    Sidebar downloads of every incremental, cumulative, link ratio and LDF
+    table of the current configuration, as an xlsx workbook or long-format
+    Parquet (see export.py). The file is only built when a button is
+    clicked, on Streamlit's download thread, so a large (monthly) export
+    does not hold up the page. The tables come from the same source as
+    the steps (see current_catalog).
     """
-    # Ensure datetime
-    ds = pd.to_datetime(date_series)
+    catalog = current_catalog()
+    grain = st.session_state.grain
+    with_incurred = st.session_state.q10 == "Paid + Incurred"
+    with_premiums = st.session_state.q6 == "Earned Premiums"
+    name = f"triangles-{st.session_state.config_key[:12]}-{grain}"
+
+    def download(write, suffix):
+        return lambda: export_bytes(write, export_tables(catalog, grain, with_incurred, with_premiums), suffix)
 
-    # Get max date per year
-    max_dates = ds.groupby(ds.dt.year).transform('max')
+    with st.sidebar.expander("Export"):
+        st.download_button("Download workbook", download(write_workbook, ".xlsx"), file_name=name + ".xlsx",
+                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", on_click="ignore")
+        st.download_button("Download Parquet", download(write_parquet, ".parquet"), file_name=name + ".parquet",
+                           mime="application/vnd.apache.parquet", on_click="ignore")
 
-    # Compute the replacement Dec 15 date for each entry
-    dec15 = pd.to_datetime(ds.dt.year.astype(str) + "-12-15")
 
-    # Replace only where date == max date in the year
-    return ds.where(ds != max_dates, dec15)
+COMMENT_USERS = ["Primary", "Reviewer", "Appointed Actuary"]
+
+
+def comment_box(step, dataset, segment=None):
+    """
+    Review comments for the current (project, segment, step, dataset),
+    from the shared comment store. Only one page is read per rerun; the
+    session just remembers which page it is on.
+    """
+    project = st.session_state.data_key or ""
+    segment = str(segment if segment is not None else st.session_state.q0)
+    thread = (project, segment, step, dataset)
+
+    selected_user = st.selectbox("Select User", COMMENT_USERS)
+    comment_text = st.text_area("Write your comment:")
 
+    # Stack of before_id cursors; the last one is the page on screen
+    cursors = st.session_state.setdefault("comment_cursors", {})
+    pages = cursors.setdefault(thread, [None])
+
+    if st.button("Submit"):
+        if comment_text.strip():
+            add_comment(*thread, selected_user, comment_text)
+            pages[:] = [None]
+            st.success("Comment added!")
+        else:
+            st.warning("Comment cannot be empty.")
+
+    st.subheader("All Comments")
+
+    comments = list_comments(*thread, before_id=pages[-1])
+    if comments:
+        for c in comments:
+            st.write(f"**{c['user']}** ({c['time']}): {c['text']}")
+    else:
+        st.write("No comments yet.")
 
+    total = count_comments(*thread)
+    if total > PAGE_SIZE:
+        col1, col2, col3 = st.columns(3)
+        col1.caption(f"Page {len(pages)} of {-(-total // PAGE_SIZE)}")
+        if col2.button("Newer", disabled=len(pages) == 1):
+            pages.pop()
+            st.rerun()
+        if col3.button("Older", disabled=len(comments) < PAGE_SIZE):
+            pages.append(comments[-1]["id"])
+            st.rerun()
 
-def adjust_quarter_max_to_15th(date_series: pd.Series) -> pd.Series:
-    ds = pd.to_datetime(date_series)
-    quarters = ds.dt.to_period('Q')
-    max_dates = ds.groupby(quarters).transform('max')
-    quarter_start = quarters.dt.end_time
-    quarter_15th = quarter_start
-    return ds.where(ds != max_dates, quarter_15th)
+
+# ---- MEMORY BUDGET ----
+
+def session_objects():
+    """
+    What this session holds: the loaded sheets, the prepared (row
+    selection) datasets, the triangle cache and the last reserve ranges.
+    """
+    return {
+        "Paid data": st.session_state.df,
+        "OS data": st.session_state.get("df_OS"),
+        "Prepared Paid": st.session_state.get("prepared"),
+        "Prepared OS": st.session_state.get("prepared_OS"),
+        f"Triangles ({len(st.session_state.triangle_cache)})": st.session_state.triangle_cache,
+        "Reserve ranges": st.session_state.get("bootstrap"),
+    }
+
+
+def enforce_memory_budget():
+    """
+    Evict least recently used triangles until the session fits its budget.
+    Loaded and prepared data are not evictable; triangles get what is left.
+    """
+    fixed = sum(nbytes(obj) for name, obj in session_objects().items() if not name.startswith("Triangles"))
+    return evict_lru(st.session_state.triangle_cache, max(st.session_state.memory_budget_mb * MB - fixed, 0))
+
+
+# ---- PROJECT SNAPSHOTS ----
+
+# Session fields saved with a snapshot, besides the data and triangles
+SNAPSHOT_FIELDS = ["step", "data_key", "grain", "triangle_source", "batch_index", "threshold",
+                   "ss_choice3", "ss_choice4", "ss_choice5", "ss_choice7"] + [f"q{i}" for i in range(12)]
+
+
+def save_project(name):
+    state = {field: st.session_state[field] for field in SNAPSHOT_FIELDS if field in st.session_state}
+    frames = {"df": st.session_state.df, "df_OS": st.session_state.get("df_OS")}
+    save_snapshot(snapshot_path(name), state, frames, st.session_state.triangle_cache)
+
+
+def open_project(name):
+    """
+    Restore a snapshot into the session, at the step it was saved at.
+    Prepared datasets are recomputed on demand; triangles are not.
+    """
+    state, frames, triangles = load_snapshot(snapshot_path(name))
+    for field, value in state.items():
+        st.session_state[field] = value
+    st.session_state.df = frames["df"]
+    st.session_state.df_OS = frames["df_OS"]
+    st.session_state.triangle_cache = OrderedDict(triangles)
+    st.session_state.prepared_key = None
+
+
+with st.sidebar.expander("Project snapshot"):
+    project_name = st.text_input("Snapshot name", value="project")
+    if st.button("Save snapshot", disabled=st.session_state.df is None):
+        try:
+            save_project(project_name)
+            st.success(f"Saved '{snapshot_name(project_name)}'")
+        except Exception as e:
+            st.error(f"Error saving snapshot: {e}")
+
+    saved = list_snapshots()
+    if saved:
+        chosen = st.selectbox("Saved snapshots", saved)
+        if st.button("Open snapshot"):
+            try:
+                open_project(chosen)
+            except Exception as e:
+                st.error(f"Error opening snapshot: {e}")
+            else:
+                st.rerun()
+
+
+with st.sidebar.expander("Memory"):
+    st.session_state.memory_budget_mb = st.number_input(
+        "Session budget (MB)", min_value=64, step=64, value=int(st.session_state.memory_budget_mb)
+    )
+    if st.checkbox("Show memory usage"):
+        st.dataframe(usage_table(session_objects()), column_config={"MB": st.column_config.NumberColumn(format="%.1f")})
+
+
+# ---- PROFILING ----
+
+# Opt-in: this session's script runs are only timed while "Record timings"
+# is on (see profiling.py). The results are filled into the same expander
+# at the end of the run.
+profiling_panel = st.sidebar.expander("Profiling")
+with profiling_panel:
+    profiling_on = st.checkbox("Record timings", key="profiling_on")
+    profiling_memory = st.checkbox(
+        "Track peak memory", key="profiling_memory", disabled=not profiling_on,
+        help="Uses tracemalloc, which traces the whole server process and slows it down."
+    )
+    if profiling_on and st.button("Reset profile"):
+        st.session_state.profile = new_profile()
+
+if profiling_on and "profile" not in st.session_state:
+    st.session_state.profile = new_profile()
+if "session_token" not in st.session_state:
+    st.session_state.session_token = uuid.uuid4().hex
+begin_run(st.session_state.profile if profiling_on else None, st.session_state.step,
+          memory=profiling_on and profiling_memory, session=st.session_state.session_token)
 
 
 # ============================================================
@@ -291,6 +591,7 @@ textColor="#000000"
     uploaded_file = st.file_uploader("Upload file")
 
     df_loaded = None  # Temporary variable for the loaded DataFrame
+    data_key = None
     if uploaded_file is not None:
         try:
             # Let pandas try to figure it out
@@ -298,8 +599,9 @@ textColor="#000000"
                 df_loaded = pd.read_csv(uploaded_file)
                 df_OS = pd.read_csv(uploaded_file, sheet_name = 'OS')
             elif uploaded_file.name.endswith(('.xls', '.xlsx')):
-                df_loaded = pd.read_excel(uploaded_file)
-                df_OS = pd.read_excel(uploaded_file, sheet_name = 'OS')
+                # Both sheets in one pass, cached on disk by file contents
+                with stage("load"):
+                    df_loaded, df_OS, data_key = load_workbook(uploaded_file.getvalue())
             elif uploaded_file.name.endswith('.json'):
                 df_loaded = pd.read_json(uploaded_file)
                 df_OS = pd.read_json(uploaded_file, sheet_name = 'OS')
@@ -318,14 +620,20 @@ textColor="#000000"
     # OR load sample dataset button
     st.markdown("### OR")
     if st.button("Load a sample dataset"):
-        df_loaded = pd.read_excel("Test_file.xlsx")
-        df_OS = pd.read_excel("Test_file.xlsx", sheet_name="OS")
+        with stage("load"):
+            df_loaded, df_OS, data_key = load_path("Test_file.xlsx")
 
 
     # If a DataFrame was successfully loaded, store in session state and show preview
     if df_loaded is not None:
         st.session_state.df = df_loaded
         st.session_state.df_OS = df_OS
+        st.session_state.data_key = data_key
+        if data_key is not None:
+            with stage("partition store"):
+                write_store(data_key, df_loaded, df_OS)
+            with stage("cube build"):
+                build_cube(data_key, df_loaded, df_OS)
         st.title('Paid')
         st.dataframe(df_loaded.head())
         st.title('OS')
@@ -347,8 +655,17 @@ elif st.session_state.step == 2:
     st.title("Step 2: Reserving Configuration")
 
 
-    segments = st.session_state.df['Line of Business'].unique().tolist()
-    q0 = st.radio("0. Reserving Segment?", segments)
+    if has_store(st.session_state.data_key):
+        segments = list_segments(st.session_state.data_key)
+    else:
+        segments = st.session_state.df['Line of Business'].unique().tolist()
+    q0 = st.radio("0. Reserving Segment?", segments + [ALL_SEGMENTS])
+    batch_index = ""
+    if q0 == ALL_SEGMENTS:
+        batch_index = st.selectbox(
+            "Stack segments by:",
+            SEGMENT_COLUMNS
+        )
     q1 = st.radio("1. Would you like to use Accident years or Underwriting years?", ["Accident", "Underwriting"])
     q2 = st.radio("2. What type of analysis are you looking for?", ["Gross + RI", "Gross + Net", "Gross"])
     q3 = st.radio("3. Salvage and Subrogation applicable?", ["No", "Yes"])
@@ -398,6 +715,7 @@ elif st.session_state.step == 2:
 
     if "config" in globals() or "config" in locals():
         st.session_state.q0 = st.session_state.get("q0", q0)
+        st.session_state.batch_index = st.session_state.get("batch_index", batch_index)
         st.session_state.q1 = st.session_state.get("q1", q1)
         st.session_state.q2 = st.session_state.get("q2", q2)
         st.session_state.q3 = st.session_state.get("q3", q3)
@@ -417,6 +735,7 @@ elif st.session_state.step == 2:
         st.session_state.threshold = st.session_state.get("threshold", threshold)
     else:
         st.session_state.q0 = q0
+        st.session_state.batch_index = batch_index
         st.session_state.q1 = q1
         st.session_state.q2 = q2
         st.session_state.q3 = q3
@@ -465,6 +784,7 @@ elif st.session_state.step == 3:
     st.title("Step 2.5: Selected Configuration")
 
     q0 = st.session_state.get("q0", "")
+    batch_index = st.session_state.get("batch_index", "")
     q1 = st.session_state.get("q1", "Accident")
     q2 = st.session_state.get("q2", "Gross")
     q3 = st.session_state.get("q3", "No")
@@ -492,7 +812,7 @@ elif st.session_state.step == 3:
             "Reserving Methodology", "Development Period"
         ],
         "Selection": [
-            q0,
+            f"{q0} — by {batch_index}" if q0 == ALL_SEGMENTS else q0,
             q1,
             q2,
             "Yes — " + ss_choice3 if q3 == "Yes" else "No",
@@ -512,6 +832,29 @@ elif st.session_state.step == 3:
 
     st.table(df, border=True)
 
+    # Quarterly store: new Data Source Qtrs are appended as diagonals to
+    # this configuration's stored triangles
+    st.subheader("Quarterly triangle store")
+    plan = compile_plan(st.session_state)
+    processed = read_manifest(store_key(plan))["quarters"]
+    st.write("Quarters processed for this configuration: " + (", ".join(map(str, processed)) or "none"))
+
+    if st.button("Append new quarters of the loaded extract"):
+        try:
+            result = append_extract(plan, st.session_state.df, st.session_state.df_OS)
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            if result["added"]:
+                st.success("Added: " + ", ".join(map(str, result["added"])))
+            if result["rejected"]:
+                st.warning("Already processed, rows rejected: " + ", ".join(map(str, result["rejected"])))
+
+    source = st.session_state.get("triangle_source", TRIANGLE_SOURCES[0])
+    st.session_state.triangle_source = st.radio(
+        "Build triangles from:", TRIANGLE_SOURCES, index=TRIANGLE_SOURCES.index(source)
+    )
+
 
 
 
@@ -531,117 +874,8 @@ elif st.session_state.step == 4:
 
     
 
-    # All configuration filters below
-
-    st.session_state.alae_df = None
-    st.session_state.alae_triangle = None
-    st.session_state.large_claims_df = None
-    st.session_state.large_claims_triangle = None
-    st.session_state.ss_triangle = None
-    st.session_state.ri_triangle = None
-    st.session_state.net_ri_df = None
-
-    st.session_state.alae_df_OS = None
-    st.session_state.alae_triangle_OS = None
-    st.session_state.large_claims_df_OS = None
-    st.session_state.large_claims_triangle_OS = None
-    st.session_state.ss_triangle_OS = None
-    st.session_state.ri_triangle_OS = None
-    st.session_state.net_ri_df_OS = None
-
-
-
-    # 11 (Development Type)
-    st.session_state.grain = 'OMDM'
-    if st.session_state.q11 == 'Yearly':
-        st.session_state.grain =  'OYDY'
-    elif st.session_state.q11 == 'Quarterly':
-        st.session_state.grain =  'OQDQ'
-    
-    
-    # 0 (Segment)
-    filtered_df = st.session_state.df[(st.session_state.df["Line of Business"] == st.session_state.q0)]
-    filtered_df_OS = st.session_state.df_OS[(st.session_state.df_OS["Line of Business"] == st.session_state.q0)]
-
-    # 7 (ALAE)
-    if st.session_state.q7 == 'Yes' and st.session_state.ss_choice7 == 'Separate':
-        st.session_state.alae_df = filtered_df[filtered_df['Claim/LAE'] == 'LAE'].copy()
-        if st.session_state.q11 == 'Yearly':
-           st.session_state.alae_df['Payment Date'] = adjust_year_max_to_dec15(st.session_state.alae_df['Payment Date'])
-        #elif st.session_state.q11 == 'Quarterly':
-        #    st.session_state.alae_df['Payment Date'] = adjust_quarter_max_to_15th(st.session_state.alae_df['Payment Date'])           
-        filtered_df = filtered_df[filtered_df['Claim/LAE'] == 'Claim']
-        
-        st.session_state.alae_df_OS = filtered_df_OS[filtered_df_OS['Claim/LAE'] == 'LAE'].copy()
-        if st.session_state.q11 == 'Yearly':
-            st.session_state.alae_df_OS['Reporting Date'] = adjust_year_max_to_dec15(st.session_state.alae_df_OS['Reporting Date'])
-        filtered_df_OS = filtered_df_OS[filtered_df_OS['Claim/LAE'] == 'Claim']
-
-  
-    # 5 (Reopened)
-    if st.session_state.q5 == 'Yes' and st.session_state.ss_choice5 == 'Calculate IBNR separately':
-        st.session_state.reopen_df = filtered_df[filtered_df['Open/Closed/Reopen'] == 'Reopen'].copy()
-        filtered_df = filtered_df[filtered_df['Open/Closed/Reopen'] != 'Reopen']
-        
-        st.session_state.reopen_df_OS = filtered_df_OS[filtered_df_OS['Open/Closed/Reopen'] == 'Reopen'].copy()
-        filtered_df_OS = filtered_df_OS[filtered_df_OS['Open/Closed/Reopen'] != 'Reopen']
-        
-
-    # 4 (Large Claims)
-    if st.session_state.q4 == 'Yes':
-        if st.session_state.ss_choice4 == 'Cap Claims':
-            filtered_df['Gross Claim Amount Paid as at'] = filtered_df['Gross Claim Amount Paid as at'].apply(
-                lambda x: min(x, st.session_state.threshold)
-            )
-            
-            filtered_df_OS['Gross Claim Amount OS as at'] = filtered_df_OS['Gross Claim Amount OS as at'].apply(
-                lambda x: min(x, st.session_state.threshold)
-            )
-
-        elif st.session_state.ss_choice4 == 'Exclude Claims':
-            st.session_state.large_claims_df = filtered_df[filtered_df['Gross Claim Amount Paid as at'] > st.session_state.threshold].copy()
-            filtered_df = filtered_df[filtered_df['Gross Claim Amount Paid as at'] <= st.session_state.threshold]
-
-            st.session_state.large_claims_df_OS = filtered_df_OS[filtered_df_OS['Gross Claim Amount OS as at'] > st.session_state.threshold].copy()
-            filtered_df_OS = filtered_df_OS[filtered_df_OS['Gross Claim Amount OS as at'] <= st.session_state.threshold]
-
-
-    # 3 (Salvage and Subrogation)
-    option3_name = 'Gross'
-    if st.session_state.q3 == 'Yes' and st.session_state.ss_choice3 == 'Gross and SS separately':
-        filtered_df['SS'] = filtered_df['Recoveries'] + filtered_df['Subrogation (Individual)'] + filtered_df['Subrogation (Company)']
-        st.session_state.ss_triangle = cl.Triangle(data = filtered_df, origin = 'Accident/Treatment Date', development= 'Payment Date', columns = 'SS')
-        
-        filtered_df_OS['SS'] = filtered_df_OS['Recoveries'] + filtered_df_OS['Subrogation (Individual)'] + filtered_df_OS['Subrogation (Company)']
-        st.session_state.ss_triangle_OS = cl.Triangle(data = filtered_df_OS, origin = 'Accident/Treatment Date', development= 'Reporting Date', columns = 'SS')
-    
-    elif st.session_state.q3 == 'Yes' and st.session_state.ss_choice3 == 'Net of SS':
-        filtered_df['Gross Claim Amount Paid as at'] = filtered_df['Gross Claim Amount Paid as at'] - (filtered_df['Recoveries'] + filtered_df['Subrogation (Individual)'] + filtered_df['Subrogation (Company)'])
-
-        filtered_df_OS['Gross Claim Amount OS as at'] = filtered_df_OS['Gross Claim Amount OS as at'] - (filtered_df_OS['Recoveries'] + filtered_df_OS['Subrogation (Individual)'] + filtered_df_OS['Subrogation (Company)'])
-        
-        option3_name = 'Net of SS'
-
-
-    # 2 (Reinsurance)
-    if st.session_state.q2 == 'Gross + RI':
-        filtered_df['RI'] = filtered_df['RI Proportional'] + filtered_df['RI Non Proportional']
-        st.session_state.ri_triangle = cl.Triangle(data = filtered_df, origin = 'Accident/Treatment Date', development= 'Payment Date', columns = 'RI')
-
-        filtered_df_OS['RI'] = filtered_df_OS['RI Proportional'] + filtered_df_OS['RI Non Proportional']
-        st.session_state.ri_triangle_OS = cl.Triangle(data = filtered_df_OS, origin = 'Accident/Treatment Date', development= 'Reporting Date', columns = 'RI')
-
-    elif st.session_state.q2 == 'Gross + Net':
-        st.session_state.net_ri_df = filtered_df.copy()
-        st.session_state.net_ri_df['Gross Claim Amount Paid as at'] = filtered_df['Gross Claim Amount Paid as at'] - (filtered_df['RI Proportional'] + filtered_df['RI Non Proportional'])
-    
-        st.session_state.net_ri_df_OS = filtered_df_OS.copy()
-        st.session_state.net_ri_df_OS['Gross Claim Amount OS as at'] = filtered_df_OS['Gross Claim Amount OS as at'] - (filtered_df_OS['RI Proportional'] + filtered_df_OS['RI Non Proportional'])
-    
-
-    st.session_state.option3_name = option3_name
-    st.session_state.filtered_df = filtered_df
-    st.session_state.filtered_df_OS = filtered_df_OS
+    # All configuration filters, compiled into one plan (see ensure_prepared)
+    ensure_prepared()
     #st.session_state.filtered_df = st.session_state.df[(st.session_state.df["Line of Business"] == st.session_state.q0) & (st.session_state.df["Claim/LAE"] == "Claim")]
     
     #triangle = cl.Triangle(data = filtered_df, origin = "Accident/Treatment Date", development = "Payment Date", columns = "Gross Claim Amount Paid as at" ,is_cumulative = False)
@@ -650,161 +884,43 @@ elif st.session_state.step == 4:
     #triangle = triangle.grain(st.session_state.grain)
     #st.session_state.sheet3_triangle = triangle.cum_to_incr()
     #st.session_state.sheet3_df = st.session_state.sheet3_triangle.to_frame(origin_as_datetime = False)
-    #st.session_state.sheet3_df = format_numeric(st.session_state.sheet3_df)
     #st.dataframe(st.session_state.sheet3_df)
 
 
-    # build a dict of possible objects (use the keys you want shown)
-    candidates = {
-        st.session_state.option3_name: st.session_state.get("filtered_df"),
-        "ALAE": st.session_state.get("alae_df"),
-        "Reopened Claims": st.session_state.get("reopen_df"),
-        "Large Claims": st.session_state.get("large_claims_df"),
-        "SS": st.session_state.get("ss_triangle"),
-        "RI": st.session_state.get("ri_triangle"),
-        "Net of RI": st.session_state.get("net_ri_df"),
-    }
-
-    # keep only non-None entries
-    available = {name: obj for name, obj in candidates.items() if obj is not None}
-
-    # handle case where nothing is available
-    if not available:
-        st.sidebar.info("No dataframes or triangles available to display.")
-    else:
-        choice = st.sidebar.selectbox("Choose dataset to view", list(available.keys()))
-        obj = available[choice]
+    # Only the chosen dataset (and its OS counterpart) is ever materialized
+    entry = choose_dataset()
+    if entry is not None:
+        paid_spec, os_spec = entry["paid"], entry["os"]
+        segment = choose_segment()
+        show_incurred = st.session_state.q10 == "Paid + Incurred" and os_spec is not None
+        cache = st.session_state.triangle_cache
+        grain = st.session_state.grain
 
-        # ---- Find corresponding _OS version ----
-        obj_OS = None
-        original_key = next((k for k, v in st.session_state.items() if v is obj), None)
-        if original_key:
-            obj_OS = st.session_state.get(original_key + "_OS")
-
-
-        if hasattr(obj, "columns") and hasattr(obj, "dtypes"):
-            obj = cl.Triangle(data = obj, origin = "Accident/Treatment Date", development = "Payment Date", columns = "Gross Claim Amount Paid as at" )
-            
-
-        # If it's a triangle-like object, convert to frame; otherwise assume it's already a DataFrame
-        if hasattr(obj, "to_frame"):
-            obj.is_cumulative = False
-            obj = obj.grain(st.session_state.grain)
-            obj_temp1 = obj.copy()
-            obj.development = pd.Index([i+1 for i in range(obj.development.size)]) # Make column names the same
-            obj_temp = obj.copy()
-            df_to_show = obj.to_frame(origin_as_datetime=False)
-            df_to_show3 = obj_temp1.to_frame(origin_as_datetime=False)
-        else:
-            df_to_show = obj.copy() if hasattr(obj, "copy") else obj
+        # Paid, OS and Incurred with development relabelled 1..n, as columns of one triangle
+        fused = fused_view(cache, entry, grain)
+        tri_to_show3 = triangle_view(cache, paid_spec, grain)
+        tri_to_show = fused[PAID]
 
 
         # OS Conditional
-        if st.session_state.q10 == "Paid + Incurred":    
-            if hasattr(obj_OS, "columns") and hasattr(obj_OS, "dtypes"):
-                obj_OS = cl.Triangle(data = obj_OS, origin = "Accident/Treatment Date", development = "Reporting Date", columns = "Gross Claim Amount OS as at" ,is_cumulative = False)
-
-            # If it's a triangle-like object, convert to frame; otherwise assume it's already a DataFrame
-            if hasattr(obj_OS, "to_frame"):
-                obj_OS.is_cumulative = False
-                obj_OS = obj_OS.grain(st.session_state.grain)
-                obj_OS_temp = obj_OS.copy()
-                obj_OS.development = pd.Index([i+1 for i in range(obj_OS.development.size)])
-                obj_Incurred = obj_OS + obj_temp # This is where OS becomes incurred
-                df_to_show_OS = obj_OS.to_frame(origin_as_datetime=False)
-                df_to_show_Incurred = obj_Incurred.to_frame(origin_as_datetime=False)
-                df_to_show_OS_temp = obj_OS_temp.to_frame(origin_as_datetime=False)
-                #df_to_show_OS = df_to_show_OS + df_to_show
-            else:
-                df_to_show_OS = obj_OS.copy() if hasattr(obj_OS, "copy") else obj_OS
+        if show_incurred:
+            tri_to_show_OS_temp = triangle_view(cache, os_spec, grain)
+            tri_to_show_OS = fused[OS]
+            tri_to_show_Incurred = fused[INCURRED] # This is where OS becomes incurred
 
 
-        # Optional: format numeric columns if you have a helper
-        try:
-            df_to_show = format_numeric_nans(df_to_show)
-            df_to_show3 = format_numeric_nans(df_to_show3)
-            if st.session_state.q10 == "Paid + Incurred":
-                df_to_show_OS = format_numeric_nans(df_to_show_OS)
-                df_to_show_OS_temp = format_numeric_nans(df_to_show_OS_temp)
-                df_to_show_Incurred = format_numeric_nans(df_to_show_Incurred) 
-        except Exception:
-            pass
-
-        st.title('Paid ChainLadder')
-        st.dataframe(
-            df_to_show3,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show3.columns
-            }
-        )
-
-        st.title('Paid Modified')
-        st.dataframe(
-            df_to_show,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show.columns
-            }
-        )
+        show_triangle('Paid ChainLadder', tri_to_show3, segment)
 
-        if st.session_state.q10 == "Paid + Incurred":
-            st.title('OS ChainLadder')
-            st.dataframe(
-            df_to_show_OS_temp,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show_OS_temp.columns
-            }            
-        )
-            
-            
-            st.title('OS Modified')
-            st.dataframe(
-            df_to_show_OS,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show_OS.columns
-            }
-        )   
-
-            st.title('Incurred')
-            st.dataframe(
-            df_to_show_Incurred,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show_Incurred.columns
-            }
-        )        
-
-    # Initialize in-memory comments list
-    if "comments" not in st.session_state:
-        st.session_state.comments = []
-
-    users = ["Primary", "Reviewer", "Appointed Actuary"]
-    selected_user = st.selectbox("Select User", users)
+        show_triangle('Paid Modified', tri_to_show, segment)
 
-    comment_text = st.text_area("Write your comment:")
+        if show_incurred:
+            show_triangle('OS ChainLadder', tri_to_show_OS_temp, segment)
 
-    if st.button("Submit"):
-        if comment_text.strip():
-            st.session_state.comments.append({
-                "user": selected_user,
-                "text": comment_text,
-                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
-            st.success("Comment added!")
-        else:
-            st.warning("Comment cannot be empty.")
+            show_triangle('OS Modified', tri_to_show_OS, segment)
 
-    # Show comments (in-memory only)
-    st.subheader("All Comments")
+            show_triangle('Incurred', tri_to_show_Incurred, segment)
 
-    if st.session_state.comments:
-        for c in st.session_state.comments:
-            st.write(f"**{c['user']}** ({c['time']}): {c['text']}")
-    else:
-        st.write("No comments yet.")
+    comment_box(3, entry["label"] if entry else "", segment if entry else None)
 
 
     col1, col2 = st.columns(2)
@@ -822,133 +938,39 @@ elif st.session_state.step == 4:
 elif st.session_state.step == 5:
     st.title('Step 4: Cummulative Triangles')
 
-    # build a dict of possible objects (use the keys you want shown)
-    candidates = {
-        st.session_state.option3_name: st.session_state.get("filtered_df"),
-        "ALAE": st.session_state.get("alae_df"),
-        "Reopened Claims": st.session_state.get("reopen_df"),
-        "Large Claims": st.session_state.get("large_claims_df"),
-        "SS": st.session_state.get("ss_triangle"),
-        "RI": st.session_state.get("ri_triangle"),
-        "Net of RI": st.session_state.get("net_ri_df"),
-    }
+    # Also reached straight from a reopened snapshot
+    ensure_prepared()
 
-    # keep only non-None entries
-    available = {name: obj for name, obj in candidates.items() if obj is not None}
+    # Only the chosen dataset (and its OS counterpart) is ever materialized
+    entry = choose_dataset()
+    if entry is not None:
+        paid_spec, os_spec = entry["paid"], entry["os"]
+        segment = choose_segment()
+        show_incurred = st.session_state.q10 == "Paid + Incurred" and os_spec is not None
+        cache = st.session_state.triangle_cache
+        grain = st.session_state.grain
 
-    # handle case where nothing is available
-    if not available:
-        st.sidebar.info("No dataframes or triangles available to display.")
-    else:
-        choice = st.sidebar.selectbox("Choose dataset to view", list(available.keys()))
-        obj = available[choice]
-
-        # ---- Find corresponding _OS version ----
-        obj_OS = None
-        original_key = next((k for k, v in st.session_state.items() if v is obj), None)
-        if original_key:
-            obj_OS = st.session_state.get(original_key + "_OS")
-
-
-        if hasattr(obj, "columns") and hasattr(obj, "dtypes"):
-            obj = cl.Triangle(data = obj, origin = "Accident/Treatment Date", development = "Payment Date", columns = "Gross Claim Amount Paid as at" ,is_cumulative = False)
-
-        # If it's a triangle-like object, convert to frame; otherwise assume it's already a DataFrame
-        if hasattr(obj, "to_frame"):
-            obj.is_cumulative = False
-            obj = obj.incr_to_cum()
-            obj = obj.grain(st.session_state.grain)
-            obj.development = pd.Index([i+1 for i in range(obj.development.size)])
-            obj_temp = obj.copy()
-
-            df_to_show = obj.to_frame(origin_as_datetime=False)
-        else:
-            df_to_show = obj.copy() if hasattr(obj, "copy") else obj
+        fused = fused_view(cache, entry, grain, cumulative=True)
+        tri_to_show = fused[PAID]
 
 
         # OS Conditional
-        if st.session_state.q10 == "Paid + Incurred":    
-            if hasattr(obj_OS, "columns") and hasattr(obj_OS, "dtypes"):
-                obj_OS = cl.Triangle(data = obj_OS, origin = "Accident/Treatment Date", development = "Reporting Date", columns = "Gross Claim Amount OS as at" ,is_cumulative = False)
-
-            # If it's a triangle-like object, convert to frame; otherwise assume it's already a DataFrame
-            if hasattr(obj_OS, "to_frame"):
-                obj_OS.is_cumulative = False
-                obj_OS = obj_OS.grain(st.session_state.grain)
-                obj_OS.development = pd.Index([i+1 for i in range(obj_OS.development.size)])
-                obj_Incurred = obj_OS + obj_temp # This is where OS becomes incurred
-                df_to_show_OS = obj_OS.to_frame(origin_as_datetime=False)
-                df_to_show_Incurred = obj_Incurred.to_frame(origin_as_datetime=False)
-                #df_to_show_OS = df_to_show_OS + df_to_show
-            else:
-                df_to_show_OS = obj_OS.copy() if hasattr(obj_OS, "copy") else obj_OS
-
+        if show_incurred:
+            tri_to_show_OS = fused[OS] # OS is never cumulated
+            tri_to_show_Incurred = fused[INCURRED] # This is where OS becomes incurred
 
-        # Optional: format numeric columns if you have a helper
-        try:
-            df_to_show = format_numeric_nans(df_to_show)
-            if st.session_state.q10 == "Paid + Incurred":
-                df_to_show_Incurred = format_numeric_nans(df_to_show_Incurred)
-                df_to_show_OS = format_numeric_nans(df_to_show_OS)
-        except Exception:
-            pass
 
-        st.title('Paid')
-        st.dataframe(
-            df_to_show,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show.columns
-            }
-        )
+        show_triangle('Paid', tri_to_show, segment)
 
-        if st.session_state.q10 == "Paid + Incurred":
-            st.title('OS')
-            st.dataframe(
-            df_to_show_OS,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show_OS.columns
-            }
-        )        
+        if show_incurred:
+            show_triangle('OS', tri_to_show_OS, segment)
             
-            st.title('Incurred')
-            st.dataframe(
-            df_to_show_Incurred,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show_Incurred.columns
-            }
-        )        
-    
-    # Initialize in-memory comments list
-    if "comments" not in st.session_state:
-        st.session_state.comments = []
-
-    users = ["Primary", "Reviewer", "Appointed Actuary"]
-    selected_user = st.selectbox("Select User", users)
-
-    comment_text = st.text_area("Write your comment:")
+            show_triangle('Incurred', tri_to_show_Incurred, segment)
 
-    if st.button("Submit"):
-        if comment_text.strip():
-            st.session_state.comments.append({
-                "user": selected_user,
-                "text": comment_text,
-                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
-            st.success("Comment added!")
-        else:
-            st.warning("Comment cannot be empty.")
-
-    # Show comments (in-memory only)
-    st.subheader("All Comments")
-
-    if st.session_state.comments:
-        for c in st.session_state.comments:
-            st.write(f"**{c['user']}** ({c['time']}): {c['text']}")
-    else:
-        st.write("No comments yet.")
+        if st.session_state.q6 == "Earned Premiums" and PREMIUM in fused.columns:
+            show_triangle('Earned Premiums', fused[PREMIUM], segment)
+    
+    comment_box(4, entry["label"] if entry else "", segment if entry else None)
 
 
     col1, col2 = st.columns(2)
@@ -965,211 +987,174 @@ elif st.session_state.step == 5:
 # ============================================================
 elif st.session_state.step == 6:
     st.title('Step 5: Ratios and Averages')
-    st.title('Link Ratios')
 
-    # build a dict of possible objects (use the keys you want shown)
-    candidates = {
-        st.session_state.option3_name: st.session_state.get("filtered_df"),
-        "ALAE": st.session_state.get("alae_df"),
-        "Reopened Claims": st.session_state.get("reopen_df"),
-        "Large Claims": st.session_state.get("large_claims_df"),
-        "SS": st.session_state.get("ss_triangle"),
-        "RI": st.session_state.get("ri_triangle"),
-        "Net of RI": st.session_state.get("net_ri_df"),
-    }
+    # Also reached straight from a reopened snapshot
+    ensure_prepared()
+    st.title('Link Ratios')
 
-    # keep only non-None entries
-    available = {name: obj for name, obj in candidates.items() if obj is not None}
+    # Only the chosen dataset (and its OS counterpart) is ever materialized
+    entry = choose_dataset()
+    if entry is not None:
+        paid_spec, os_spec = entry["paid"], entry["os"]
+        segment = choose_segment()
+        show_incurred = st.session_state.q10 == "Paid + Incurred" and os_spec is not None
+        cache = st.session_state.triangle_cache
+        grain = st.session_state.grain
 
-    # handle case where nothing is available
-    if not available:
-        st.sidebar.info("No dataframes or triangles available to display.")
-    else:
-        choice = st.sidebar.selectbox("Choose dataset to view", list(available.keys()))
-        obj = available[choice]
-
-        # ---- Find corresponding _OS version ----
-        obj_OS = None
-        original_key = next((k for k, v in st.session_state.items() if v is obj), None)
-        if original_key:
-            obj_OS = st.session_state.get(original_key + "_OS")
-
-
-        if hasattr(obj, "columns") and hasattr(obj, "dtypes"):
-            obj = cl.Triangle(data = obj, origin = "Accident/Treatment Date", development = "Payment Date", columns = ["Gross Claim Amount Paid as at", "Earned Premiums"] ,is_cumulative = False)
-
-        # If it's a triangle-like object, convert to frame; otherwise assume it's already a DataFrame
-        if hasattr(obj, "to_frame"):
-            obj.is_cumulative = False
-            obj = obj.incr_to_cum()
-            obj = obj.grain(st.session_state.grain)
-            obj.development = pd.Index([i+1 for i in range(obj.development.size)])
-            #obj.valuation = 
-            obj_paid_copy = obj.copy()
-            if choice == 'RI':
-                obj_temp = obj['RI'].copy()
-                obj = obj['RI'].link_ratio
-            elif choice == 'SS':
-                obj_temp = obj['SS'].copy()
-                obj = obj['SS'].link_ratio
-            else:
-                obj_temp = obj['Gross Claim Amount Paid as at'].copy()
-                obj = obj['Gross Claim Amount Paid as at'].link_ratio
-            df_to_show = obj.to_frame(origin_as_datetime=False)
-        else:
-            df_to_show = obj.copy() if hasattr(obj, "copy") else obj
+        # Link ratios of the cumulative Paid and Incurred columns of the fused triangle
+        link_ratios = fused_link_ratio_view(cache, entry, grain)
+        tri_to_show = link_ratios[PAID]
 
 
         # OS Conditional
-        if st.session_state.q10 == "Paid + Incurred":    
-            if hasattr(obj_OS, "columns") and hasattr(obj_OS, "dtypes"):
-                obj_OS = cl.Triangle(data = obj_OS, origin = "Accident/Treatment Date", development = "Reporting Date", columns = ["Gross Claim Amount OS as at","Earned Premiums"] ,is_cumulative = False)
-
-            # If it's a triangle-like object, convert to frame; otherwise assume it's already a DataFrame
-            if hasattr(obj_OS, "to_frame"):
-                obj_OS.is_cumulative = False
-                obj_OS = obj_OS.grain(st.session_state.grain)
-                os_dev = obj_OS.development
-                obj_OS.development = pd.Index([i+1 for i in range(obj_OS.development.size)])
-                if choice == 'RI':
-                    obj_Incurred =  obj_OS['RI'] + obj_temp # This is where OS becomes incurred
-                elif choice == 'SS':
-                    obj_Incurred =  obj_OS['SS'] + obj_temp # This is where OS becomes incurred
-                else:
-                    obj_Incurred =  obj_OS['Gross Claim Amount OS as at'] + obj_temp # This is where OS becomes incurred
-                obj_Incurred.is_cumulative = True # Necessary for proper averages
-
-                # # Step 1: find the minimum valuation date
-                # min_val_date = obj_Incurred.valuation.min()
-
-                # dev_numbers = []
-                # # Step 2: loop over origin years
-                # for year in obj_Incurred.origin:
-                #     # filter valuations for this year
-                #     vals_this_year = obj_Incurred.valuation[(obj_Incurred.valuation).year == year]
-                #     if len(vals_this_year) == 0:
-                #         dev_numbers.append(None)  # or np.nan
-                #         continue
-
-                #     # Step 3: get the max month for that year
-                #     max_date = vals_this_year.max()
-
-                #     # Step 4: compute month distance from min_val_date
-                #     diff_months = (max_date.year - min_val_date.year) * 12 + (max_date.month - min_val_date.month + 1)
-                #     dev_numbers.append(diff_months)
-
-                # # Step 5: assign to obj_Incurred.development
-                # #obj_Incurred.development = dev_numbers
-
-                obj_Incurred1 = obj_Incurred.copy()
-                obj_Incurred = obj_Incurred.link_ratio
-                df_to_show_Incurred = obj_Incurred.to_frame(origin_as_datetime=False)
-            else:
-                df_to_show_OS = obj_OS.copy() if hasattr(obj_OS, "copy") else obj_OS
+        if show_incurred:
+            tri_to_show_Incurred = link_ratios[INCURRED]
 
 
-        # Optional: format numeric columns if you have a helper
-        try:
-            df_to_show = format_four_decimals(df_to_show)
-            if st.session_state.q10 == "Paid + Incurred":
-                df_to_show_Incurred = format_four_decimals(df_to_show_Incurred)
-        except Exception:
-            pass
+        show_triangle('Paid', tri_to_show, segment, decimals=4)
 
-        st.title('Paid')
-        st.dataframe(
-            df_to_show,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show.columns
-            }
-        )
 
+        # Every method and window is fitted once per triangle; choosing one is a lookup
+        grid = ldf_grid_view(cache, entry, grain)
+        ldf_selection(grid, PAID, segment, key="paid")
 
-        # n_periods1 = st.number_input(
-        # "Select number of periods:",
-        # min_value=1,
-        # max_value=20,
-        # value=2,
-        # step=1
-        # )
+        if show_incurred:
+            
+            show_triangle('Incurred', tri_to_show_Incurred, segment, decimals=4)
 
-        avg_method1 = st.selectbox(
-        "Select averaging method:",
-        options=["simple", "regression", "volume"], 
-        index=0
-        )
+            ldf_selection(grid, INCURRED, segment, key="incurred")
 
-        if st.button("Calculate LDF", key = 'avg_method1'):
-            #st.write(obj_paid_copy.values.shape)  
-            #obj_Incurred1 = obj_Incurred1.iloc[:, :, (n_periods):4, :]
-            #st.write(obj_Incurred1.values.shape)
-            #st.write(obj_Incurred1)  
-
-            #dev = obj_Incurred1.development.values[-2:]
-            #obj_trim = obj_Incurred1.sel(development=dev)
-
-            #st.write(obj_paid_copy['Gross Claim Amount Paid as at'].valuation)
-            #st.write(obj_paid_copy['Gross Claim Amount Paid as at'].valuation_date)
-            #st.write(obj_paid_copy['Gross Claim Amount Paid as at'].origin)
-            if choice == 'RI':
-                model = cl.Development(average=avg_method1).fit(obj_paid_copy['RI']).ldf_
-            elif choice == 'SS':
-                model = cl.Development(average=avg_method1).fit(obj_paid_copy['SS']).ldf_
-            else:
-                model = cl.Development(average=avg_method1).fit(obj_paid_copy['Gross Claim Amount Paid as at']).ldf_
-            obj_avg = model.to_frame()
 
-            st.subheader("Calculated LDF:")
-            st.dataframe(obj_avg)    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("⬅ Back", on_click=previous_step)
+    with col2:
+        st.button("Next ➜", on_click=next_step)
 
-        if st.session_state.q10 == "Paid + Incurred":
-            
-            st.title('Incurred')
-            st.dataframe(
-            df_to_show_Incurred,
-            column_config={
-                col: st.column_config.TextColumn(width="small")
-                for col in df_to_show_Incurred.columns
-            }
-        )        
-
-
-            # n_periods2 = st.number_input(
-            #    "Select number of periods:",
-            #    min_value=1,
-            #    max_value=20,
-            #    value=2,
-            #    step=1, key = 'n2'
-            # )
-
-            avg_method2 = st.selectbox(
-            "Select averaging method:",
-            options=["simple", "regression", "volume"],  # add any others supported by chainladder
-            index=0,
-            key = 'a2'
-            )
-        
 
-            if st.button("Calculate LDF", key = 'avg_method2'):
-                #st.write(obj_Incurred1.shape)  
-                #obj_Incurred1 = obj_Incurred1.iloc[:, :, (n_periods):4, :]
-                #st.write(obj_Incurred1.values.shape)
-                #st.write(obj_Incurred1)  
+# ============================================================
+#                       STEP 6
+# ============================================================
+elif st.session_state.step == 7:
+    st.title('Step 6: Reserves')
+
+    # Also reached straight from a reopened snapshot
+    ensure_prepared()
 
-                #dev = obj_Incurred1.development.values[-2:]
-                #obj_trim = obj_Incurred1.sel(development=dev)
+    catalog = current_catalog()
+    if not catalog:
+        st.info("No dataframes or triangles available to display.")
+    else:
+        segment = choose_segment()
+        cache = st.session_state.triangle_cache
+        grain = st.session_state.grain
+
+        st.caption("Chain ladder of the Step 4 cumulative triangles with volume-weighted LDFs over all "
+                   "periods, fitted for every dataset and segment at once.")
+        mack = st.checkbox("Include Mack standard errors", value=False)
+        totals, origins = reserve_view(cache, catalog, grain, mack)
+        if st.session_state.q10 != "Paid + Incurred":
+            totals = totals[totals.index.get_level_values("Column") == PAID]
+            origins = origins[origins.index.get_level_values("Column") == PAID]
+
+        amount = number_column()
+        column_config = {column: amount for column in totals.columns if column != "CV"}
+        column_config["CV"] = st.column_config.NumberColumn(format="%.3f")
+
+        st.subheader("Reserves by dataset:")
+        st.dataframe(totals, column_config=column_config)
+
+        # Every dataset was fitted above; picking one only slices the result
+        entry = choose_dataset()
+        if entry is not None:
+            st.subheader(f"{entry['label']} by origin:")
+            if not missing_segment(origins.index.get_level_values(0).unique(), segment):
+                rows = origins.xs(segment if segment is not None else origins.index[0][0], level=0)
+                st.dataframe(rows.xs(entry["label"], level="Dataset"), column_config=column_config)
 
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("⬅ Back", on_click=previous_step)
+    with col2:
+        st.button("Next ➜", on_click=next_step)
 
-                model = cl.Development(average=avg_method2).fit(obj_Incurred1).ldf_
-                obj_avg = model.to_frame()
 
-                st.subheader("Calculated LDF:")
-                st.dataframe(obj_avg)                  
-            
+# ============================================================
+#                       STEP 7
+# ============================================================
+elif st.session_state.step == 8:
+    st.title('Step 7: Reserve Ranges')
+
+    # Also reached straight from a reopened snapshot
+    ensure_prepared()
+
+    # Only the chosen dataset (and its OS counterpart) is ever materialized
+    entry = choose_dataset()
+    if entry is not None:
+        segment = choose_segment()
+        show_incurred = st.session_state.q10 == "Paid + Incurred" and entry["os"] is not None
+        cache = st.session_state.triangle_cache
+        grain = st.session_state.grain
+
+        st.caption("Over-dispersed Poisson bootstrap of the Step 4 cumulative triangles, "
+                   "chain ladder with volume-weighted LDFs over all periods. The model expects "
+                   "mostly positive increments; negative ones (common in Incurred) widen the ranges.")
+        col1, col2, col3 = st.columns(3)
+        n_sims = int(col1.number_input("Number of simulations:", min_value=100, max_value=100_000,
+                                       value=1000, step=1000))
+        seed = int(col2.number_input("Random seed:", min_value=0, value=0, step=1))
+        process = col3.checkbox("Include process variance", value=True)
+        params = (entry["paid"]["key"], entry["os"] and entry["os"]["key"], grain, n_sims, seed, process)
+
+        if st.button("Run simulations"):
+            bar = st.progress(0.0, text="Simulating...")
+            ranges = bootstrap_view(cache, entry, grain, n_sims, seed, process,
+                                    progress=lambda done, total: bar.progress(done / total, text=f"Simulating... {done}/{total} chunks"))
+            bar.empty()
+            # Kept with the session rather than only in the triangle cache,
+            # which may evict it: a rerun must not simulate again unasked
+            st.session_state.bootstrap = {"params": params, "ranges": ranges}
+
+        # Results of the last run stay on screen until an input changes
+        bootstrap = st.session_state.get("bootstrap")
+        if bootstrap is not None and bootstrap["params"] == params:
+            ranges = bootstrap["ranges"]
+            st.subheader("Reserve distribution:")
+            if not missing_segment(ranges.index.get_level_values(0).unique(), segment):
+                ranges = ranges.xs(segment if segment is not None else ranges.index[0][0], level=0)
+                if not show_incurred:
+                    ranges = ranges.loc[[PAID]]
+                amount = number_column()
+                st.dataframe(ranges, column_config={
+                    column: amount for column in ranges.columns if column not in ("Simulations", "CV")
+                } | {"CV": st.column_config.NumberColumn(format="%.3f")})
 
     col1, col2 = st.columns(2)
     with col1:
         st.button("⬅ Back", on_click=previous_step)
     with col2:
-        st.button("Finish")
\ No newline at end of file
+        st.button("Finish")
+
+
+# Steps 3 onwards have prepared the catalog of the current configuration
+if st.session_state.step >= 4 and st.session_state.get("catalog"):
+    export_buttons()
+
+# Derived objects built during this rerun count against the budget from now on
+enforce_memory_budget()
+end_run()
+
+if profiling_on:
+    profile = st.session_state.profile
+    seconds = st.column_config.NumberColumn(format="%.3f")
+    with profiling_panel:
+        st.caption(f"{profile['runs']} script runs; per step: "
+                   + ", ".join(f"{step}: {runs}" for step, runs in sorted(profile["reruns"].items())))
+        st.dataframe(stage_table(profile), column_config={
+            "Total (s)": seconds, "Mean (s)": seconds, "Max (s)": seconds,
+            "Peak MB": st.column_config.NumberColumn(format="%.1f"),
+        })
+        if profile["cache"]:
+            st.dataframe(cache_table(profile), column_config={"Hit rate (%)": st.column_config.NumberColumn(format="%.0f")})
+        st.download_button("Download trace", trace_json(profile), file_name="triangles-trace.json",
+                           mime="application/json", help="Chrome trace format, for chrome://tracing or Perfetto")
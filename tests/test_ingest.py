@@ -0,0 +1,82 @@
+import io
+import os
+import zipfile
+
+import pandas as pd
+import pytest
+
+from ingest import (OS_SHEET, PAID_SHEET, _shared_strings, apply_filters, apply_schema, has_store, iter_sheet_rows,
+                    list_segments, read_segment, read_workbook, write_store)
+
+SAMPLE = os.path.join(os.path.dirname(__file__), os.pardir, "Test_file.xlsx")
+
+MAIN = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+
+SHARED_STRINGS = f"""<?xml version="1.0" encoding="UTF-8"?>
+<sst {MAIN} count="2" uniqueCount="2">
+  <si><t>Motor</t></si>
+  <si><r><t>東京</t></r><r><t>都</t></r><rPh sb="0" eb="2"><t>トウキョウ</t></rPh><phoneticPr fontId="1"/></si>
+</sst>"""
+
+SHEET = f"""<?xml version="1.0" encoding="UTF-8"?>
+<worksheet {MAIN}><sheetData>
+  <row r="1">
+    <c r="A1" t="s"><v>0</v></c>
+    <c r="B1" t="s"><v>1</v></c>
+    <c r="C1" t="inlineStr"><is><t>大阪</t><rPh sb="0" eb="2"><t>オオサカ</t></rPh></is></c>
+    <c r="E1"><v>1.5</v></c>
+  </row>
+</sheetData></worksheet>"""
+
+
+def _zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for name, text in members.items():
+            zf.writestr(name, text)
+    return zipfile.ZipFile(buffer)
+
+
+def test_phonetic_hints_are_not_part_of_strings():
+    zf = _zip({"xl/sharedStrings.xml": SHARED_STRINGS, "xl/worksheets/sheet1.xml": SHEET})
+    strings = _shared_strings(zf)
+    assert strings == ["Motor", "東京都"]
+
+    rows = list(iter_sheet_rows(zf, "xl/worksheets/sheet1.xml", strings))
+    assert rows == [{0: "Motor", 1: "東京都", 2: "大阪", 4: 1.5}]
+    # Columns left out are skipped
+    assert list(iter_sheet_rows(zf, "xl/worksheets/sheet1.xml", strings, wanted={2})) == [{2: "大阪"}]
+
+
+def test_streaming_reader_matches_pandas():
+    with open(SAMPLE, "rb") as f:
+        raw = f.read()
+    df_paid, df_OS = read_workbook(raw)
+
+    sheets = pd.read_excel(io.BytesIO(raw), sheet_name=[PAID_SHEET, OS_SHEET])
+    for df, expected in ((df_paid, sheets[PAID_SHEET]), (df_OS, sheets[OS_SHEET])):
+        expected = apply_schema(expected[list(df.columns)])
+        pd.testing.assert_frame_equal(df.reset_index(drop=True), expected, check_categorical=False)
+
+
+def test_store_reads_what_filtering_in_memory_gives(tmp_path, monkeypatch):
+    with open(SAMPLE, "rb") as f:
+        df_paid, df_OS = read_workbook(f.read())
+    monkeypatch.chdir(tmp_path)     # the store under .cache
+    write_store("sample", df_paid, df_OS)
+    assert has_store("sample")
+
+    segments = list_segments("sample")
+    assert segments == sorted(df_paid["Line of Business"].unique())
+    filters = [("Claim/LAE", "==", "Claim"), ("Data Source Qtr", "in", ["2021Q1", "2021Q2"])]
+    read = 0
+    for segment in segments:
+        for sheet, df in (("Paid", df_paid), ("OS", df_OS)):
+            got = read_segment("sample", sheet, segment, filters)
+            expected = apply_filters(df, [("Line of Business", "==", segment)] + filters)
+            assert len(got) == len(expected)
+            read += len(got)
+            for column in ("Gross Claim Amount Paid as at", "Gross Claim Amount OS as at"):
+                if column in expected.columns:
+                    assert got[column].sum() == pytest.approx(expected[column].sum())
+    assert read
@@ -0,0 +1,18 @@
+import chainladder as cl
+import numpy as np
+import pytest
+
+from ldf_grid import ALL_PERIODS, METHODS, ldf_grid
+
+
+@pytest.mark.parametrize("sample", ["raa", "genins", "ukmotor"])
+def test_grid_matches_chainladder_development(sample):
+    tri = cl.load_sample(sample)
+    grid = ldf_grid(tri)
+
+    for method in METHODS:
+        for periods in grid.index.get_level_values("Periods").unique():
+            n_periods = -1 if periods == ALL_PERIODS else int(periods)
+            expected = np.asarray(cl.Development(average=method, n_periods=n_periods).fit(tri).ldf_.values)[0, 0, 0]
+            ldfs = grid.xs((method, periods), level=("Method", "Periods")).to_numpy()[0]
+            np.testing.assert_allclose(ldfs, expected, rtol=1e-12, err_msg=f"{method}, {periods} periods")
@@ -0,0 +1,66 @@
+import chainladder as cl
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocess import DEVELOPMENT_COLUMNS
+from reserves import reserve_summary
+from triangles import ORIGIN_COLUMN, PAID, dataset_spec, reserve_view
+
+SEGMENT = "Line of Business"
+PAYMENT = DEVELOPMENT_COLUMNS["Paid"]
+
+
+def _rows(segments):
+    # Three yearly origins developing over three years, per segment
+    rows = []
+    for s, segment in enumerate(segments):
+        for origin in range(3):
+            for lag in range(3 - origin):
+                rows.append({
+                    SEGMENT: segment,
+                    ORIGIN_COLUMN: pd.Timestamp(2020 + origin, 6, 30),
+                    PAYMENT: pd.Timestamp(2020 + origin + lag, 6, 30),
+                    "Amount": 1000.0 * (s + 1) / (lag + 1),
+                })
+    return pd.DataFrame(rows)
+
+
+def _entry(name, label, rows):
+    return {
+        "name": name,
+        "label": label,
+        "measure": "Amount",
+        "sources": ["Amount"],
+        "development": dict(DEVELOPMENT_COLUMNS),
+        "paid": dataset_spec(name + "-Paid", lambda: rows, PAYMENT, "Amount", SEGMENT),
+        "os": None,
+    }
+
+
+def test_one_segment_dataset_stays_in_its_segment():
+    catalog = {
+        "filtered_df": _entry("filtered_df", "Gross", _rows(["Auto", "Fire", "Health"])),
+        "large_claims_df": _entry("large_claims_df", "Large Claims", _rows(["Health"])),
+    }
+    totals, _ = reserve_view({}, catalog, "OYDY")
+
+    large = totals.xs(("Large Claims", PAID), level=("Dataset", "Column"))
+    gross = totals.xs(("Gross", PAID), level=("Dataset", "Column"))
+    # Health is the third segment of the gross rows but the only one here
+    assert large.loc["Health", "Latest"] == pytest.approx(1000.0 * (1 + 1 / 2 + 1 / 3) + 1000.0 * (1 + 1 / 2) + 1000.0)
+    assert np.isnan(large.loc[["Auto", "Fire"], "Latest"]).all()
+    assert gross.loc["Health", "Latest"] == pytest.approx(3 * large.loc["Health", "Latest"])
+    assert gross.loc["Auto", "Latest"] == pytest.approx(large.loc["Health", "Latest"])
+
+
+@pytest.mark.parametrize("sample", ["raa", "genins", "ukmotor"])
+def test_mack_matches_chainladder(sample):
+    tri = cl.load_sample(sample)
+    totals, origins = reserve_summary(tri, mack=True)
+    model = cl.MackChainladder().fit(tri)
+
+    assert totals["IBNR"].iloc[0] == pytest.approx(model.ibnr_.sum())
+    assert totals["Mack Std Err"].iloc[0] == pytest.approx(model.total_mack_std_err_.values[0, 0])
+    expected = np.nan_to_num(np.asarray(model.mack_std_err_.values)[0, 0, :, -1])
+    np.testing.assert_allclose(origins["Mack Std Err"].to_numpy(), expected, rtol=1e-12)
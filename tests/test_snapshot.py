@@ -0,0 +1,48 @@
+import os
+
+import chainladder as cl
+import numpy as np
+import pandas as pd
+import pytest
+
+from snapshot import SNAPSHOT_DIR, list_snapshots, load_snapshot, save_snapshot, snapshot_path
+
+
+@pytest.fixture(autouse=True)
+def in_tmp(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)     # snapshots under .cache
+
+
+def test_round_trip():
+    raa = cl.load_sample("raa")
+    stacked = cl.load_sample("clrd")["CumPaidLoss"].iloc[:5].set_backend("sparse")
+    df = pd.DataFrame({
+        "Line of Business": pd.Categorical(["Motor", "Fire", "Motor"]),
+        "Paid": [1.5, 2.0, -3.25],
+        "Payment Date": pd.to_datetime(["2020-01-31", "2021-06-30", "2022-12-31"]),
+    })
+    cache = {
+        ("raa", "OYDY"): raa,
+        ((("paid", "os"),), "OYDY", "reserve_triangle"): stacked,
+        ("grid",): pd.DataFrame({"LDF": [1.2]}),      # not a triangle: rebuilt on use
+    }
+    path = snapshot_path("project")
+    save_snapshot(path, {"step": 6, "q0": "Motor"}, {"df": df, "df_OS": None}, cache)
+    assert list_snapshots() == ["project"]
+
+    state, frames, triangles = load_snapshot(path)
+    assert state == {"step": 6, "q0": "Motor"}
+    pd.testing.assert_frame_equal(frames["df"], df)
+    assert frames["df_OS"] is None
+
+    assert list(triangles) == [("raa", "OYDY"), ((("paid", "os"),), "OYDY", "reserve_triangle")]
+    assert triangles[("raa", "OYDY")] == raa
+    restored = triangles[((("paid", "os"),), "OYDY", "reserve_triangle")]
+    assert restored.array_backend == "sparse"
+    np.testing.assert_array_equal(restored.values.todense(), stacked.values.todense())
+
+
+def test_names_stay_in_the_snapshot_folder():
+    for name in ("../../etc/passwd", "/tmp/x", ".."):
+        path = os.path.realpath(snapshot_path(name))
+        assert os.path.dirname(path) == os.path.realpath(SNAPSHOT_DIR)
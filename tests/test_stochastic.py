@@ -0,0 +1,29 @@
+import chainladder as cl
+import numpy as np
+import pandas as pd
+import pytest
+
+from stochastic import simulate_reserves
+
+
+def test_parameter_risk_matches_chainladder_bootstrap():
+    tri = cl.load_sample("raa")
+    ranges = simulate_reserves(tri, 5000, process=False, seed=1, workers=1)
+
+    resampled = cl.BootstrapODPSample(n_sims=5000, random_state=1).fit(tri).resampled_triangles_
+    ibnr = np.asarray(cl.Chainladder().fit(resampled).ibnr_.sum("origin").values).ravel()
+    assert ranges["Mean"].iloc[0] == pytest.approx(ibnr.mean(), rel=0.03)
+    assert ranges["Std"].iloc[0] == pytest.approx(ibnr.std(), rel=0.03)
+    assert ranges["Chain ladder IBNR"].iloc[0] == pytest.approx(cl.Chainladder().fit(tri).ibnr_.sum())
+
+
+def test_results_do_not_depend_on_workers():
+    tri = cl.load_sample("clrd")[["CumPaidLoss", "IncurLoss"]].iloc[:3]
+    done = []
+    one = simulate_reserves(tri, 400, seed=7, workers=1, progress=lambda n, total: done.append((n, total)))
+    two = simulate_reserves(tri, 400, seed=7, workers=2)
+
+    pd.testing.assert_frame_equal(one, two)
+    # Triangles too sparse to fit are reported without simulations
+    assert len(one) == 3 * 2 and set(one["Simulations"]) == {0, 400}
+    assert done and done[-1][0] == done[-1][1]
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pytest
+
+from ingest import load_path
+from preprocess import ALL_SEGMENTS, apply_plan, compile_plan
+from triangle_store import QUARTER_COLUMN, append_extract, read_manifest, store_key, stored_specs
+from triangles import OS, PAID, build_catalog, dense, fused_view, triangle_view
+
+SAMPLE = os.path.join(os.path.dirname(__file__), os.pardir, "Test_file.xlsx")
+
+
+@pytest.fixture
+def extract(tmp_path, monkeypatch):
+    path = os.path.abspath(SAMPLE)
+    monkeypatch.chdir(tmp_path)     # caches and the store under .cache
+    df_paid, df_OS, _ = load_path(path)
+    return df_paid, df_OS
+
+
+def _values(tri):
+    return np.nan_to_num(np.asarray(dense(tri).values, dtype="float64"))
+
+
+def test_appended_quarters_build_the_extract_triangles(extract):
+    df_paid, df_OS = extract
+    plan = compile_plan({"q0": ALL_SEGMENTS, "q2": "Gross + RI", "q11": "Quarterly"})
+    early = lambda df: df[df[QUARTER_COLUMN].astype(str) < "2023Q1"]
+
+    assert append_extract(plan, early(df_paid), early(df_OS))["rejected"] == []
+    # The second extract repeats the early quarters, which are not counted twice
+    result = append_extract(plan, df_paid, df_OS)
+    assert result["rejected"] == sorted(early(df_paid)[QUARTER_COLUMN].astype(str).unique())
+    assert result["added"] and min(result["added"]) == "2023Q1"
+
+    catalog = build_catalog("extract", apply_plan(plan, df_paid, "Paid"), apply_plan(plan, df_OS, "OS"))
+    key = store_key(plan)
+    datasets = read_manifest(key)["datasets"]
+    assert set(datasets) == set(catalog)
+
+    cache = {}
+    for name, entry in catalog.items():
+        paid_spec, os_spec = stored_specs(key, name)
+        assert np.allclose(_values(triangle_view(cache, paid_spec, "OQDQ")),
+                           _values(triangle_view(cache, entry["paid"], "OQDQ")))
+        assert np.allclose(_values(triangle_view(cache, os_spec, "OQDQ")),
+                           _values(triangle_view(cache, entry["os"], "OQDQ")))
+
+        # Both sides together, as Steps 3-5 build them
+        stored = fused_view(cache, dict(entry, paid=paid_spec, os=os_spec, premium=None), "OQDQ")
+        assert list(stored.columns) == [PAID, OS, "Incurred"]
+        assert np.allclose(_values(stored[OS]), _values(fused_view(cache, entry, "OQDQ")[OS]))
@@ -0,0 +1,53 @@
+import chainladder as cl
+import numpy as np
+import pandas as pd
+import pytest
+
+from triangles import ORIGIN_COLUMN, bin_rows, build_triangle, dense
+
+SEGMENT = "Line of Business"
+PAYMENT = "Payment Date"
+
+
+def _rows(n, years, seed=0):
+    rng = np.random.default_rng(seed)
+    origin = pd.Timestamp("1990-01-01") + pd.to_timedelta(rng.integers(0, 365 * years, n), unit="D")
+    return pd.DataFrame({
+        SEGMENT: rng.choice(["Auto", "Fire", "Health", "Property", "Marine"], n),
+        ORIGIN_COLUMN: origin,
+        PAYMENT: origin + pd.to_timedelta(rng.integers(0, 365 * years, n), unit="D"),
+        "Paid": rng.normal(1000, 500, n),
+        "RI": rng.normal(-100, 50, n),
+    })
+
+
+# A short span counts into the full cell grid, a long one numbers the occupied cells
+@pytest.mark.parametrize("n, years", [(5000, 5), (200, 50)])
+def test_bins_sum_rows_by_month(n, years):
+    rows = _rows(n, years)
+    cells, density = bin_rows(rows, PAYMENT, ["Paid", "RI"], SEGMENT)
+
+    month = lambda dates: dates.dt.to_period("M").dt.to_timestamp()
+    expected = (rows.assign(**{ORIGIN_COLUMN: month(rows[ORIGIN_COLUMN]), PAYMENT: month(rows[PAYMENT])})
+                .groupby([SEGMENT, ORIGIN_COLUMN, PAYMENT], as_index=False)[["Paid", "RI"]].sum())
+    got = cells.sort_values([SEGMENT, ORIGIN_COLUMN, PAYMENT]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False)
+    assert 0 < density <= 1
+
+
+@pytest.mark.parametrize("grain", ["OYDY", "OQDQ", "OMDM"])
+def test_triangle_from_bins_matches_rows(grain):
+    rows = _rows(3000, 4)
+    tri = build_triangle(rows, PAYMENT, "Paid", SEGMENT)
+    expected = cl.Triangle(rows, origin=ORIGIN_COLUMN, development=PAYMENT, columns="Paid", index=[SEGMENT],
+                           cumulative=False)
+
+    got, expected = dense(tri.grain(grain)), expected.grain(grain)
+    assert got.shape == expected.shape
+    np.testing.assert_allclose(np.nan_to_num(got.values), np.nan_to_num(expected.values), rtol=1e-9)
+
+
+def test_rows_without_dates_are_left_to_chainladder():
+    rows = _rows(10, 2)
+    rows.loc[3, PAYMENT] = pd.NaT
+    assert bin_rows(rows, PAYMENT, "Paid", SEGMENT) == (None, None)
@@ -0,0 +1,224 @@
+import json
+import os
+from contextlib import contextmanager
+
+import pandas as pd
+
+from ingest import apply_filters
+from preprocess import DEVELOPMENT_COLUMNS, apply_plan, materialize, to_month_start
+from triangles import ORIGIN_COLUMN, fingerprint, dataset_spec, bin_rows
+
+
+# Persisted incremental triangles, one folder per configuration, that grow
+# by one calendar diagonal per quarterly extract instead of being rebuilt
+# from the full claims history.
+#
+# Cell files are never overwritten: an append writes a new version of each
+# file it changes and commits them all at once by replacing the manifest,
+# which names the files of the current version. Appends to one store are
+# serialized by a file lock, across sessions and batch processes.
+STORE_DIR = ".cache/triangles"
+QUARTER_COLUMN = "Data Source Qtr"
+
+
+def store_key(plan):
+    """
+    Folder name of the stored triangles for a configuration plan. Unlike
+    the triangle cache keys it does not depend on any one extract.
+    """
+    return fingerprint("triangle-store", plan)
+
+
+def _folder(key):
+    return os.path.join(STORE_DIR, key)
+
+
+def _cells_file(name, dataset, sheet):
+    # Stores written before cell files were versioned have no "files"
+    return dataset.get("files", {}).get(sheet, f"{name}-{sheet}.parquet")
+
+
+def _cells_path(key, name, dataset, sheet):
+    return os.path.join(_folder(key), _cells_file(name, dataset, sheet))
+
+
+def _measure(dataset, sheet):
+    # Stores written before measures were kept per sheet have one "measure"
+    return dataset.get("measures", {}).get(sheet, dataset.get("measure"))
+
+
+def _listed_files(manifest):
+    return {_cells_file(name, dataset, sheet)
+            for name, dataset in manifest["datasets"].items() for sheet in dataset["sheets"]}
+
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock_file(f):
+        # Lock the first byte; LK_LOCK gives up after 10 attempts, so retry
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def _unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock_file(f):
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+    def _unlock_file(f):
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _locked(key):
+    # Exclusive lock on the store's folder for one append
+    os.makedirs(_folder(key), exist_ok=True)
+    with open(os.path.join(_folder(key), "lock"), "w") as f:
+        _lock_file(f)
+        try:
+            yield
+        finally:
+            _unlock_file(f)
+
+
+def read_manifest(key):
+    """
+    The store's manifest: processed quarters, the version of the cell
+    files, the index column and the label, sheets and per-sheet measures
+    and files of each stored dataset. Empty for a new store.
+    """
+    path = os.path.join(_folder(key), "manifest.json")
+    if not os.path.exists(path):
+        return {"quarters": [], "version": 0, "index": None, "datasets": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(key, manifest):
+    path = os.path.join(_folder(key), "manifest.json")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+def triangle_cells(df, development, measure, index=None):
+    """
+    Collapse claim rows into triangle cells: one row per (index, origin
+    month, development month) with the measure summed. A triangle built
+    from the cells equals one built from the rows.
+    """
+    cells, _ = bin_rows(df, development, measure, index)
+    if cells is not None:
+        return cells
+
+    # Rows bin_rows does not cover (missing dates or segment) go through pandas
+    keys = [index] if index is not None else []
+    cells = df[keys + [measure]].copy()
+    cells[ORIGIN_COLUMN] = to_month_start(df[ORIGIN_COLUMN])
+    cells[development] = to_month_start(df[development])
+    return cells.groupby(keys + [ORIGIN_COLUMN, development], as_index=False, observed=True, dropna=False)[measure].sum()
+
+
+def append_extract(plan, df_paid, df_OS):
+    """
+    Add the quarters of a new extract to the stored triangles of `plan`.
+
+    Rows whose Data Source Qtr has already been processed are rejected, so
+    re-sending an extract (or one that overlaps the last) cannot double
+    count. Only the new rows go through apply_plan and are collapsed into
+    cells, which are then merged into the stored cells: the work is
+    proportional to the new quarter, not to the history.
+
+    Returns {"added": [...quarters], "rejected": [...quarters]}.
+    """
+    if plan["alae_yearly_dates"]:
+        # The Dec 15 adjustment moves the latest date of each year, which a
+        # later quarter of the same year changes retroactively
+        raise ValueError("Yearly ALAE dates depend on the whole year's history; "
+                         "rebuild this configuration from the full extract instead.")
+
+    key = store_key(plan)
+    with _locked(key):
+        manifest = read_manifest(key)
+        processed = set(manifest["quarters"])
+
+        extract_quarters = set(df_paid[QUARTER_COLUMN].dropna()) | set(df_OS[QUARTER_COLUMN].dropna())
+        rejected = sorted(extract_quarters & processed, key=str)
+        added = sorted(extract_quarters - processed, key=str)
+        if not added:
+            return {"added": [], "rejected": rejected}
+
+        filters = [(QUARTER_COLUMN, "in", added)]
+        if plan["segment"] is not None:
+            filters.append(("Line of Business", "==", plan["segment"]))
+
+        previous = _listed_files(manifest)
+        version = manifest.get("version", 0) + 1
+        for sheet, df in (("Paid", df_paid), ("OS", df_OS)):
+            development = DEVELOPMENT_COLUMNS[sheet]
+            prepared = apply_plan(plan, apply_filters(df, filters), sheet)
+
+            for name, dataset in prepared["datasets"].items():
+                measure = dataset["measure"]
+                cells = triangle_cells(materialize(prepared, name), development, measure, plan["index"])
+
+                entry = manifest["datasets"].setdefault(name, {"label": dataset["label"], "sheets": []})
+                # Paid and OS cells hold different measure columns
+                entry.setdefault("measures", {})[sheet] = measure
+                if sheet in entry["sheets"]:
+                    keys = [c for c in cells.columns if c != measure]
+                    cells = pd.concat([pd.read_parquet(_cells_path(key, name, entry, sheet)), cells], ignore_index=True)
+                    cells = cells.groupby(keys, as_index=False, observed=True, dropna=False)[measure].sum()
+                else:
+                    entry["sheets"].append(sheet)
+
+                # A new file, unseen until the manifest names it
+                entry.setdefault("files", {})[sheet] = f"{name}-{sheet}-v{version}.parquet"
+                cells.to_parquet(_cells_path(key, name, entry, sheet), index=False)
+
+        # Replacing the manifest commits the new files and quarters at once:
+        # an interrupted append leaves the previous version in place, and a
+        # retry rewrites its files from that version
+        manifest["index"] = plan["index"]
+        manifest["quarters"] = sorted(processed | set(added), key=str)
+        manifest["version"] = version
+        _write_manifest(key, manifest)
+
+        # Files of older versions and of interrupted appends. The previous
+        # version stays, for sessions that have read its manifest
+        keep = previous | _listed_files(manifest)
+        for file in os.listdir(_folder(key)):
+            if file.endswith(".parquet") and file not in keep:
+                os.remove(os.path.join(_folder(key), file))
+
+    return {"added": added, "rejected": rejected}
+
+
+def stored_specs(key, name):
+    """
+    Triangle specs (see triangles.dataset_spec) for the Paid and OS sides
+    of a stored dataset, built from its cells. The cache key includes the
+    processed quarters, so appending a quarter invalidates cached views.
+    os_spec is None when the dataset has no OS side.
+    """
+    manifest = read_manifest(key)
+    dataset = manifest["datasets"][name]
+    base = fingerprint(key, name, manifest["quarters"])
+
+    specs = {}
+    for sheet in ("Paid", "OS"):
+        if sheet in dataset["sheets"]:
+            specs[sheet] = dataset_spec(base + "-" + sheet,
+                                        lambda sheet=sheet: pd.read_parquet(_cells_path(key, name, dataset, sheet)),
+                                        DEVELOPMENT_COLUMNS[sheet], _measure(dataset, sheet), manifest["index"])
+    return specs.get("Paid"), specs.get("OS")
@@ -0,0 +1,515 @@
+import hashlib
+import json
+
+import chainladder as cl
+import numpy as np
+import pandas as pd
+import sparse
+
+from ldf_grid import ldf_grid
+from preprocess import DEVELOPMENT_COLUMNS, materialize
+from profiling import cache_event, stage
+from reserves import lagged, reserve_summary
+from stochastic import simulate_reserves
+
+
+ORIGIN_COLUMN = "Accident/Treatment Date"
+
+# Development period answer (q11) -> chainladder grain
+GRAINS = {"Yearly": "OYDY", "Quarterly": "OQDQ", "Monthly": "OMDM"}
+
+# Triangles with fewer than this fraction of their cells filled are held on
+# chainladder's sparse backend
+SPARSE_DENSITY = 0.1
+
+# Columns of a dataset's fused triangle (see fused_view). Earned Premiums
+# are summed over the dataset's Paid rows, by payment date.
+PAID, OS, INCURRED, PREMIUM = "Paid", "OS", "Incurred", "Earned Premiums"
+
+
+def fingerprint(*parts) -> str:
+    """
+    Stable digest of everything a triangle depends on (file, segment,
+    configuration answers, dataset, measure...). Equal inputs always give
+    the same key, across reruns and sessions.
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def cached(cache, key, build):
+    """
+    Return cache[key], calling build() to fill it on a miss. An
+    OrderedDict cache is kept in least- to most-recently used order, for
+    memory.evict_lru.
+    """
+    if key not in cache:
+        cache_event("triangles", hit=False)
+        cache[key] = build()
+    else:
+        cache_event("triangles", hit=True)
+        if hasattr(cache, "move_to_end"):
+            cache.move_to_end(key)
+    return cache[key]
+
+
+def month_codes(dates):
+    """
+    Integer month codes (months since 1970-01) of a datetime Series, and a
+    mask of the NaT entries.
+    """
+    months = dates.to_numpy(dtype="datetime64[ns]").astype("datetime64[M]")
+    return months.astype(np.int64), np.isnat(months)
+
+
+def bin_rows(data, development, columns, index=None):
+    """
+    Aggregate claim rows into triangle cells: one row per non-empty
+    (index, origin month, development month) with each measure summed.
+
+    Dates are turned into integer month codes once and every row gets a
+    flat cell number, so each measure is summed with a single np.bincount
+    instead of chainladder grouping the raw rows. Cells are dated on the
+    first of the month, which chainladder reads at the same grain.
+
+    Returns (cells, density), density being the fraction of the monthly
+    cells of the tensor that hold rows. Returns (None, None) for data the
+    binning does not cover (missing dates or index values), which is then
+    left to chainladder.
+    """
+    measures = [columns] if isinstance(columns, str) else list(columns)
+    if len(data) == 0:
+        return None, None
+
+    origin, origin_nat = month_codes(data[ORIGIN_COLUMN])
+    dev, dev_nat = month_codes(data[development])
+    if origin_nat.any() or dev_nat.any():
+        return None, None
+
+    if index is not None:
+        segment, segments = pd.factorize(data[index], use_na_sentinel=True)
+        if (segment < 0).any():
+            return None, None
+        segments = np.asarray(segments, dtype=object)
+    else:
+        segment = np.zeros(len(origin), dtype=np.int64)
+
+    lag = dev - origin
+    origin0, lag0 = origin.min(), lag.min()
+    n_origin = origin.max() - origin0 + 1
+    n_lag = lag.max() - lag0 + 1
+    size = (segment.max() + 1) * n_origin * n_lag
+    flat = (segment * n_origin + (origin - origin0)) * n_lag + (lag - lag0)
+
+    if size <= max(4 * len(flat), 1 << 20):
+        # Dense enough to count straight into the full cell grid
+        counts = np.bincount(flat, minlength=size)
+        cell_ids = np.flatnonzero(counts)
+        positions = np.searchsorted(cell_ids, flat)
+    else:
+        # Mostly empty grid: number the occupied cells first
+        cell_ids, positions = np.unique(flat, return_inverse=True)
+
+    cells = {}
+    cell_segment, rest = np.divmod(cell_ids, n_origin * n_lag)
+    cell_origin, cell_lag = np.divmod(rest, n_lag)
+    cell_origin = cell_origin + origin0
+    if index is not None:
+        cells[index] = segments[cell_segment]
+    cells[ORIGIN_COLUMN] = cell_origin.astype("datetime64[M]").astype("datetime64[ns]")
+    cells[development] = (cell_origin + cell_lag + lag0).astype("datetime64[M]").astype("datetime64[ns]")
+    for measure in measures:
+        weights = np.nan_to_num(data[measure].to_numpy(dtype="float64"))
+        cells[measure] = np.bincount(positions, weights=weights, minlength=len(cell_ids))
+
+    return pd.DataFrame(cells), len(cell_ids) / size
+
+
+def density(tri):
+    """
+    Fraction of a triangle's tensor cells that hold a value.
+    """
+    values = tri.values
+    if hasattr(values, "nnz"):
+        return values.nnz / np.prod(values.shape)
+    return np.count_nonzero(~np.isnan(values)) / values.size
+
+
+def fit_backend(tri):
+    """
+    Move a triangle to the sparse or dense backend according to how full
+    it is. Rolling up to a coarser grain or cumulating fills cells, so each
+    view is checked again rather than inheriting its source's backend.
+    """
+    backend = "sparse" if density(tri) < SPARSE_DENSITY else "numpy"
+    if tri.array_backend != backend:
+        tri = tri.set_backend(backend)
+    return tri
+
+
+def dense(tri):
+    """
+    Dense copy of a (typically small, already sliced) triangle for display
+    or export.
+    """
+    if tri.array_backend == "sparse":
+        return tri.set_backend("numpy")
+    return tri
+
+
+def build_triangle(data, development, columns, index=None):
+    """
+    Build an incremental triangle from claim rows, stacked along the index
+    dimension by the `index` column when given. `data` may also be an
+    existing triangle, which is copied as is.
+
+    The rows are first collapsed into cells with bin_rows, so chainladder
+    only sees one row per cell. Sparse data (monthly grain, many segments)
+    is built straight onto the sparse backend.
+    """
+    if hasattr(data, "to_frame"):
+        tri = data.copy()
+    else:
+        with stage("bin rows"):
+            cells, cell_density = bin_rows(data, development, columns, index)
+        if cells is None:
+            cells, backend = data, "numpy"
+            if index is not None and isinstance(data[index].dtype, pd.CategoricalDtype):
+                # chainladder groups by the index; a categorical would bring
+                # every unobserved category into the tensor
+                cells = data.copy(deep=False)
+                cells[index] = data[index].astype("object")
+        else:
+            backend = "sparse" if cell_density < SPARSE_DENSITY else "numpy"
+
+        with stage("cl.Triangle"):
+            if index is not None:
+                tri = cl.Triangle(data=cells, origin=ORIGIN_COLUMN, development=development, columns=columns,
+                                  index=[index], array_backend=backend)
+            else:
+                tri = cl.Triangle(data=cells, origin=ORIGIN_COLUMN, development=development, columns=columns,
+                                  array_backend=backend)
+            tri = fit_backend(tri)
+    tri.is_cumulative = False
+    return tri
+
+
+def select_segment(tri, segment):
+    """
+    Slice one segment out of a triangle stacked by segment. Triangles of a
+    single segment (segment None) are returned as is.
+    """
+    if segment is None:
+        return tri
+    return tri.loc[segment]
+
+
+def segment_labels(tri):
+    """
+    Labels of the segments a triangle stacked by segment holds rows for,
+    which for a dataset can be fewer than the segments of the data.
+    """
+    return tri.index.iloc[:, 0].tolist()
+
+
+def segment_frame(tri, segment=None, origins=None, developments=None):
+    """
+    The origin x development frame of a triangle (one segment of it when
+    stacked by segment), optionally cut down to a window of origin and
+    development positions (slices). Only that slice is made dense.
+    """
+    tri = select_segment(tri, segment)
+    if origins is not None or developments is not None:
+        tri = tri.iloc[:, :, origins or slice(None), developments or slice(None)]
+    with stage("to_frame"):
+        return dense(tri).to_frame(origin_as_datetime=False)
+
+
+def renumbered(tri):
+    """
+    Copy of a triangle with development periods relabelled 1..n, so that
+    Paid and OS triangles line up column by column.
+    """
+    tri = tri.copy()
+    tri.development = pd.Index([i + 1 for i in range(tri.development.size)])
+    return tri
+
+
+def dataset_spec(key, load, development, columns, index=None):
+    """
+    Describe one dataset for the functions below: its cache key, a callable
+    returning its rows (or triangle), the development date column, the
+    measure column(s) and the optional segment column to stack by. `load`
+    is only called when a triangle is missing.
+    """
+    return {"key": key, "load": load, "development": development, "columns": columns, "index": index}
+
+
+def build_catalog(config_key, prepared, prepared_OS):
+    """
+    Catalog of the datasets of apply_plan results, keyed by dataset name.
+
+    Each entry pairs the Paid and OS sides under one key with the
+    dataset's label, measure, source columns and development date columns,
+    and holds a spec (see dataset_spec) per side; "os" is None when the
+    dataset has no OS counterpart. "premium" is the Earned Premiums of the
+    Paid rows, or None when the extract has no such column. Building the
+    catalog materializes nothing: a dataset's rows are only taken when a
+    triangle of it is first needed.
+
+    Datasets without Paid rows (e.g. Large Claims when no claim is above
+    the threshold) are left out, and an OS side without rows is None: no
+    triangle can be built of them.
+    """
+    catalog = {}
+    for name, dataset in prepared["datasets"].items():
+        if not len(dataset["rows"]):
+            continue
+        key = fingerprint(config_key, name)
+        entry = {
+            "name": name,
+            "label": dataset["label"],
+            "measure": dataset["measure"],
+            "sources": dataset["sources"],
+            "development": {"Paid": DEVELOPMENT_COLUMNS["Paid"]},
+            "paid": dataset_spec(key + "-Paid", lambda name=name: materialize(prepared, name),
+                                 DEVELOPMENT_COLUMNS["Paid"], dataset["measure"], prepared["index"]),
+            "os": None,
+            "premium": None,
+        }
+        if PREMIUM in prepared["frame"].columns:
+            entry["premium"] = dataset_spec(key + "-EP", lambda name=name: materialize(prepared, name),
+                                            DEVELOPMENT_COLUMNS["Paid"], PREMIUM, prepared["index"])
+        if name in prepared_OS["datasets"] and len(prepared_OS["datasets"][name]["rows"]):
+            entry["development"]["OS"] = DEVELOPMENT_COLUMNS["OS"]
+            entry["os"] = dataset_spec(key + "-OS", lambda name=name: materialize(prepared_OS, name),
+                                       DEVELOPMENT_COLUMNS["OS"], prepared_OS["datasets"][name]["measure"],
+                                       prepared_OS["index"])
+        catalog[name] = entry
+    return catalog
+
+
+def _load(spec):
+    with stage("load dataset"):
+        return spec["load"]()
+
+
+def base_triangle(cache, spec):
+    """
+    The incremental triangle of a dataset at the data's own grain. Every
+    other view below is derived from this one object.
+    """
+    return cached(
+        cache,
+        (spec["key"], "base"),
+        lambda: build_triangle(_load(spec), spec["development"], spec["columns"], spec["index"]),
+    )
+
+
+def triangle_view(cache, spec, grain):
+    """
+    Incremental view of one side of a dataset at `grain` ('OYDY', 'OQDQ'
+    or 'OMDM'), with its own development labels.
+    """
+    def build():
+        with stage("grain"):
+            return fit_backend(base_triangle(cache, spec).grain(grain))
+
+    return cached(cache, (spec["key"], grain), build)
+
+
+def _reindexed(tri, keys):
+    # `tri` with one row per index key, in that order; keys it lacks get
+    # empty rows
+    own = [tuple(key) for key in tri.kdims]
+    if own == keys:
+        return tri
+    rows = {key: i for i, key in enumerate(own)}
+    module = sparse if tri.array_backend == "sparse" else np
+    empty = module.full((1,) + tri.values.shape[1:], np.nan)
+    out = tri.copy()
+    out.values = module.concatenate([tri.values[[rows[key]]] if key in rows else empty for key in keys], axis=0)
+    out.kdims = np.array(keys, dtype=object)
+    return out
+
+
+def _aligned(triangles):
+    # Bring triangles onto the union of their segments, origins and
+    # development periods. Segments are matched by label (chainladder
+    # would broadcast a one-segment triangle onto every segment); adding
+    # an all-zero copy of the others then only pads with NaN
+    backend = "sparse" if all(t.array_backend == "sparse" for t in triangles) else "numpy"
+    triangles = [t if t.array_backend == backend else t.set_backend(backend) for t in triangles]
+    keys = list(dict.fromkeys(tuple(key) for t in triangles for key in t.kdims))
+    triangles = [_reindexed(t, keys) for t in triangles]
+    aligned = []
+    for i, tri in enumerate(triangles):
+        for j, other in enumerate(triangles):
+            if i != j:
+                tri = tri + other * 0
+        aligned.append(tri)
+    return aligned
+
+
+def _side(cache, spec, grain, cumulative):
+    # One side of a fused view. It is cumulated before being relabelled:
+    # chainladder masks cells past the valuation date by development age
+    tri = triangle_view(cache, spec, grain)
+    if cumulative:
+        with stage("incr_to_cum"):
+            tri = tri.incr_to_cum()
+    return renumbered(tri)
+
+
+def fused_view(cache, entry, grain, cumulative=False):
+    """
+    Paid, OS, Incurred and Earned Premiums of a catalog entry as the
+    columns of one triangle at `grain`, development relabelled 1..n so the
+    sides line up column by column, all on the same origins and
+    development periods. OS and Incurred are only there when the dataset
+    has an OS side, Earned Premiums when it has premiums.
+
+    OS is never cumulated, so in the cumulative view Incurred is the
+    incremental OS plus the cumulative Paid.
+    """
+    def build():
+        specs = {PAID: entry["paid"], OS: entry["os"], PREMIUM: entry.get("premium")}
+        names = [name for name, spec in specs.items() if spec is not None]
+        with stage("align"):
+            sides = _aligned([_side(cache, specs[name], grain, cumulative and name != OS) for name in names])
+        sides = dict(zip(names, sides))
+
+        tri = sides[PAID].rename("columns", [PAID])
+        if OS in sides:
+            tri[OS] = sides[OS]
+            with stage("incurred"):
+                tri[INCURRED] = sides[OS] + sides[PAID]
+        if PREMIUM in sides:
+            tri[PREMIUM] = sides[PREMIUM]
+        tri.is_cumulative = cumulative  # Necessary for proper averages
+        return fit_backend(tri)
+
+    key = (entry["paid"]["key"], entry["os"] and entry["os"]["key"], entry.get("premium") and entry["premium"]["key"])
+    return cached(cache, key + (grain, cumulative, "fused"), build)
+
+
+def _development_columns(tri):
+    # The columns link ratios and LDFs are taken of
+    return [column for column in (PAID, INCURRED) if column in tri.columns]
+
+
+def _link_ratio(tri):
+    with stage("link_ratio"):
+        return tri.link_ratio
+
+
+def _fit_ldf(tri, average):
+    with stage("cl.Development"):
+        return cl.Development(average=average).fit(tri).ldf_
+
+
+def fused_link_ratio_view(cache, entry, grain):
+    """
+    Link ratios of the cumulative Paid (and Incurred) columns of a fused
+    view.
+    """
+    def build():
+        tri = fused_view(cache, entry, grain, cumulative=True)
+        return _link_ratio(tri[_development_columns(tri)])
+
+    return cached(cache, (entry["paid"]["key"], entry["os"] and entry["os"]["key"], grain, "link_ratio"), build)
+
+
+def fused_ldf_view(cache, entry, grain, average):
+    """
+    Loss development factors of the cumulative Paid (and Incurred) columns
+    of a fused view for one averaging method ('simple', 'volume' or
+    'regression'), fitted together.
+    """
+    def build():
+        tri = fused_view(cache, entry, grain, cumulative=True)
+        return _fit_ldf(tri[_development_columns(tri)], average)
+
+    return cached(cache, (entry["paid"]["key"], entry["os"] and entry["os"]["key"], grain, "ldf", average), build)
+
+
+def ldf_grid_view(cache, entry, grain):
+    """
+    LDFs of the cumulative Paid (and Incurred) columns of a fused view for
+    every averaging method and window (see ldf_grid), computed once so any
+    method / n_periods selection is just a lookup.
+    """
+    def build():
+        tri = fused_view(cache, entry, grain, cumulative=True)
+        with stage("ldf grid"):
+            return ldf_grid(tri[_development_columns(tri)])
+
+    return cached(cache, (entry["paid"]["key"], entry["os"] and entry["os"]["key"], grain, "ldf_grid"), build)
+
+
+def bootstrap_view(cache, entry, grain, n_sims, seed=0, process=True, workers=None, progress=None):
+    """
+    ODP bootstrap reserve ranges of the cumulative Paid (and Incurred)
+    columns of a fused view (see stochastic.simulate_reserves), one row
+    per segment and column.
+    """
+    def build():
+        tri = fused_view(cache, entry, grain, cumulative=True)
+        return simulate_reserves(tri[_development_columns(tri)], n_sims, process=process, seed=seed,
+                                 workers=workers, progress=progress)
+
+    key = (entry["paid"]["key"], entry["os"] and entry["os"]["key"], grain, "bootstrap", n_sims, seed, process)
+    return cached(cache, key, build)
+
+
+def reserve_triangle(cache, catalog, grain):
+    """
+    The cumulative Paid (and Incurred) columns of every dataset of a
+    catalog as the columns of one triangle ("<label> / Paid", ...), stacked
+    by segment like the datasets, on the same origins and development
+    periods, with development ages in months (see reserves.lagged).
+    """
+    def build():
+        sides, labels = [], []
+        for entry in catalog.values():
+            tri = fused_view(cache, entry, grain, cumulative=True)
+            columns = _development_columns(tri)
+            sides.append(tri[columns])
+            labels.append([f"{entry['label']} / {c}" for c in columns])
+        with stage("align"):
+            sides = _aligned(sides)
+        # Named after aligning: adding triangles keeps the column names of one side only
+        sides = [side.rename("columns", names) for side, names in zip(sides, labels)]
+        tri = sides[0]
+        for side in sides[1:]:
+            for column in side.columns:
+                tri[column] = side[column]
+        tri.is_cumulative = True
+        return lagged(tri, grain)
+
+    keys = tuple((entry["paid"]["key"], entry["os"] and entry["os"]["key"]) for entry in catalog.values())
+    return cached(cache, (keys, grain, "reserve_triangle"), build)
+
+
+def reserve_view(cache, catalog, grain, mack=False):
+    """
+    Chain ladder ultimates and IBNR (and Mack standard errors) of every
+    dataset and segment of a catalog, fitted together on reserve_triangle.
+    Returns (totals, origins) frames indexed by segment, dataset and
+    column (and origin).
+    """
+    def build():
+        totals, origins = reserve_summary(reserve_triangle(cache, catalog, grain), mack)
+        return tuple(_split_columns(frame) for frame in (totals, origins))
+
+    keys = tuple((entry["paid"]["key"], entry["os"] and entry["os"]["key"]) for entry in catalog.values())
+    return cached(cache, (keys, grain, "reserves", mack), build)
+
+
+def _split_columns(frame):
+    # "<label> / Paid" -> Dataset "<label>", Column "Paid"
+    index = frame.index.to_frame(index=False)
+    parts = index.pop("Column").str.rsplit(" / ", n=1, expand=True)
+    index.insert(1, "Dataset", parts[0])
+    index.insert(2, "Column", parts[1])
+    return frame.set_axis(pd.MultiIndex.from_frame(index))